@@ -13,26 +13,66 @@ Options
                          -99  all templates
 --n_shots K              Prepend K shots; shots & target share one template
                          (incompatible with --prompt_id)
+--shot_pool N            Reservoir size per stratum (default 1000)
+--stratify S             Draw shots from the target's language | choices | source
+--max_tokens N           Token budget per prompt: fewer shots when the K shots
+                         do not fit, targets longer than N are skipped
+--tokenizer NAME         Tokenizer for --max_tokens (common.tokenizer_provider)
 --limit N                Stop after N generated prompts
 --keep_keys              Copy all original JSON keys; overwrite only id/text
 --backup_result          Duplicate original 'result' ➜ 'old_result'
 --output_file FILE       Write prompts as JSONL (stdout if omitted)
+--seed N                 Seed for the per-record generators (random and
+                         printed if omitted)
+--num_workers N          Processes (default: all cores)
+--shard_mb N             Input megabytes per shard (default 16); fixes the
+                         shard boundaries, and with them the output
+--work_dir DIR           Keep finished shards here; a rerun with the same
+                         settings resumes at the first unfinished shard
 
-Fast: single-pass, ≤1000-item reservoir for few-shot sampling.
+Deterministic: every random choice for a record (template, shuffle, shot
+sample, reservoir slot) comes from a generator keyed on (seed, "3b_spm",
+record id), common.record_rng.RecordRNG. The input is cut into line-aligned byte ranges that are
+converted independently (each with its own few-shot pool, whose first
+n_shots items only fill it) and concatenated in input order, so the output
+is byte-identical for every --num_workers and for resumed runs.
+
+Fast: single-pass; templates are compiled once (common.mcq_template) and
+only build the choice layouts they use, once per record; few-shot items
+live in an indexed pool (shot_pool.py) that caches each shot's rendering
+and token length per template.
 """
 
 import argparse
+import contextlib
 import copy
+import itertools
 import json
+import os
 import random
 import re
+import shutil
 import sys
-from typing import Dict, List
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
 
 from tqdm import tqdm
 
+from shot_pool import STRATA, ShotPool, stratum_key
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.mcq_template import LazyFields, compile_templates
+from common.record_rng import RecordRNG, fresh_seed
+from common.token_counting import byte_ranges, iter_range_lines
+from common.tokenizer_provider import load_tokenizer
+
 LABELS = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
-SHOT_BUF = 1_000                       # reservoir size for few-shot
+SHOT_BUF = 1_000                       # reservoir size for few-shot (per stratum)
+SHARD_MB = 16                          # input megabytes per shard
+STAGE = "3b_spm"
 
 # -------------------------------------------------------------------------
 # PROMPT TEMPLATES
@@ -146,119 +186,241 @@ def validate(e: dict):
     if a not in LABELS[: len(e["choices"])]: raise ValueError
 
 def answer_text(e): return e["choices"][LABELS.index(e["answer"])]
-def shuffle(e):
+def shuffle(e, rng=random):
     cor = answer_text(e)
-    random.shuffle(e["choices"])
+    rng.shuffle(e["choices"])
     e["answer"] = LABELS[e["choices"].index(cor)]
 
-def choose_pids(arg: int) -> List[int]:
-    if arg is None:   return [random.randint(0, MAX_PID)]
+def choose_pids(arg: int, rng=random) -> List[int]:
+    if arg is None:   return [rng.randint(0, MAX_PID)]
     if arg >= 0:      return [arg] if arg <= MAX_PID else sys.exit("prompt_id out of range")
     if arg == -99:    return list(range(MAX_PID + 1))
-    return random.sample(range(MAX_PID + 1), k=min(abs(arg), MAX_PID + 1))
+    return rng.sample(range(MAX_PID + 1), k=min(abs(arg), MAX_PID + 1))
+
+def plain_commas(ch): return ", ".join(ch[:-1])+f" eller {ch[-1]}" if len(ch)>1 else ch[0]
+
+# placeholder -> builder; only the ones a template uses are computed (once per record)
+FIELDS = {
+    "question":         lambda e: e["question"].strip(),
+    "letters":          lambda e: "\n".join(f"{l}: {t}" for l, t in zip(LABELS, e["choices"])),
+    "letters_bullets":  lambda e: "\n".join(f"- {l}: {t}" for l, t in zip(LABELS, e["choices"])),
+    "letters_dashes":   lambda e: "\n".join(f"– {l}: {t}" for l, t in zip(LABELS, e["choices"])),
+    "plain_bullets":    lambda e: "\n".join(f"- {t}" for t in e["choices"]),
+    "plain_commas":     lambda e: plain_commas(e["choices"]),
+    "options":          lambda e: ", ".join(LABELS[: len(e["choices"])]),
+    "answer":           lambda e: e["answer"],
+    "answer_text":      answer_text,
+    "answer_combo":     lambda e: f"{e['answer']} – {answer_text(e)}",
+    "full_text_answer": answer_text,
+}
+TEMPLATES = compile_templates(PROMPTS, FIELDS)
+
+def fields(e): return LazyFields(e, FIELDS)
 
 def render(e, pid):
-    q, ch, ans = e["question"].strip(), e["choices"], e["answer"]
-    letters         = "\n".join(f"{l}: {t}" for l, t in zip(LABELS, ch))
-    letters_bullets = "\n".join(f"- {l}: {t}" for l, t in zip(LABELS, ch))
-    letters_dashes  = "\n".join(f"– {l}: {t}" for l, t in zip(LABELS, ch))
-    plain_bullets   = "\n".join(f"- {t}" for t in ch)
-    plain_commas    = ", ".join(ch[:-1])+f" eller {ch[-1]}" if len(ch)>1 else ch[0]
-    opts            = ", ".join(LABELS[: len(ch)])
-    return PROMPTS[pid].format(
-        question=q, letters=letters, letters_bullets=letters_bullets,
-        letters_dashes=letters_dashes, plain_bullets=plain_bullets,
-        plain_commas=plain_commas, options=opts, answer=ans,
-        answer_text=answer_text(e),
-        answer_combo=f"{ans} – {answer_text(e)}",
-        full_text_answer=answer_text(e))
+    """e: an item, or its fields(e) to share the choice layouts across templates."""
+    return TEMPLATES[pid].render(e if isinstance(e, LazyFields) else fields(e))
 
 SHOT_TEMPLATE = "Spørsmål: {question}\n\nSvar: {answer}"
 def render_shot(e): return SHOT_TEMPLATE.format(
         question=e["question"].strip(), answer=answer_text(e))
 
 # -------------------------------------------------------------------------
-def main() -> None:
-    pr = argparse.ArgumentParser()
-    pr.add_argument("--input_file", required=True)
-    pr.add_argument("--output_file")
-    pr.add_argument("--prompt_id", type=int)
-    pr.add_argument("--shuffle_alternatives", action="store_true")
-    pr.add_argument("--limit", type=int)
-    pr.add_argument("--n_shots", type=int, default=0)
-    pr.add_argument("--keep_keys", action="store_true")
-    pr.add_argument("--backup_result", action="store_true")
-    args = pr.parse_args()
-
-    if args.n_shots and args.prompt_id is not None:
-        sys.exit("--n_shots cannot be combined with --prompt_id")
+# SHARDED GENERATION
+# -------------------------------------------------------------------------
+_ARGS = None
+_COUNT_TOKENS = None
 
-    outfh = open(args.output_file, "w", encoding="utf-8") if args.output_file else None
-    wr = outfh if outfh else sys.stdout
+def init_worker(args) -> None:
+    global _ARGS, _COUNT_TOKENS
+    _ARGS, _COUNT_TOKENS = args, None
+    if args.max_tokens:
+        tok = load_tokenizer(args.tokenizer)
+        _COUNT_TOKENS = lambda s: len(tok.encode(s, add_special_tokens=False))
 
-    reservoir: List[dict] = []
+def generate(lines, args, count_tokens, stats: Counter) -> Iterator[str]:
+    """JSON lines for (byte offset, raw line) pairs; every draw comes from the record's own rng."""
+    pool = ShotPool(args.shot_pool, render, count_tokens)
+    rngs = RecordRNG(args.seed, STAGE)
     produced = 0
-    shot_suffix = f"_{args.n_shots}shot" if args.n_shots else ""
 
-    for raw in tqdm(open(args.input_file, encoding="utf-8"),
-                    desc="Processing", unit="line"):
+    for offset, raw in lines:
         if args.limit and produced >= args.limit:
             break
         try:
             outer = json.loads(raw)
             itm   = fenced_json(outer["result"])
-            itm["_base"] = outer.get("id", f"id{produced}")
+            itm["_base"] = outer.get("id", f"id{offset}")
             validate(itm)
         except Exception:
             continue
+        rng = rngs(itm["_base"])
 
         main_e = copy.deepcopy(itm) if args.shuffle_alternatives else itm
         if args.shuffle_alternatives:
-            shuffle(main_e)
+            shuffle(main_e, rng)
+        target = fields(main_e)
 
         # FEW-SHOT
         if args.n_shots:
-            if len(reservoir) < args.n_shots:
-                if len(reservoir) < SHOT_BUF:
-                    reservoir.append(itm)
+            key = stratum_key(args.stratify, outer, itm)
+            shots = pool.draw(args.n_shots, key, rng)
+            shot = target if main_e is itm else fields(itm)
+            if shots is None:
+                pool.add(shot, key, rng)
                 continue
 
-            pid = random.randint(0, MAX_PID)
-            shots = random.sample(reservoir, k=args.n_shots)
-            prompt_text = "\n\n".join(render(s, pid) for s in shots) + \
-                          "\n\n" + render(main_e, pid)
+            pid = rng.randint(0, MAX_PID)
+            prompt_text, used = pool.compose(shots, pid, render(target, pid),
+                                             args.max_tokens)
+            pool.add(shot, key, rng)
+            if prompt_text is None:
+                stats["too_long"] += 1
+                continue
             rec = outer.copy() if args.keep_keys else {}
             if args.backup_result:
                 rec["old_result"] = outer.get("result")
-            rec.update({"id": f"{itm['_base']}{shot_suffix}_prompt{pid}",
+            rec.update({"id": f"{itm['_base']}_{used}shot_prompt{pid}",
                         "text": prompt_text})
-            json.dump(rec, wr); wr.write("\n")
+            yield json.dumps(rec)
             produced += 1
         # REGULAR
         else:
-            for pid in choose_pids(args.prompt_id):
+            for pid in choose_pids(args.prompt_id, rng):
                 if args.limit and produced >= args.limit:
                     break
-                txt = render(main_e, pid)
+                txt = render(target, pid)
+                if args.max_tokens and count_tokens(txt) > args.max_tokens:
+                    stats["too_long"] += 1
+                    continue
                 rec = outer.copy() if args.keep_keys else {}
                 if args.backup_result:
                     rec["old_result"] = outer.get("result")
                 rec.update({"id": f"{itm['_base']}_prompt{pid}", "text": txt})
-                json.dump(rec, wr); wr.write("\n")
+                yield json.dumps(rec)
                 produced += 1
 
-        # update reservoir
-        if args.n_shots:
-            if len(reservoir) < SHOT_BUF:
-                reservoir.append(itm)
+def process_shard(job: Tuple[str, int, int, str]) -> Tuple[int, dict]:
+    """Worker: write the prompts of one byte range to its shard file; (bytes, stats).
+
+    A shard is only complete once its .done file exists, so an interrupted
+    run with --work_dir picks up at the first missing shard."""
+    path, start, end, shard = job
+    done = Path(shard + ".done")
+    if done.is_file():
+        return end - start, json.loads(done.read_text())
+    stats = Counter(produced=0, too_long=0)
+    lines = iter_range_lines(Path(path), start, end, offsets=True)
+    with open(shard + ".part", "w", encoding="utf-8") as fh:
+        for line in generate(lines, _ARGS, _COUNT_TOKENS, stats):
+            fh.write(line + "\n")
+            stats["produced"] += 1
+    os.replace(shard + ".part", shard)
+    done.write_text(json.dumps(stats))
+    return end - start, dict(stats)
+
+def check_work_dir(work_dir: Path, args) -> None:
+    """Refuse to resume shards that were generated with other settings."""
+    params = {k: v for k, v in sorted(vars(args).items())
+              if k not in ("output_file", "num_workers", "work_dir")}
+    marker = work_dir / "params.json"
+    if marker.is_file():
+        if json.loads(marker.read_text()) != params:
+            sys.exit(f"{work_dir} holds shards from a run with other settings "
+                     f"(see {marker}); use another --work_dir")
+    else:
+        marker.write_text(json.dumps(params, indent=2) + "\n")
+
+# -------------------------------------------------------------------------
+def main() -> None:
+    pr = argparse.ArgumentParser()
+    pr.add_argument("--input_file", required=True)
+    pr.add_argument("--output_file")
+    pr.add_argument("--prompt_id", type=int)
+    pr.add_argument("--shuffle_alternatives", action="store_true")
+    pr.add_argument("--limit", type=int)
+    pr.add_argument("--n_shots", type=int, default=0)
+    pr.add_argument("--shot_pool", type=int, default=SHOT_BUF)
+    pr.add_argument("--stratify", choices=STRATA)
+    pr.add_argument("--max_tokens", type=int)
+    pr.add_argument("--tokenizer", default="meta-llama/Llama-3.1-8B")
+    pr.add_argument("--keep_keys", action="store_true")
+    pr.add_argument("--backup_result", action="store_true")
+    pr.add_argument("--seed", type=int)
+    pr.add_argument("--num_workers", type=int, default=os.cpu_count())
+    pr.add_argument("--shard_mb", type=float, default=SHARD_MB)
+    pr.add_argument("--work_dir")
+    args = pr.parse_args()
+
+    if args.n_shots and args.prompt_id is not None:
+        sys.exit("--n_shots cannot be combined with --prompt_id")
+    if args.seed is None:
+        args.seed = fresh_seed()
+        print(f"Seed: {args.seed} (pass --seed {args.seed} to reproduce)", file=sys.stderr)
+
+    path = Path(args.input_file)
+    shard_bytes = max(1, int(args.shard_mb * 2**20))
+    ranges = byte_ranges(path, shard_bytes)
+    parallel = args.num_workers > 1 and len(ranges) > 1
+    produced = too_long = 0
+    with contextlib.ExitStack() as stack:
+        outfh = stack.enter_context(open(args.output_file, "w", encoding="utf-8")) if args.output_file else None
+        wr = outfh if outfh else sys.stdout
+        bar = stack.enter_context(tqdm(total=path.stat().st_size, desc="Processing",
+                                       unit="B", unit_scale=True))
+
+        # One process, nothing to resume: convert the shards straight into the output.
+        if not parallel and not args.work_dir:
+            init_worker(args)
+            for start, end in ranges:
+                stats = Counter(too_long=0)
+                lines = generate(iter_range_lines(path, start, end, offsets=True), args, _COUNT_TOKENS, stats)
+                for line in itertools.islice(lines, args.limit - produced if args.limit else None):
+                    wr.write(line + "\n")
+                    produced += 1
+                too_long += stats["too_long"]
+                bar.update(end - start)
+                if args.limit and produced >= args.limit:
+                    break
+        else:
+            if args.work_dir:
+                work_dir = Path(args.work_dir)
+                work_dir.mkdir(parents=True, exist_ok=True)
+                check_work_dir(work_dir, args)
+            else:
+                out_dir = Path(args.output_file).parent if args.output_file else None
+                work_dir = Path(stack.enter_context(tempfile.TemporaryDirectory(dir=out_dir)))
+            jobs = [(str(path), start, end, str(work_dir / f"{path.stem}.{k:05d}.jsonl"))
+                    for k, (start, end) in enumerate(ranges)]
+            if parallel:
+                os.environ["TOKENIZERS_PARALLELISM"] = "false"
+                executor = stack.enter_context(ProcessPoolExecutor(
+                    args.num_workers, initializer=init_worker, initargs=(args,)))
+                results = executor.map(process_shard, jobs)
             else:
-                j = random.randint(0, produced-1)
-                if j < SHOT_BUF:
-                    reservoir[j] = itm
+                init_worker(args)
+                results = map(process_shard, jobs)
+
+            # Shards are concatenated in input order: the output does not depend on --num_workers.
+            for job, (nbytes, stats) in zip(jobs, results):
+                with open(job[3], encoding="utf-8") as fh:
+                    if args.limit:
+                        for line in itertools.islice(fh, args.limit - produced):
+                            wr.write(line)
+                            produced += 1
+                    else:
+                        produced += stats["produced"]
+                        shutil.copyfileobj(fh, wr, 1 << 20)
+                too_long += stats["too_long"]
+                bar.update(nbytes)
+                if args.limit and produced >= args.limit:
+                    if parallel:
+                        executor.shutdown(cancel_futures=True)
+                    break
 
-    if outfh:
-        outfh.close()
     print(f"Prompts generated: {produced}", file=sys.stderr)
+    if args.max_tokens:
+        print(f"Skipped (over {args.max_tokens} tokens): {too_long}", file=sys.stderr)
 
 if __name__ == "__main__":
     main()
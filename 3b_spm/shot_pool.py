@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+shot_pool.py
+============
+
+Indexed few-shot pool for process_question.py --n_shots.
+
+• one reservoir per stratum (--stratify language | choices | source), each a
+  uniform sample of the items seen so far in that stratum (Algorithm R,
+  replacement index drawn over items seen), plus one over all items
+• a target draws its shots from its own stratum, or from the whole pool
+  while its stratum holds fewer than n_shots items
+• every pooled item caches its rendering per template id and the token
+  length of that rendering, so a shot is rendered and tokenized once however
+  often it is drawn
+• with a token budget, shots are added while the cached lengths fit and the
+  final prompt is encoded once to check it; shots are dropped until it fits
+• add() and draw() take an optional rng (default: the pool's), so the
+  replacement index and the sample can come from the record's own generator
+  (common.record_rng) instead of one shared stream
+"""
+
+import random
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+SEPARATOR = "\n\n"                     # between shots and target
+STRATA = ("language", "choices", "source")
+
+
+def stratum_key(stratify: Optional[str], outer: dict, item: dict):
+    """Stratum of one input record (None: unstratified)."""
+    if stratify == "choices":
+        return len(item["choices"])
+    if stratify == "language":
+        return outer.get("language") or item.get("language")
+    if stratify == "source":
+        # explicit source, else the id without its running number (edu15_da_q_123 -> edu15_da_q)
+        return outer.get("source") or re.sub(r"[_\-]?\d+$", "", str(item.get("_base", "")))
+    return None
+
+
+class Shot:
+    __slots__ = ("item", "texts", "lengths")
+
+    def __init__(self, item: dict):
+        self.item = item
+        self.texts: Dict[int, str] = {}    # template id -> rendering
+        self.lengths: Dict[int, int] = {}  # template id -> tokens in rendering
+
+
+class ShotPool:
+    def __init__(self, capacity: int, render: Callable[[dict, int], str],
+                 count_tokens: Optional[Callable[[str], int]] = None,
+                 rng: random.Random = random):
+        self.capacity = capacity
+        self.render = render
+        self.count_tokens = count_tokens
+        self.rng = rng
+        self.sep_tokens = count_tokens(SEPARATOR) if count_tokens else 0
+        self.pools: Dict[object, List[Shot]] = {}
+        self.seen: Dict[object, int] = {}
+        self.everything: List[Shot] = []
+        self.seen_all = 0
+
+    def __len__(self) -> int:
+        return len(self.everything)
+
+    def _offer(self, pool: List[Shot], seen: int, shot: Shot, rng: random.Random) -> None:
+        if len(pool) < self.capacity:
+            pool.append(shot)
+        else:
+            j = rng.randrange(seen)
+            if j < self.capacity:
+                pool[j] = shot
+
+    def add(self, item: dict, key=None, rng: Optional[random.Random] = None) -> None:
+        rng = rng or self.rng
+        shot = Shot(item)
+        self.seen_all += 1
+        self._offer(self.everything, self.seen_all, shot, rng)
+        if key is not None:
+            self.seen[key] = self.seen.get(key, 0) + 1
+            self._offer(self.pools.setdefault(key, []), self.seen[key], shot, rng)
+
+    def draw(self, k: int, key=None, rng: Optional[random.Random] = None) -> Optional[List[Shot]]:
+        """k distinct shots from the key's stratum (or the whole pool); None if the pool is too small."""
+        pool = self.pools.get(key, ()) if key is not None else self.everything
+        if len(pool) < k:
+            pool = self.everything
+            if len(pool) < k:
+                return None
+        return (rng or self.rng).sample(pool, k)
+
+    def text(self, shot: Shot, pid: int) -> str:
+        text = shot.texts.get(pid)
+        if text is None:
+            text = shot.texts[pid] = self.render(shot.item, pid)
+        return text
+
+    def length(self, shot: Shot, pid: int) -> int:
+        n = shot.lengths.get(pid)
+        if n is None:
+            n = shot.lengths[pid] = self.count_tokens(self.text(shot, pid))
+        return n
+
+    def compose(self, shots: List[Shot], pid: int, target: str,
+                max_tokens: Optional[int] = None) -> Tuple[Optional[str], int]:
+        """(prompt, shots used); (None, 0) when the target alone exceeds max_tokens."""
+        if max_tokens is None:
+            return SEPARATOR.join([self.text(s, pid) for s in shots] + [target]), len(shots)
+        used = self.count_tokens(target)
+        if used > max_tokens:
+            return None, 0
+        chosen = []
+        for s in shots:
+            n = self.length(s, pid) + self.sep_tokens
+            if used + n <= max_tokens:
+                chosen.append(s)
+                used += n
+        while True:
+            prompt = SEPARATOR.join([self.text(s, pid) for s in chosen] + [target])
+            if not chosen or self.count_tokens(prompt) <= max_tokens:
+                return prompt, len(chosen)
+            chosen.pop()
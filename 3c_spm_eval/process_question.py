@@ -6,25 +6,36 @@ MCQ ➜ plain prompts  |  HF chat prompts
 """
 
 import argparse, json, os, random, re, sys
+from pathlib import Path
 from typing import List
 from tqdm import tqdm
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer, set_chat_fields
+from common.mcq_template import LazyFields, TemplateError, compile_template
+from common import tokenizer_provider
+
 LABELS = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
 OR_WORD = "eller"   # overridden by --english
 
 # ------------ templates ---------------------------------------------------
 def load_templates():
+    """prompts.txt compiled once; unknown or malformed placeholders fail here."""
     path = os.path.join(os.path.dirname(__file__), "prompts.txt")
+    templates = []
     with open(path, encoding="utf-8") as fh:
-        return [ln.rstrip("\n") for ln in fh
-                if ln.strip() and not ln.lstrip().startswith("#")]
-TEMPLATES = load_templates()
-MAX_PID   = len(TEMPLATES) - 1
+        for lineno, ln in enumerate(fh, 1):
+            if not ln.strip() or ln.lstrip().startswith("#"):
+                continue
+            try:
+                templates.append(compile_template(ln.rstrip("\n"), FIELDS))
+            except TemplateError as exc:
+                sys.exit(f"{path}:{lineno}: {exc}")
+    return templates
 
 # ------------ HF chat -----------------------------------------------------
 def load_tokenizer(model_id):
-    from transformers import AutoTokenizer
-    tok = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
+    tok = tokenizer_provider.load_tokenizer(model_id, trust_remote_code=True)
     if not hasattr(tok, "apply_chat_template"):
         sys.exit("tokenizer lacks chat template")
     return tok
@@ -53,6 +64,23 @@ def shuffle_choices(e):
     random.shuffle(e["choices"])
     e["answer"] = LABELS[e["choices"].index(right)]
 
+# placeholder -> builder; a template only computes the ones it uses
+FIELDS = {
+    "question":         lambda e: trim(e["question"]),
+    "letters":          lambda e: "\n".join(f"{l}: {trim(t)}" for l, t in zip(LABELS, e["choices"])),
+    "letters_bullets":  lambda e: bullets_labeled(e["choices"]),
+    "letters_dashes":   lambda e: "\n".join(f"– {l}: {trim(t)}" for l, t in zip(LABELS, e["choices"])),
+    "plain_bullets":    lambda e: bullets_labeled(e["choices"]),
+    "plain_commas":     lambda e: commas(e["choices"]),
+    "options":          lambda e: ", ".join(LABELS[: len(e["choices"])]),
+    "answer":           lambda e: e["answer"],
+    "answer_text":      answer_text,
+    "full_text_answer": answer_text,
+    "answer_combo":     lambda e: f"{e['answer']} – {answer_text(e)}",
+}
+TEMPLATES = load_templates()
+MAX_PID   = len(TEMPLATES) - 1
+
 # ------------ main --------------------------------------------------------
 def main():
     global OR_WORD
@@ -60,6 +88,7 @@ def main():
     pa.add_argument("--input_file", required=True)
     pa.add_argument("--output_file")
     pa.add_argument("--chat_template")
+    pa.add_argument("--emit_messages", action="store_true", help="store 'messages' instead of rendered 'text' (chat mode)")
     pa.add_argument("--prompt_id", type=int)
     pa.add_argument("--shuffle_alternatives", action="store_true")
     pa.add_argument("--english", action="store_true", help="use 'or' instead of 'eller'")
@@ -75,6 +104,7 @@ def main():
     if chat:
         tok = load_tokenizer(args.chat_template)
         sys_prompt = getattr(tok, "default_system_prompt", "You are a helpful assistant.")
+        renderer = ChatRenderer(tok, defer=args.emit_messages)
         args.prompt_id = None  # ignore prompt choice in chat mode
 
     outfh = open(args.output_file, "w", encoding="utf-8") if args.output_file else None
@@ -110,31 +140,17 @@ def main():
                 {"role": "user", "content": user_msg},
                 {"role": "assistant", "content": assistant},
             ]
-            text = tok.apply_chat_template(msgs, tokenize=False, add_generation_prompt=False)
-
             rec = outer.copy() if args.keep_keys else {}
             if args.backup_result: rec["old_result"] = outer.get("old_result")
-            rec.update({"id": f"{outer.get('id', f'id{produced}')}{suffix_chat}", "text": text})
+            rec["id"] = f"{outer.get('id', f'id{produced}')}{suffix_chat}"
+            set_chat_fields(rec, renderer.fields(msgs))
             json.dump(rec, wr); wr.write("\n")
             produced += 1
             continue
 
         # -------- plain mode --------
         pid = 0 if args.prompt_id is None else args.prompt_id
-        tpl = TEMPLATES[pid]
-        prompt = tpl.format(
-            question=trim(e["question"]),
-            letters="\n".join(f"{l}: {trim(t)}" for l, t in zip(LABELS, e["choices"])),
-            letters_bullets=bullets_labeled(e["choices"]),
-            letters_dashes="\n".join(f"– {l}: {trim(t)}" for l, t in zip(LABELS, e["choices"])),
-            plain_bullets=bullets_labeled(e["choices"]),
-            plain_commas=commas(e["choices"]),
-            options=", ".join(LABELS[: len(e["choices"])]),
-            answer=e["answer"],
-            answer_text=answer_text(e),
-            full_text_answer=answer_text(e),
-            answer_combo=f"{e['answer']} – {answer_text(e)}",
-        )
+        prompt = TEMPLATES[pid].render(LazyFields(e, FIELDS))
         rec = outer.copy() if args.keep_keys else {}
         if args.backup_result: rec["old_result"] = outer.get("old_result")
         rec.update({"id": f"{outer.get('id', f'id{produced}')}_prompt{pid}", "text": prompt})
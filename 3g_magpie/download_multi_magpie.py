@@ -2,14 +2,15 @@
 """
 magpie_to_chat.py
 =================
-Stream Magpie-Align/Magpie-Pro-MT-300K-v0.1 from HF and convert to
-instruction-chat JSONL (id + text) using a chat template.
+Download Magpie-Align/Magpie-Pro-MT-300K-v0.1 from HF and convert to
+instruction-chat JSONL (id + text) using a chat template. Rows are
+rendered in parallel (--num_workers) and written in dataset order.
 
 Usage:
   python magpie_to_chat.py \
       --output_file magpie_chat.jsonl \
       --chat_template meta-llama/Meta-Llama-3-8B-Instruct \
-      [--limit N]
+      [--limit N] [--num_workers 16]
 
 Fields:
   - input1, output1, input2, output2, …  define the turns.
@@ -17,19 +18,48 @@ Fields:
 """
 
 import argparse
-import json
+import os
 import re
 import sys
-from itertools import zip_longest
+from pathlib import Path
 
 from datasets import load_dataset
-from transformers import AutoTokenizer
-from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.parallel_render import DEFAULT_SHARD_SIZE, render_dataset
+from common.tokenizer_provider import load_tokenizer
 
 # Hard-coded HF dataset ID
 DATASET_ID = "Magpie-Align/Magpie-Pro-MT-300K-v0.1"
 
+# Set in main() before the workers fork
+system_prompt = "You are a helpful assistant."
+input_keys, output_keys = [], []
+
+
+def convert(row, idx, renderer):
+    # Build the chat turns
+    messages = [{"role": "system", "content": system_prompt}]
+    for inp, out in zip(input_keys, output_keys):
+        # skip if missing or empty
+        user_txt = row.get(inp)
+        bot_txt  = row.get(out)
+        if not user_txt or not bot_txt:
+            continue
+        messages.append({"role": "user",      "content": user_txt.strip()})
+        messages.append({"role": "assistant", "content": bot_txt.strip()})
+
+    if len(messages) < 3:
+        # no valid turns beyond system→user→assistant
+        return None
+
+    # Generate a stable ID (use existing uuid if present)
+    example_id = row.get("uuid") or f"magpie_{idx}"
+    return {"id": example_id, **renderer.fields(messages)}
+
+
 def main():
+    global system_prompt, input_keys, output_keys
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--output_file", required=True,
@@ -43,25 +73,32 @@ def main():
         "--limit", type=int, default=None,
         help="Optional cap on number of examples"
     )
+    parser.add_argument(
+        "--num_workers", type=int, default=os.cpu_count(),
+        help="Processes rendering chat templates (output order is unchanged)"
+    )
+    parser.add_argument(
+        "--shard_size", type=int, default=DEFAULT_SHARD_SIZE,
+        help="Dataset rows per worker job"
+    )
+    parser.add_argument(
+        "--emit_messages", action="store_true",
+        help="Store 'messages' (role/content) instead of the rendered 'text'"
+    )
     args = parser.parse_args()
 
     # Load tokenizer + verify chat template support
-    tok = AutoTokenizer.from_pretrained(args.chat_template, trust_remote_code=True)
+    tok = load_tokenizer(args.chat_template, trust_remote_code=True)
     if not hasattr(tok, "apply_chat_template"):
         sys.exit("Error: tokenizer lacks `apply_chat_template`; pick a chat/instruction model.")
     system_prompt = getattr(tok, "default_system_prompt", "You are a helpful assistant.")
 
-    # Stream the dataset
-    ds = load_dataset(DATASET_ID, split="train", streaming=True)
-    it = iter(ds)
-
-    # Peek first record to discover fields
-    try:
-        first = next(it)
-    except StopIteration:
+    # Load the dataset (memory-mapped Arrow, so it can be split into index ranges)
+    ds = load_dataset(DATASET_ID, split="train")
+    if len(ds) == 0:
         sys.exit("Dataset appears empty.")
     # Identify all input/output keys, sorted by their numeric suffix
-    all_keys = list(first.keys())
+    all_keys = ds.column_names
     input_keys = sorted([k for k in all_keys if re.match(r"^input\d+$", k)],
                         key=lambda x: int(x.replace("input", "")))
     output_keys = sorted([k for k in all_keys if re.match(r"^output\d+$", k)],
@@ -69,43 +106,18 @@ def main():
     if not input_keys or len(input_keys) != len(output_keys):
         sys.exit(f"Unexpected columns: inputs={input_keys}, outputs={output_keys}")
 
-    # Rewind streaming iterator by re-creating
-    ds = load_dataset(DATASET_ID, split="train", streaming=True)
-    writer = open(args.output_file, "w", encoding="utf-8")
     count = 0
+    with open(args.output_file, "w", encoding="utf-8") as writer:
+        for line in render_dataset(ds, convert, args.chat_template,
+                                   num_workers=args.num_workers,
+                                   shard_size=args.shard_size,
+                                   desc="Converting",
+                                   defer=args.emit_messages):
+            if args.limit and count >= args.limit:
+                break
+            writer.write(line + "\n")
+            count += 1
 
-    for row in tqdm(ds, desc="Converting", unit="ex"):
-        if args.limit and count >= args.limit:
-            break
-
-        # Build the chat turns
-        messages = [{"role": "system", "content": system_prompt}]
-        for inp, out in zip(input_keys, output_keys):
-            # skip if missing or empty
-            user_txt = row.get(inp)
-            bot_txt  = row.get(out)
-            if not user_txt or not bot_txt:
-                continue
-            messages.append({"role": "user",      "content": user_txt.strip()})
-            messages.append({"role": "assistant", "content": bot_txt.strip()})
-
-        if len(messages) < 3:
-            # no valid turns beyond system→user→assistant
-            continue
-
-        # Apply chat template
-        chat_text = tok.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=False
-        )
-        # Generate a stable ID (use existing uuid if present)
-        example_id = row.get("uuid") or f"magpie_{count}"
-        writer.write(json.dumps({"id": example_id, "text": chat_text},
-                                ensure_ascii=False) + "\n")
-        count += 1
-
-    writer.close()
     print(f"Finished. Wrote {count} examples to {args.output_file}", file=sys.stderr)
 
 
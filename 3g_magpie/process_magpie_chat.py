@@ -26,7 +26,10 @@ from collections import Counter
 from pathlib import Path
 
 from tqdm import tqdm
-from transformers import AutoTokenizer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer
+from common.tokenizer_provider import load_tokenizer
 
 LABEL_TO_ROLE = {"human": "user", "gpt": "assistant"}
 
@@ -51,12 +54,15 @@ def main() -> None:
                     help="HF-modell med innebygget chat-template")
     ap.add_argument("--english", action="store_true",
                     help="bruk conversations og prefiks id med en_")
+    ap.add_argument("--emit_messages", action="store_true",
+                    help="lagre «messages» (rolle/innhold) i stedet for rendret «text»")
     args = ap.parse_args()
 
-    tokenizer = AutoTokenizer.from_pretrained(
+    tokenizer = load_tokenizer(
         args.chat_template, trust_remote_code=True)
     if not hasattr(tokenizer, "apply_chat_template"):
         sys.exit("Valgt tokenizer mangler apply_chat_template (ikke chatmodell)")
+    renderer = ChatRenderer(tokenizer, defer=args.emit_messages)
 
     system_prompt = getattr(
         tokenizer, "default_system_prompt", "You are a helpful assistant.")
@@ -87,11 +93,9 @@ def main() -> None:
                          "content": m["value"].strip()}
                     )
 
-                prompt = tokenizer.apply_chat_template(
-                    chat, tokenize=False, add_generation_prompt=False)
 
                 out_id = id_prefix + obj.get("uuid", f"row{written}")
-                json.dump({"id": out_id, "text": prompt},
+                json.dump({"id": out_id, **renderer.fields(chat)},
                           fout, ensure_ascii=False)
                 fout.write("\n")
 
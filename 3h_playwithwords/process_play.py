@@ -2,7 +2,8 @@
 """
 replace_system_prompt.py
 ------------------------
-Bytter system-prompten i et chat-formatert JSONL (felt id + text).
+Bytter system-prompten i et chat-formatert JSONL (felt id + text, eller
+id + messages fra --emit_messages; da byttes system-meldingen direkte).
 
 Ny prompt-rekkefølge:
     1. --system_prompt  (hvis gitt)
@@ -13,24 +14,32 @@ Alle andre deler er uendret.
 """
 
 import argparse, json, sys
+from pathlib import Path
 from tqdm import tqdm
-from transformers import AutoTokenizer
 
-START_TAG = "<|start_header_id|>system<|end_header_id|>"
-EOT_TAG   = "<|eot_id|>"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import iter_llama3
+from common.tokenizer_provider import load_tokenizer
 
 
 def swap_prompt(text: str, new_prompt: str | None) -> str | None:
-    start = text.find(START_TAG)
-    if start == -1:
-        return None
-    start += len(START_TAG)
-    end = text.find(EOT_TAG, start)
-    if end == -1:
+    # første komplette system-blokk; innholdet står mellom "\n\n" og <|eot_id|>
+    span = next(((start, end) for role, start, end in iter_llama3(text) if role == "system"), None)
+    if span is None:
         return None
     if new_prompt is None:          # ingen endring
         return text
-    return text[:start] + "\n\n" + new_prompt.strip() + text[end:]
+    start, end = span
+    head = text[:start] if text.startswith("\n\n", start - 2) else text[:start] + "\n\n"
+    return head + new_prompt.strip() + text[end:]
+
+
+def swap_message(messages: list, new_prompt: str | None) -> list | None:
+    if not messages or messages[0].get("role") != "system":
+        return None
+    if new_prompt is None:
+        return messages
+    return [{**messages[0], "content": new_prompt.strip()}] + messages[1:]
 
 
 def main() -> None:
@@ -42,8 +51,8 @@ def main() -> None:
                     help="overstyr modellens default-prompt")
     args = ap.parse_args()
 
-    tok = AutoTokenizer.from_pretrained(args.chat_template,
-                                        trust_remote_code=True)
+    tok = load_tokenizer(args.chat_template,
+                         trust_remote_code=True)
 
     # henter standard-prompt fra tokenizeren
     default_prompt = getattr(tok, "default_system_prompt",
@@ -58,11 +67,15 @@ def main() -> None:
             bar.update(1); tot += 1
             try:
                 row = json.loads(line)
-                text2 = swap_prompt(row["text"], new_prompt)
-                if text2 is None:
-                    raise ValueError
-                json.dump({"id": row["id"], "text": text2},
-                          fout, ensure_ascii=False)
+                if "messages" in row:
+                    out = {"id": row["id"], "messages": swap_message(row["messages"], new_prompt)}
+                    if out["messages"] is None:
+                        raise ValueError
+                else:
+                    out = {"id": row["id"], "text": swap_prompt(row["text"], new_prompt)}
+                    if out["text"] is None:
+                        raise ValueError
+                json.dump(out, fout, ensure_ascii=False)
                 fout.write("\n"); ok += 1
             except Exception:
                 bad += 1
@@ -11,23 +11,46 @@ instruction-chat-format (id + text).
 * Første turn er en system-prompt hentet fra tokenizer.default_system_prompt
   (eller «You are a helpful assistant.» hvis modellen ikke har en).
 * Chat-prompten bygges med tokenizer.apply_chat_template().
+* Datasettet deles i indeksintervaller som rendres parallelt (--num_workers);
+  utfilen har samme rekkefølge og innhold uansett antall prosesser.
 
 Bruk:
 python tiny_codes_to_chat.py \
     --output_file tiny_codes_chat.jsonl \
-    --chat_template meta-llama/Meta-Llama-3-8B-Instruct
+    --chat_template meta-llama/Meta-Llama-3-8B-Instruct \
+    --num_workers 16
 """
 
 import argparse
-import json
+import os
 import sys
+from pathlib import Path
 
 from datasets import load_dataset
-from tqdm import tqdm
-from transformers import AutoTokenizer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.parallel_render import DEFAULT_SHARD_SIZE, render_dataset
+from common.tokenizer_provider import load_tokenizer
 
 LABELS = {"user": "prompt", "assistant": "response"}
 
+system_prompt = "You are a helpful assistant."  # set in main() before the workers fork
+
+
+def convert(row, idx, renderer):
+    try:
+        prompt = row["prompt"].strip()
+        response = row["response"].strip()
+    except KeyError:
+        return None  # hopp over ufullstendige rader
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt},
+        {"role": "assistant", "content": response},
+    ]
+    return {"id": f"tiny_codes_{idx}", **renderer.fields(messages)}
+
 
 def main() -> None:
     ap = argparse.ArgumentParser()
@@ -35,13 +58,20 @@ def main() -> None:
                     help="sti til JSONL-utfil")
     ap.add_argument("--chat_template", required=True,
                     help="HF-modell id med chat-template")
+    ap.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                    help="antall prosesser som rendrer chat-templates")
+    ap.add_argument("--shard_size", type=int, default=DEFAULT_SHARD_SIZE,
+                    help="rader per jobb")
+    ap.add_argument("--emit_messages", action="store_true",
+                    help="lagre «messages» (rolle/innhold) i stedet for rendret «text»")
     args = ap.parse_args()
 
     print("Laster tokenizer …")
-    tok = AutoTokenizer.from_pretrained(args.chat_template,
-                                        trust_remote_code=True)
+    tok = load_tokenizer(args.chat_template,
+                         trust_remote_code=True)
     if not hasattr(tok, "apply_chat_template"):
         sys.exit("Tokenizeren mangler apply_chat_template – velg chatmodell")
+    global system_prompt
     system_prompt = getattr(
         tok, "default_system_prompt", "You are a helpful assistant.")
 
@@ -49,27 +79,13 @@ def main() -> None:
     ds = load_dataset("nampdn-ai/tiny-codes", split="train")
     print("Antall eksempler:", len(ds))
 
-    with open(args.output_file, "w", encoding="utf-8") as fout, \
-            tqdm(total=len(ds), desc="Eksempler") as bar:
-        for idx, row in enumerate(ds):
-            bar.update(1)
-            try:
-                prompt = row["prompt"].strip()
-                response = row["response"].strip()
-            except KeyError as e:
-                continue  # hopp over ufullstendige rader
-
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
-                {"role": "assistant", "content": response},
-            ]
-            text = tok.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=False)
-
-            json.dump({"id": f"tiny_codes_{idx}", "text": text},
-                      fout, ensure_ascii=False)
-            fout.write("\n")
+    with open(args.output_file, "w", encoding="utf-8") as fout:
+        for line in render_dataset(ds, convert, args.chat_template,
+                                   num_workers=args.num_workers,
+                                   shard_size=args.shard_size,
+                                   desc="Eksempler",
+                                   defer=args.emit_messages):
+            fout.write(line + "\n")
 
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ import logging
 import re
 import sys
 import random
+from pathlib import Path
 from typing import List, Dict, Tuple, Any
 from collections import Counter
 
@@ -15,10 +16,12 @@ except ImportError:
     print("Please install tqdm: pip install tqdm")
     sys.exit(1)
 
-try:
-    from transformers import AutoTokenizer
-except ImportError:
-    AutoTokenizer = None
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer
+from common.record_rng import RecordRNG, add_rng_arguments, shard_lines, stage_rng
+from common.tokenizer_provider import load_tokenizer
+
+STAGE = "3k_extract_ja_nei"
 
 AUGMENTATION_PHRASES = [
     "Svar med ja eller nei, og ikke noe annet.",
@@ -130,7 +133,9 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--input_file", "-i", required=True)
     parser.add_argument("--output_file", "-o", required=True)
     parser.add_argument("--chat_template", help="HF-modell med innebygget chat-template")
+    parser.add_argument("--emit_messages", action="store_true", help="lagre «messages» (rolle/innhold) i stedet for rendret «text»")
     parser.add_argument("--debug", action="store_true")
+    add_rng_arguments(parser)
     return parser.parse_args()
 
 def extract_question_answer(text: str) -> Tuple[str, str]:
@@ -151,8 +156,9 @@ def process_record(
     record: Dict[str, Any],
     debug: bool = False,
     chat_template: str = None,
-    tokenizer=None,
-    system_prompt: str = None
+    renderer: ChatRenderer = None,
+    system_prompt: str = None,
+    rngs: RecordRNG = None
 ) -> Tuple[List[Dict[str, str]], List[str], int, str]:
     errors: List[str] = []
     outputs: List[Dict[str, str]] = []
@@ -176,28 +182,27 @@ def process_record(
     if not binary:
         return outputs, errors, 0, ""  # Not an error, just not relevant
 
-    augmentation = random.choice(AUGMENTATION_PHRASES)
+    rng = rngs(base_id) if rngs else random
+    augmentation = rng.choice(AUGMENTATION_PHRASES)
     full_question = f"{question} {augmentation}"
 
     # Use chat template if enabled
-    if chat_template and tokenizer:
+    if chat_template and renderer:
         msgs = [
             {"role": "system",    "content": system_prompt or "You are a helpful assistant."},
             {"role": "user",      "content": full_question},
             {"role": "assistant", "content": binary},
         ]
-        text_out = tokenizer.apply_chat_template(
-            msgs, tokenize=False, add_generation_prompt=False
-        )
+        chat_fields = renderer.fields(msgs)
     else:
-        text_out = f"{full_question}\n{binary}"
+        chat_fields = {"text": f"{full_question}\n{binary}"}
 
     outputs.append({
         "id": base_id,
         "question": question,
         "augmentation": augmentation,
         "answer": binary,
-        "text": text_out
+        **chat_fields
     })
     return outputs, errors, 1, ""
 
@@ -211,18 +216,19 @@ def main():
     args = parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(levelname)s: %(message)s")
 
+    rngs = stage_rng(args, STAGE)
+
     # Load tokenizer if chat_template is used
-    tokenizer = None
+    renderer = None
     system_prompt = None
     if args.chat_template:
-        if AutoTokenizer is None:
-            sys.exit("transformers må være installert for --chat_template")
-        tokenizer = AutoTokenizer.from_pretrained(
+        tokenizer = load_tokenizer(
             args.chat_template, trust_remote_code=True
         )
         if not hasattr(tokenizer, "apply_chat_template"):
             sys.exit("Tokenizer mangler apply_chat_template; velg chatmodell")
         system_prompt = getattr(tokenizer, "default_system_prompt", "You are a helpful assistant.")
+        renderer = ChatRenderer(tokenizer, defer=args.emit_messages)
 
     total_input = 0
     total_output = 0
@@ -230,11 +236,10 @@ def main():
     extraction_counts = Counter()
 
     try:
-        num_lines = count_lines(args.input_file)
-        with open(args.input_file, "r", encoding="utf-8") as infile, \
-             open(args.output_file, "w", encoding="utf-8") as outfile, \
+        num_lines = count_lines(args.input_file) if args.shard is None else None
+        with open(args.output_file, "w", encoding="utf-8") as outfile, \
              tqdm(total=num_lines, desc="Processing lines", unit="lines") as pbar:
-            for line_num, line in enumerate(infile, 1):
+            for line_num, line in enumerate(shard_lines(args.input_file, args.shard), 1):
                 total_input += 1
                 line = line.strip()
                 if not line:
@@ -254,8 +259,9 @@ def main():
                     record,
                     args.debug,
                     args.chat_template,
-                    tokenizer,
-                    system_prompt
+                    renderer,
+                    system_prompt,
+                    rngs,
                 )
                 extraction_counts[count] += 1
 
@@ -6,6 +6,7 @@ import logging
 import re
 import sys
 import random
+from pathlib import Path
 from typing import List, Dict, Tuple, Any
 from collections import Counter
 
@@ -15,10 +16,12 @@ except ImportError:
     print("Please install tqdm: pip install tqdm")
     sys.exit(1)
 
-try:
-    from transformers import AutoTokenizer
-except ImportError:
-    AutoTokenizer = None
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer
+from common.record_rng import RecordRNG, add_rng_arguments, shard_lines, stage_rng
+from common.tokenizer_provider import load_tokenizer
+
+STAGE = "3k_extract_n_samples"
 
 AUGMENTATION_TEMPLATES = [
     "Begrens svaret til maksimalt {n} ord.",
@@ -132,7 +135,9 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--min_words", type=int, default=2)
     parser.add_argument("--max_words", type=int, default=6)
     parser.add_argument("--chat_template", help="HF-modell med innebygget chat-template")
+    parser.add_argument("--emit_messages", action="store_true", help="lagre «messages» (rolle/innhold) i stedet for rendret «text»")
     parser.add_argument("--debug", action="store_true")
+    add_rng_arguments(parser)
     return parser.parse_args()
 
 def extract_question_answer(text: str) -> Tuple[str, str]:
@@ -150,8 +155,9 @@ def process_record(
     max_words: int,
     debug: bool = False,
     chat_template: str = None,
-    tokenizer=None,
-    system_prompt: str = None
+    renderer: ChatRenderer = None,
+    system_prompt: str = None,
+    rngs: RecordRNG = None
 ) -> Tuple[List[Dict[str, str]], List[str], int, str, int]:
     errors: List[str] = []
     outputs: List[Dict[str, str]] = []
@@ -178,28 +184,27 @@ def process_record(
     if not (min_words <= num_words <= max_words):
         return outputs, errors, 0, "", num_words
 
-    augmentation = random.choice(AUGMENTATION_TEMPLATES).format(n=num_words)
+    rng = rngs(base_id) if rngs else random
+    augmentation = rng.choice(AUGMENTATION_TEMPLATES).format(n=num_words)
     full_question = f"{question} {augmentation}"
 
     # Use chat template if enabled
-    if chat_template and tokenizer:
+    if chat_template and renderer:
         msgs = [
             {"role": "system",    "content": system_prompt or "You are a helpful assistant."},
             {"role": "user",      "content": full_question},
             {"role": "assistant", "content": answer},
         ]
-        text_out = tokenizer.apply_chat_template(
-            msgs, tokenize=False, add_generation_prompt=False
-        )
+        chat_fields = renderer.fields(msgs)
     else:
-        text_out = f"{full_question}\n{answer}"
+        chat_fields = {"text": f"{full_question}\n{answer}"}
 
     outputs.append({
         "id": base_id,
         "question": question,
         "augmentation": augmentation,
         "answer": answer,
-        "text": text_out
+        **chat_fields
     })
     return outputs, errors, 1, "", num_words
 
@@ -213,18 +218,19 @@ def main():
     args = parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(levelname)s: %(message)s")
 
+    rngs = stage_rng(args, STAGE)
+
     # Load tokenizer if chat_template is used
-    tokenizer = None
+    renderer = None
     system_prompt = None
     if args.chat_template:
-        if AutoTokenizer is None:
-            sys.exit("transformers må være installert for --chat_template")
-        tokenizer = AutoTokenizer.from_pretrained(
+        tokenizer = load_tokenizer(
             args.chat_template, trust_remote_code=True
         )
         if not hasattr(tokenizer, "apply_chat_template"):
             sys.exit("Tokenizer mangler apply_chat_template; velg chatmodell")
         system_prompt = getattr(tokenizer, "default_system_prompt", "You are a helpful assistant.")
+        renderer = ChatRenderer(tokenizer, defer=args.emit_messages)
 
     total_input = 0
     total_output = 0
@@ -233,11 +239,10 @@ def main():
     word_stats = Counter()
 
     try:
-        num_lines = count_lines(args.input_file)
-        with open(args.input_file, "r", encoding="utf-8") as infile, \
-             open(args.output_file, "w", encoding="utf-8") as outfile, \
+        num_lines = count_lines(args.input_file) if args.shard is None else None
+        with open(args.output_file, "w", encoding="utf-8") as outfile, \
              tqdm(total=num_lines, desc="Processing lines", unit="lines") as pbar:
-            for line_num, line in enumerate(infile, 1):
+            for line_num, line in enumerate(shard_lines(args.input_file, args.shard), 1):
                 total_input += 1
                 line = line.strip()
                 if not line:
@@ -259,8 +264,9 @@ def main():
                     args.max_words,
                     args.debug,
                     args.chat_template,
-                    tokenizer,
+                    renderer,
                     system_prompt,
+                    rngs,
                 )
                 extraction_counts[count] += 1
 
@@ -30,9 +30,13 @@ import argparse
 import json
 import re
 import sys
+from pathlib import Path
 
 from tqdm import tqdm
-from transformers import AutoTokenizer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer
+from common.tokenizer_provider import load_tokenizer
 
 START_FENCE = re.compile(r"```json\s*(.*?)\s*```", re.DOTALL)
 
@@ -51,18 +55,21 @@ def main():
                    help="Output JSONL med id+text")
     p.add_argument("--chat_template",
                    help="HF-modell med innebygget chat-template")
+    p.add_argument("--emit_messages", action="store_true",
+                   help="lagre «messages» (rolle/innhold) i stedet for rendret «text»")
     args = p.parse_args()
 
     # Chat-modus?
     use_chat = bool(args.chat_template)
     if use_chat:
-        tok = AutoTokenizer.from_pretrained(
+        tok = load_tokenizer(
             args.chat_template, trust_remote_code=True
         )
         if not hasattr(tok, "apply_chat_template"):
             sys.exit("Tokenizer mangler apply_chat_template; velg chatmodell")
         system_prompt = getattr(tok, "default_system_prompt",
                                 "You are a helpful assistant.")
+        renderer = ChatRenderer(tok, defer=args.emit_messages)
 
     total = kept = dropped = 0
 
@@ -94,13 +101,9 @@ def main():
                         {"role": "user",      "content": q},
                         {"role": "assistant", "content": a},
                     ]
-                    text = tok.apply_chat_template(
-                        msgs, tokenize=False, add_generation_prompt=False
-                    )
+                    out = {"id": rec["id"], **renderer.fields(msgs)}
                 else:
-                    text = f"{q}\n{a}"
-
-                out = {"id": rec["id"], "text": text}
+                    out = {"id": rec["id"], "text": f"{q}\n{a}"}
                 fout.write(json.dumps(out, ensure_ascii=False) + "\n")
                 kept += 1
 
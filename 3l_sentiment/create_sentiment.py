@@ -3,13 +3,17 @@
 import argparse
 import json
 import random
+import sys
+from pathlib import Path
 from datasets import load_dataset
 from tqdm import tqdm
 
-try:
-    from transformers import AutoTokenizer
-except ImportError:
-    AutoTokenizer = None
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer
+from common.record_rng import RecordRNG, add_rng_arguments, shard_range, stage_rng
+from common.tokenizer_provider import load_tokenizer
+
+STAGE = "3l_sentiment"
 
 NB_PROMPTS = [
     "Her følger dokumenter og deres sentiment, som kan være {labels_str}.",
@@ -74,24 +78,26 @@ INSTRUCTION_TEMPLATE = {
     "no": "Dokument: {text}\n\nKlassifiser følelsen i teksten. Svar med {labels_str}, og ikke noe annet.",
 }
 
-def process_dataset(output_file, use_chat_template, chat_template_model):
+def process_dataset(output_file, use_chat_template, chat_template_model, emit_messages=False,
+                    rngs: RecordRNG = None, shard=None):
     dataset = load_dataset('EleutherAI/twitter-sentiment', split='train')
 
     tokenizer = None
     if use_chat_template:
-        if AutoTokenizer is None:
-            raise ImportError("transformers not installed. Required for --chat_template.")
-        tokenizer = AutoTokenizer.from_pretrained(chat_template_model, trust_remote_code=True)
+        tokenizer = load_tokenizer(chat_template_model, trust_remote_code=True)
         if not hasattr(tokenizer, "apply_chat_template"):
             raise ValueError(f"Model '{chat_template_model}' does not support apply_chat_template.")
+        renderer = ChatRenderer(tokenizer, defer=emit_messages)
 
     with open(output_file, 'w', encoding='utf-8') as f:
-        pbar = tqdm(total=len(dataset), desc="Processing dataset")
-        for idx in range(len(dataset)):
-            language = "no" if random.random() < 0.5 else "en"
+        rows = shard_range(len(dataset), shard)
+        pbar = tqdm(total=len(rows), desc="Processing dataset")
+        for idx in rows:
+            rng = rngs(idx) if rngs else random  # keyed on the dataset row
+            language = "no" if rng.random() < 0.5 else "en"
             prompt_list = NB_PROMPTS if language == "no" else EN_PROMPTS
             labels_str = LABELS_STR[language]
-            prompt_prefix = random.choice(prompt_list).format(labels_str=labels_str)
+            prompt_prefix = rng.choice(prompt_list).format(labels_str=labels_str)
             prompt_template = PROMPT_TEMPLATE[language]
             text = dataset[idx]['text']
             label = LABEL_MAPS[language][dataset[idx]['label']]
@@ -102,13 +108,10 @@ def process_dataset(output_file, use_chat_template, chat_template_model):
                     {"role": "user", "content": INSTRUCTION_TEMPLATE[language].format(text=text, labels_str=labels_str)},
                     {"role": "assistant", "content": label}
                 ]
-                formatted = tokenizer.apply_chat_template(
-                    [chat_message], tokenize=False, add_generation_prompt=False
-                )[0]
                 record = {
                     "source": "EleutherAI/twitter-sentiment",
                     "language": language,
-                    "text": formatted,
+                    **renderer.fields(chat_message),
                     "prompt": prompt_prefix
                 }
             else:
@@ -126,9 +129,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process EleutherAI Twitter Sentiment dataset (bilingual, prompt augmentation, one sample per record).')
     parser.add_argument('--output_file', type=str, required=True, help='Path to the output JSONLines file')
     parser.add_argument('--chat_template', type=str, default=None, help='HF model for chat template formatting (optional).')
+    parser.add_argument('--emit_messages', action='store_true', help='Store "messages" (role/content) instead of the rendered "text" (chat mode).')
+    add_rng_arguments(parser)
     args = parser.parse_args()
     process_dataset(
         args.output_file,
         use_chat_template=bool(args.chat_template),
-        chat_template_model=args.chat_template
+        chat_template_model=args.chat_template,
+        emit_messages=args.emit_messages,
+        rngs=stage_rng(args, STAGE),
+        shard=args.shard
     )
@@ -3,12 +3,16 @@
 import argparse
 import json
 import random
+import sys
+from pathlib import Path
 from tqdm import tqdm
 
-try:
-    from transformers import AutoTokenizer
-except ImportError:
-    AutoTokenizer = None
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer
+from common.record_rng import RecordRNG, add_rng_arguments, shard_lines, stage_rng
+from common.tokenizer_provider import load_tokenizer
+
+STAGE = "3o_acceptability"
 
 # 20 Norwegian prompt templates, all specifying the options ja, nei
 NB_PROMPTS = [
@@ -40,59 +44,58 @@ INSTRUCTION_TEMPLATE = (
     "Setning: {text}\n\nBestem om setningen er grammatisk korrekt eller ikke. Svar med {labels_str}, og ikke noe annet."
 )
 
-def swap_words(sentence):
+def swap_words(sentence, rng=random):
     """Swap 2-4 random words (not first) in the sentence."""
     words = sentence.strip().split()
     if len(words) < 4:
         # Can't meaningfully swap, return as is
         return sentence
-    num_to_swap = random.randint(2, min(4, len(words)-1))
+    num_to_swap = rng.randint(2, min(4, len(words)-1))
     idxs = list(range(1, len(words)))  # Never swap the first word
-    swap_idxs = random.sample(idxs, num_to_swap)
+    swap_idxs = rng.sample(idxs, num_to_swap)
     swapped_words = words[:]
     swap_order = swap_idxs[:]
-    random.shuffle(swap_order)
+    rng.shuffle(swap_order)
     for i, j in zip(swap_idxs, swap_order):
         swapped_words[i], swapped_words[j] = swapped_words[j], swapped_words[i]
     return " ".join(swapped_words)
 
-def process_file(input_file, output_file, use_chat_template, chat_template_model):
+def process_file(input_file, output_file, use_chat_template, chat_template_model, emit_messages=False,
+                 rngs: RecordRNG = None, shard=None):
     if use_chat_template:
-        if AutoTokenizer is None:
-            raise ImportError("transformers not installed. Required for --chat_template.")
-        tokenizer = AutoTokenizer.from_pretrained(chat_template_model, trust_remote_code=True)
+        tokenizer = load_tokenizer(chat_template_model, trust_remote_code=True)
         if not hasattr(tokenizer, "apply_chat_template"):
             raise ValueError(f"Model '{chat_template_model}' does not support apply_chat_template.")
+        renderer = ChatRenderer(tokenizer, defer=emit_messages)
 
-    with open(input_file, encoding="utf-8") as fin, open(output_file, "w", encoding="utf-8") as fout:
-        lines = [json.loads(l) for l in fin if l.strip()]
+    with open(output_file, "w", encoding="utf-8") as fout:
+        lines = [json.loads(l) for l in shard_lines(input_file, shard) if l.strip()]
         pbar = tqdm(total=len(lines), desc="Processing sentences")
-        for i, rec in enumerate(lines):
+        for rec in lines:
             orig_text = rec["text"].strip()
             if not orig_text:
                 pbar.update(1)
                 continue
-            # Randomly choose correct or incorrect for each line (or alternate)
-            make_incorrect = (i % 2 == 1)
+            rng = rngs(rec.get("id") or orig_text) if rngs else random
+            # Randomly choose correct or incorrect for each line (a coin per record, not
+            # alternation by position, so a line's label does not depend on the shard)
+            make_incorrect = rng.random() < 0.5
             if make_incorrect:
-                sent = swap_words(orig_text)
+                sent = swap_words(orig_text, rng)
                 label = "nei"
             else:
                 sent = orig_text
                 label = "ja"
-            prompt_prefix = random.choice(NB_PROMPTS).format(labels_str=LABELS_STR)
+            prompt_prefix = rng.choice(NB_PROMPTS).format(labels_str=LABELS_STR)
             if use_chat_template:
                 chat_message = [
                     {"role": "system", "content": prompt_prefix},
                     {"role": "user", "content": INSTRUCTION_TEMPLATE.format(text=sent, labels_str=LABELS_STR)},
                     {"role": "assistant", "content": label}
                 ]
-                formatted = tokenizer.apply_chat_template(
-                    [chat_message], tokenize=False, add_generation_prompt=False
-                )[0]
                 record = {
                     "language": "no",
-                    "text": formatted,
+                    **renderer.fields(chat_message),
                     "prompt": prompt_prefix,
                     "label": label,
                 }
@@ -112,10 +115,15 @@ if __name__ == "__main__":
     parser.add_argument('--input_file', type=str, required=True, help='Input JSONL file (field: "text")')
     parser.add_argument('--output_file', type=str, required=True, help='Path to output JSONL')
     parser.add_argument('--chat_template', type=str, default=None, help='HF model for chat template formatting (optional)')
+    parser.add_argument('--emit_messages', action='store_true', help='Store "messages" (role/content) instead of the rendered "text" (chat mode)')
+    add_rng_arguments(parser)
     args = parser.parse_args()
     process_file(
         args.input_file,
         args.output_file,
         use_chat_template=bool(args.chat_template),
-        chat_template_model=args.chat_template
+        chat_template_model=args.chat_template,
+        emit_messages=args.emit_messages,
+        rngs=stage_rng(args, STAGE),
+        shard=args.shard
     )
@@ -6,13 +6,16 @@ import json
 import logging
 import sys
 import random
+from pathlib import Path
 from typing import Dict, Any, List
 from tqdm import tqdm
 
-try:
-    from transformers import AutoTokenizer
-except ImportError:
-    AutoTokenizer = None
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer, set_chat_fields
+from common.record_rng import add_rng_arguments, shard_lines, stage_rng
+from common.tokenizer_provider import load_tokenizer
+
+STAGE = "3y_bokmal_nynorsk"
 
 NB_LABELS = ["Bokmål:", "Norwegian Bokmål:", "Norsk bokmål:", "NB:"]
 NN_LABELS = ["Nynorsk:", "Norwegian Nynorsk:", "NN:"]
@@ -148,16 +151,16 @@ def count_lines(filename: str) -> int:
     with open(filename, "r", encoding="utf-8") as f:
         return sum(1 for _ in f)
 
-def create_chat_messages(record: Dict[str, Any], swap: bool, system_prompt_str: str):
+def create_chat_messages(record: Dict[str, Any], swap: bool, system_prompt_str: str, rng=random):
     nb, nn = record.get("nb", ""), record.get("nn", "")
     if not nb or not nn:
         return None, None
     if not swap:
-        augmentation = random.choice(NB_TO_NN_PROMPTS)
+        augmentation = rng.choice(NB_TO_NN_PROMPTS)
         user_content = f"{augmentation}\n{nb}"
         assistant_content = nn
     else:
-        augmentation = random.choice(NN_TO_NB_PROMPTS)
+        augmentation = rng.choice(NN_TO_NB_PROMPTS)
         user_content = f"{augmentation}\n{nn}"
         assistant_content = nb
     return [
@@ -166,11 +169,11 @@ def create_chat_messages(record: Dict[str, Any], swap: bool, system_prompt_str:
         {"role": "assistant", "content": assistant_content}
     ], augmentation
 
-def process_record_standard(record: Dict[str, Any], swap: bool) -> Dict[str, Any]:
+def process_record_standard(record: Dict[str, Any], swap: bool, rng=random) -> Dict[str, Any]:
     nb, nn = record.get("nb", ""), record.get("nn", "")
     if not nb or not nn: return None
     out = dict(record)
-    nb_label, nn_label = random.choice(NB_LABELS), random.choice(NN_LABELS)
+    nb_label, nn_label = rng.choice(NB_LABELS), rng.choice(NN_LABELS)
     out["text"] = f"{nb_label} {nb}\n{nn_label} {nn}" if not swap else f"{nn_label} {nn}\n{nb_label} {nb}"
     return out
 
@@ -183,23 +186,24 @@ def main():
     parser.add_argument("--chat_template", help="HF model identifier with a built-in chat template.")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
     parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Batch size for chat template processing (default: {DEFAULT_BATCH_SIZE}).")
+    parser.add_argument("--emit_messages", action="store_true", help='Store the conversation as "messages" (role/content) instead of rendering "text"; it is rendered at export (7c_retargeted/transcode_chat.py).')
     parser.add_argument("--no_count_lines", action="store_true", help="Skip initial line count for faster startup.")
 
+    add_rng_arguments(parser)
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(levelname)s: %(message)s")
+    rngs = stage_rng(args, STAGE)
 
     tokenizer = None
     system_prompt_for_chat = "Du er ein hjelpsam språkassistent."
     process_as_chat = False
 
     if args.chat_template:
-        if AutoTokenizer is None:
-            logging.error("transformers not installed, cannot use --chat_template")
-            sys.exit(1)
         try:
-            tokenizer = AutoTokenizer.from_pretrained(args.chat_template, trust_remote_code=True)
+            tokenizer = load_tokenizer(args.chat_template, trust_remote_code=True)
             if hasattr(tokenizer, "apply_chat_template") and callable(tokenizer.apply_chat_template):
                 process_as_chat = True
+                renderer = ChatRenderer(tokenizer, defer=args.emit_messages)
                 if "Llama-3" in args.chat_template:
                     system_prompt_for_chat = "You are a helpful AI assistant."
         except Exception as e:
@@ -210,14 +214,13 @@ def main():
     error_list = []
 
     num_lines = 0
-    if not args.no_count_lines:
+    if not args.no_count_lines and args.shard is None:
         try:
             num_lines = count_lines(args.input_file)
         except Exception:
             pass
 
-    with open(args.input_file, "r", encoding="utf-8") as infile, \
-         open(args.output_file, "w", encoding="utf-8") as outfile, \
+    with open(args.output_file, "w", encoding="utf-8") as outfile, \
          tqdm(desc="Processing lines", unit="lines", total=(num_lines or None)) as pbar:
 
         record_batch_originals = []
@@ -225,7 +228,7 @@ def main():
         augmentation_batch_info = []
         output_lines_buffer = []
 
-        for line_num, line in enumerate(infile, 1):
+        for line_num, line in enumerate(shard_lines(args.input_file, args.shard), 1):
             total_input += 1
             line = line.strip()
             if not line:
@@ -238,22 +241,21 @@ def main():
                 pbar.update(1)
                 continue
 
-            swap = bool(random.getrandbits(1))
+            rng = rngs(record.get("id") or record.get("nb"))  # keyed on the record, not its position
+            swap = bool(rng.getrandbits(1))
             if process_as_chat:
-                messages, augmentation = create_chat_messages(record, swap, system_prompt_for_chat)
+                messages, augmentation = create_chat_messages(record, swap, system_prompt_for_chat, rng)
                 if messages:
                     record_batch_originals.append(dict(record))
                     messages_batch_for_template.append(messages)
                     augmentation_batch_info.append(augmentation)
                 if len(messages_batch_for_template) >= args.batch_size:
                     try:
-                        formatted_texts = tokenizer.apply_chat_template(
-                            messages_batch_for_template, tokenize=False, add_generation_prompt=False
-                        )
+                        formatted_fields = renderer.fields_batch(messages_batch_for_template)
                         for i, original_rec in enumerate(record_batch_originals):
                             out_record = original_rec
                             out_record["augmentation"] = augmentation_batch_info[i]
-                            out_record["text"] = formatted_texts[i]
+                            set_chat_fields(out_record, formatted_fields[i])
                             output_lines_buffer.append(json.dumps(out_record, ensure_ascii=False))
                             total_output += 1
                         outfile.write("\n".join(output_lines_buffer) + "\n")
@@ -267,7 +269,7 @@ def main():
                         augmentation_batch_info.clear()
                         output_lines_buffer.clear()
             else:
-                out_record = process_record_standard(record, swap)
+                out_record = process_record_standard(record, swap, rng)
                 if out_record:
                     outfile.write(json.dumps(out_record, ensure_ascii=False) + "\n")
                     total_output += 1
@@ -276,13 +278,11 @@ def main():
         # Final batch processing for chat mode
         if process_as_chat and messages_batch_for_template:
             try:
-                formatted_texts = tokenizer.apply_chat_template(
-                    messages_batch_for_template, tokenize=False, add_generation_prompt=False
-                )
+                formatted_fields = renderer.fields_batch(messages_batch_for_template)
                 for i, original_rec in enumerate(record_batch_originals):
                     out_record = original_rec
                     out_record["augmentation"] = augmentation_batch_info[i]
-                    out_record["text"] = formatted_texts[i]
+                    set_chat_fields(out_record, formatted_fields[i])
                     output_lines_buffer.append(json.dumps(out_record, ensure_ascii=False))
                     total_output += 1
                 if output_lines_buffer:
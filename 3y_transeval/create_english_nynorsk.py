@@ -5,6 +5,7 @@ import argparse
 import logging
 import sys
 import random
+from pathlib import Path
 from typing import Dict, Any, List
 
 # Using orjson if available
@@ -23,10 +24,12 @@ try:
     from tqdm import tqdm
 except ImportError:
     print("Please install tqdm: pip install tqdm"); sys.exit(1)
-try:
-    from transformers import AutoTokenizer
-except ImportError:
-    AutoTokenizer = None # Will be checked later
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer, set_chat_fields
+from common.record_rng import add_rng_arguments, shard_lines, stage_rng
+from common.tokenizer_provider import load_tokenizer
+
+STAGE = "3y_english_nynorsk"
 
 NN_LABELS = ["Nynorsk:"]
 EN_LABELS = ["English:", "Engelsk:"]
@@ -165,16 +168,16 @@ def count_lines(filename: str) -> int:
         with open(filename, "r", encoding="utf-8") as f: return sum(1 for _ in f)
     except FileNotFoundError: return 0
 
-def create_chat_messages(record: Dict[str, Any], swap: bool, system_prompt_str: str) -> (List[Dict[str, str]], str):
+def create_chat_messages(record: Dict[str, Any], swap: bool, system_prompt_str: str, rng=random) -> (List[Dict[str, str]], str):
     source, target = record.get("source", ""), record.get("target", "")
     if not source or not target: return None, None
     augmentation_choice = None
     if not swap:
-        augmentation_choice = random.choice(EN_PROMPTS_TO_NN)
+        augmentation_choice = rng.choice(EN_PROMPTS_TO_NN)
         user_content = f"{augmentation_choice}\n{source}"
         assistant_content = target
     else:
-        augmentation_choice = random.choice(NN_PROMPTS_TO_EN)
+        augmentation_choice = rng.choice(NN_PROMPTS_TO_EN)
         user_content = f"{augmentation_choice}\n{target}"
         assistant_content = source
     return [
@@ -183,11 +186,11 @@ def create_chat_messages(record: Dict[str, Any], swap: bool, system_prompt_str:
         {"role": "assistant", "content": assistant_content}
     ], augmentation_choice
 
-def process_record_standard(record: Dict[str, Any], swap: bool) -> Dict[str, Any]:
+def process_record_standard(record: Dict[str, Any], swap: bool, rng=random) -> Dict[str, Any]:
     source, target = record.get("source", ""), record.get("target", "")
     if not source or not target: return None
     out = dict(record)
-    en_label, nn_label = random.choice(EN_LABELS), random.choice(NN_LABELS)
+    en_label, nn_label = rng.choice(EN_LABELS), rng.choice(NN_LABELS)
     out["text"] = f"{en_label} {source}\n{nn_label} {target}" if not swap else f"{nn_label} {target}\n{en_label} {source}"
     return out
 
@@ -200,10 +203,13 @@ def main():
     parser.add_argument("--chat_template", help="HF model identifier with a built-in chat template.")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
     parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Batch size for chat template processing (default: {DEFAULT_BATCH_SIZE}).")
+    parser.add_argument("--emit_messages", action="store_true", help='Store the conversation as "messages" (role/content) instead of rendering "text"; it is rendered at export (7c_retargeted/transcode_chat.py).')
     parser.add_argument("--no_count_lines", action="store_true", help="Skip initial line count for faster startup.")
 
+    add_rng_arguments(parser)
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(levelname)s: %(message)s")
+    rngs = stage_rng(args, STAGE)
     logging.info(f"Using {JSON_LIB_USED} for JSON operations.")
 
     tokenizer = None 
@@ -211,17 +217,15 @@ def main():
     process_as_chat = False
 
     if args.chat_template:
-        if AutoTokenizer is None:
-            logging.error("The 'transformers' library must be installed for --chat_template. Run: pip install transformers")
-            sys.exit(1)
         try:
             logging.info(f"Loading tokenizer for: {args.chat_template}")
-            tokenizer = AutoTokenizer.from_pretrained(args.chat_template, trust_remote_code=True)
+            tokenizer = load_tokenizer(args.chat_template, trust_remote_code=True)
             logging.info(f"Tokenizer {args.chat_template} loaded successfully.")
             if not hasattr(tokenizer, "apply_chat_template") or not callable(tokenizer.apply_chat_template):
                 logging.error(f"Tokenizer for '{args.chat_template}' lacks a callable 'apply_chat_template' method. Cannot proceed in chat mode.")
             else:
                 process_as_chat = True
+                renderer = ChatRenderer(tokenizer, defer=args.emit_messages)
                 if "Llama-3" in args.chat_template:
                     system_prompt_for_chat = "You are a helpful AI assistant."
                 logging.info(f"CHAT MODE ACTIVE. Using chat template from '{args.chat_template}' with system prompt: \"{system_prompt_for_chat}\", Batch size: {args.batch_size}")
@@ -238,7 +242,7 @@ def main():
 
     try:
         num_lines = 0
-        if not args.no_count_lines:
+        if not args.no_count_lines and args.shard is None:
             logging.info(f"Counting lines in '{args.input_file}'...")
             num_lines = count_lines(args.input_file)
             if num_lines == 0 and args.input_file:
@@ -249,8 +253,7 @@ def main():
             logging.info(f"Found {num_lines} lines in '{args.input_file}'.")
         else: logging.info("Skipping initial line count.")
 
-        with open(args.input_file, "r", encoding="utf-8") as infile, \
-             open(args.output_file, "w", encoding="utf-8") as outfile:
+        with open(args.output_file, "w", encoding="utf-8") as outfile:
             pbar_params = {"desc": "Processing lines", "unit": "lines"}
             if num_lines > 0: pbar_params["total"] = num_lines
             pbar = tqdm(**pbar_params)
@@ -260,28 +263,29 @@ def main():
             augmentation_batch_info = [] 
             output_lines_buffer = []
 
-            for line_num, line in enumerate(infile, 1):
+            for line_num, line in enumerate(shard_lines(args.input_file, args.shard), 1):
                 total_input += 1
                 line = line.strip()
                 if not line: pbar.update(1); continue
                 try: record = json_loads(line)
                 except Exception as e: error_list.append((line_num, f"JSON load: {e}. L: '{line[:100]}...'")); pbar.update(1); continue
                 
-                swap = bool(random.getrandbits(1))
+                rng = rngs(record.get("id") or record.get("source"))  # keyed on the record, not its position
+                swap = bool(rng.getrandbits(1))
 
                 if process_as_chat:
-                    messages, augmentation = create_chat_messages(record, swap, system_prompt_for_chat) 
+                    messages, augmentation = create_chat_messages(record, swap, system_prompt_for_chat, rng) 
                     if messages:
                         record_batch_originals.append(dict(record)) 
                         messages_batch_for_template.append(messages)
                         augmentation_batch_info.append(augmentation)
                     if len(messages_batch_for_template) >= args.batch_size:
                         try:
-                            formatted_texts = tokenizer.apply_chat_template(messages_batch_for_template, tokenize=False, add_generation_prompt=False)
+                            formatted_fields = renderer.fields_batch(messages_batch_for_template)
                             for i, original_rec in enumerate(record_batch_originals):
                                 out_record = original_rec
                                 out_record["augmentation"] = augmentation_batch_info[i]
-                                out_record["text"] = formatted_texts[i]
+                                set_chat_fields(out_record, formatted_fields[i])
                                 output_lines_buffer.append(json_dumps(out_record)) 
                                 total_output += 1
                             outfile.write("\n".join(output_lines_buffer) + "\n")
@@ -294,7 +298,7 @@ def main():
                             augmentation_batch_info.clear()
                             output_lines_buffer.clear()
                 else:
-                    out_record = process_record_standard(record, swap)
+                    out_record = process_record_standard(record, swap, rng)
                     if out_record: 
                         outfile.write(json_dumps(out_record) + "\n")
                         total_output += 1
@@ -304,11 +308,11 @@ def main():
             if process_as_chat and messages_batch_for_template:
                 logging.info(f"Processing final batch of {len(messages_batch_for_template)} items...")
                 try:
-                    formatted_texts = tokenizer.apply_chat_template(messages_batch_for_template, tokenize=False, add_generation_prompt=False)
+                    formatted_fields = renderer.fields_batch(messages_batch_for_template)
                     for i, original_rec in enumerate(record_batch_originals):
                         out_record = original_rec
                         out_record["augmentation"] = augmentation_batch_info[i]
-                        out_record["text"] = formatted_texts[i]
+                        set_chat_fields(out_record, formatted_fields[i])
                         output_lines_buffer.append(json_dumps(out_record)); total_output += 1
                     if output_lines_buffer: outfile.write("\n".join(output_lines_buffer) + "\n")
                 except Exception as e:
@@ -323,7 +327,7 @@ def main():
     except IOError as e: logging.error(f"File I/O error: {e}"); sys.exit(1)
     except Exception as e: logging.error(f"Unexpected error: {e}", exc_info=args.debug); sys.exit(1)
     finally:
-        if pbar: pbar.close()
+        if pbar is not None: pbar.close()
 
     print(f"\n--- Processing Summary ---")
     print(f"Total input lines read: {total_input}")
@@ -6,6 +6,7 @@ import json
 import logging
 import sys
 import random
+from pathlib import Path
 from typing import Dict, Any, List
 
 # Using orjson if available
@@ -24,10 +25,9 @@ try:
     from tqdm import tqdm
 except ImportError:
     print("Please install tqdm: pip install tqdm"); sys.exit(1)
-try:
-    from transformers import AutoTokenizer
-except ImportError:
-    AutoTokenizer = None # Will be checked later
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer, set_chat_fields
+from common.tokenizer_provider import load_tokenizer
 
 NB_LABELS = ["Norwegian:", "Norwegian Bokmål:", "Norsk:", "Norsk bokmål:"]
 EN_LABELS = ["English:", "Engelsk:"]
@@ -82,6 +82,7 @@ def main():
     parser.add_argument("--chat_template", help="HF model identifier with a built-in chat template.")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
     parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Batch size for chat template processing (default: {DEFAULT_BATCH_SIZE}).")
+    parser.add_argument("--emit_messages", action="store_true", help='Store the conversation as "messages" (role/content) instead of rendering "text"; it is rendered at export (7c_retargeted/transcode_chat.py).')
     parser.add_argument("--no_count_lines", action="store_true", help="Skip initial line count for faster startup.")
 
     args = parser.parse_args()
@@ -93,12 +94,9 @@ def main():
     process_as_chat = False # Flag to determine if we are in chat processing mode
 
     if args.chat_template:
-        if AutoTokenizer is None:
-            logging.error("The 'transformers' library must be installed for --chat_template. Run: pip install transformers")
-            sys.exit(1)
         try:
             logging.info(f"Loading tokenizer for: {args.chat_template}")
-            tokenizer = AutoTokenizer.from_pretrained(args.chat_template, trust_remote_code=True)
+            tokenizer = load_tokenizer(args.chat_template, trust_remote_code=True)
             logging.info(f"Tokenizer {args.chat_template} loaded successfully.")
             
             if not hasattr(tokenizer, "apply_chat_template") or not callable(tokenizer.apply_chat_template):
@@ -106,6 +104,7 @@ def main():
                 # process_as_chat will remain False
             else:
                 process_as_chat = True 
+                renderer = ChatRenderer(tokenizer, defer=args.emit_messages)
                 if "Llama-3" in args.chat_template: 
                     system_prompt_for_chat = "You are a helpful AI assistant." 
                 logging.info(f"CHAT MODE ACTIVE. Using chat template from '{args.chat_template}' with system prompt: \"{system_prompt_for_chat}\", Batch size: {args.batch_size}")
@@ -166,11 +165,11 @@ def main():
                     if len(messages_batch_for_template) >= args.batch_size:
                         try:
                             # tokenizer is definitely available and valid here
-                            formatted_texts = tokenizer.apply_chat_template(messages_batch_for_template, tokenize=False, add_generation_prompt=False)
+                            formatted_fields = renderer.fields_batch(messages_batch_for_template)
                             for i, original_rec in enumerate(record_batch_originals):
                                 out_record = original_rec
                                 out_record["augmentation"] = augmentation_batch_info[i]
-                                out_record["text"] = formatted_texts[i]
+                                set_chat_fields(out_record, formatted_fields[i])
                                 output_lines_buffer.append(json_dumps(out_record)) 
                                 total_output += 1
                             outfile.write("\n".join(output_lines_buffer) + "\n")
@@ -194,11 +193,11 @@ def main():
                 logging.info(f"Processing final batch of {len(messages_batch_for_template)} items...")
                 try:
                     # tokenizer is definitely available and valid here
-                    formatted_texts = tokenizer.apply_chat_template(messages_batch_for_template, tokenize=False, add_generation_prompt=False)
+                    formatted_fields = renderer.fields_batch(messages_batch_for_template)
                     for i, original_rec in enumerate(record_batch_originals):
                         out_record = original_rec
                         out_record["augmentation"] = augmentation_batch_info[i]
-                        out_record["text"] = formatted_texts[i]
+                        set_chat_fields(out_record, formatted_fields[i])
                         output_lines_buffer.append(json_dumps(out_record)); total_output += 1
                     if output_lines_buffer: outfile.write("\n".join(output_lines_buffer) + "\n")
                 except Exception as e:
@@ -1,299 +1,330 @@
 #!/usr/bin/env python3
+"""
+test_template_speed.py
+
+Reproducible benchmark for the per-record work in the 3y/3z generators:
+chat-template rendering and JSON encode/decode.
+
+Records are synthetic Norwegian/English translation pairs drawn with a fixed
+seed from a length distribution (--lengths short/medium/long/mixed), turned
+into chat messages with the same create_chat_messages() as
+create_english_norwegian.py. Benchmarks:
+
+    template_record      tokenizer.apply_chat_template, one conversation per call
+    template_batch_<N>   tokenizer.apply_chat_template on batches of N (--batch_sizes)
+    native               common.chat_render.ChatRenderer (native builder, if verified)
+    json_dumps/loads     stdlib json (ensure_ascii=False, like the generators)
+    orjson_dumps/loads   orjson, if installed
+
+For every benchmark and distribution the report has throughput (records/s,
+median over --repeats), p50/p99 latency per record in microseconds (for
+batched calls: batch time / batch size) and peak RSS. Each benchmark runs in
+a forked child process, so peak RSS is not inflated by earlier benchmarks.
+
+Results are written as JSON; --compare prints the speed-up against an earlier
+result file, e.g. one produced on the previous commit:
+
+    python test_template_speed.py --chat_template meta-llama/Meta-Llama-3-8B-Instruct -o before.json
+    (change something)
+    python test_template_speed.py --chat_template meta-llama/Meta-Llama-3-8B-Instruct -o after.json --compare before.json
+"""
 
 import argparse
-import json # Standard JSON library
+import json
 import logging
-import sys
+import os
+import platform
 import random
-from typing import Dict, Any, List
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
 
-# Attempt to use orjson for potentially faster JSON processing
 try:
     import orjson
-    JSON_LIB_USED = "orjson"
-    def json_loads(s: str) -> Any:
-        return orjson.loads(s)
-    def json_dumps(obj: Any) -> str:
-        # orjson.dumps returns bytes, so we need to decode
-        return orjson.dumps(obj).decode('utf-8')
 except ImportError:
-    import json as std_json # Fallback to standard json
-    JSON_LIB_USED = "standard json"
-    def json_loads(s: str) -> Any:
-        return std_json.loads(s)
-    def json_dumps(obj: Any) -> str:
-        return std_json.dumps(obj, ensure_ascii=False)
-
-try:
-    from tqdm import tqdm
-except ImportError:
-    print("Please install tqdm: pip install tqdm")
-    sys.exit(1)
+    orjson = None
 
 try:
     from transformers import AutoTokenizer
 except ImportError:
     AutoTokenizer = None
 
-NB_LABELS = [
-    "Norwegian:", "Norwegian Bokmål:", "Norsk:", "Norsk bokmål:"
-]
-EN_LABELS = [
-    "English:", "Engelsk:"
-]
-
-# Prompts for Norwegian Bokmål -> English and English -> Norwegian Bokmål
-NB_PROMPTS_TO_EN = [
-    "Oversett denne teksten fra norsk bokmål til engelsk:", "Vennligst oversett følgende tekst fra norsk bokmål til engelsk:", "Kan du oversette teksten nedenfor (som er på norsk bokmål) til engelsk?", "Oversett fra norsk bokmål til engelsk:", "Gjengi denne norsk bokmål-teksten på engelsk.", "Konverter dette tekstutdraget fra norsk bokmål til engelsk.", "Oversettelse fra norsk bokmål til engelsk ønskes for:", "Jeg trenger denne teksten oversatt fra norsk bokmål til engelsk:", "Oversett følgende til engelsk (teksten er på norsk bokmål):", "Norsk bokmål-tekst for oversettelse til engelsk:", "Oversett denne teksten (skrevet på norsk bokmål) til engelsk:", "Vennligst gjør om følgende tekst, som er på norsk bokmål, til engelsk:", "Kan du gjengi teksten under, som er på norsk bokmål, på engelsk?", "Til engelsk, oversett denne norsk bokmål-teksten:", "Kildespråk: Norsk bokmål. Målspråk: Engelsk. Oversett teksten:", "Formuler denne norsk bokmål-teksten på engelsk.", "Jeg ønsker en engelsk versjon av denne teksten på norsk bokmål:", "Overfør meningen i denne teksten fra norsk bokmål til engelsk.", "Gi meg en engelsk oversettelse av det følgende (på norsk bokmål):", "Lag en engelsk gjengivelse av teksten nedenfor (som er norsk bokmål).", "Norsk bokmål -> Engelsk: Oversett.", "Hjelp meg å oversette dette fra norsk bokmål til engelsk.", "Vær snill og konverter denne norsk bokmål-teksten til engelsk:", "Tekst på norsk bokmål for engelsk oversettelse:", "Sett om denne passasjen fra norsk bokmål til engelsk.",
-    "Oversett denne teksten fra norsk til engelsk:", "Vennligst oversett følgende tekst fra norsk til engelsk:", "Kan du oversette teksten nedenfor fra norsk til engelsk?", "Oversett fra norsk til engelsk:", "Gjengi denne norske teksten på engelsk.", "Konverter dette tekstutdraget fra norsk til engelsk.", "Oversettelse fra norsk til engelsk ønskes for:", "Jeg trenger denne teksten oversatt fra norsk til engelsk:", "Oversett følgende til engelsk (teksten er på norsk):", "Norsk tekst for oversettelse til engelsk:", "Oversett denne teksten til engelsk:", "Vennligst gjør om følgende tekst til engelsk:", "Kan du gjengi teksten under på engelsk?", "Til engelsk, oversett:", "Kildespråk: Norsk. Målspråk: Engelsk. Oversett teksten:", "Formuler denne norske teksten på engelsk.", "Jeg ønsker en engelsk versjon av denne norske teksten:", "Overfør meningen i denne teksten fra norsk til engelsk.", "Gi meg en engelsk oversettelse av det følgende (som er norsk):", "Lag en engelsk gjengivelse av teksten nedenfor.", "Norsk -> Engelsk: Oversett.", "Hjelp meg å oversette dette fra norsk til engelsk.", "Vær snill og konverter norsk tekst til engelsk:", "Tekst for engelsk oversettelse (fra norsk):", "Sett om denne passasjen fra norsk til engelsk.",
-    "Translate this text from Norwegian Bokmål to English:", "Please translate the following passage from Norwegian Bokmål into English.", "Could you convert this Norwegian Bokmål text to English?", "Render the text below from Norwegian Bokmål to English.", "Norwegian Bokmål to English translation task:", "Translate from Norwegian Bokmål to English:", "I need an English translation of the following Norwegian Bokmål text:", "Provide an English version of the text (originally in Norwegian Bokmål):", "Source: Norwegian Bokmål. Target: English. Translate the provided text:", "Translate this Norwegian Bokmål text to English:", "Please convert the following text, which is in Norwegian Bokmål, into English.", "Could you render the passage below (in Norwegian Bokmål) in English?", "To English, please translate this Norwegian Bokmål text:", "Here is a text in Norwegian Bokmål. Please provide the English translation:", "Task: Translate the following from its original language (Norwegian Bokmål) to English.", "Rephrase this Norwegian Bokmål text in English.", "Convert the following from Norwegian Bokmål into English:", "Your task is to translate the upcoming Norwegian Bokmål text into English.", "English rendition needed for this Norwegian Bokmål text:", "Process the following Norwegian Bokmål text and output its English equivalent.", "Norwegian Bokmål -> English: Translate.", "Assist me by translating this from Norwegian Bokmål to English.", "Kindly transform the Norwegian Bokmål input into English.", "Provide the English translation for the Norwegian Bokmål content below:", "Transcribe this passage from Norwegian Bokmål into English.",
-    "Translate this text from Norwegian to English:", "Please translate the following passage from Norwegian into English.", "Could you convert this Norwegian text to English?", "Render the text below from Norwegian to English.", "Norwegian to English translation task:", "Translate from Norwegian to English:", "I need an English translation of the following Norwegian text:", "Provide an English version of the text (originally in Norwegian):", "Source: Norwegian. Target: English. Translate the provided text:", "Translate this text to English:", "Please convert the following text into English.", "Could you render the passage below in English?", "To English, please translate the text:", "Here is a text in Norwegian. Please provide the English translation:", "Task: Translate the following from its original language (Norwegian) to English.", "Rephrase this Norwegian text in English.", "Convert the following from Norwegian into English:", "Your task is to translate the upcoming Norwegian text into English.", "English rendition needed for this Norwegian text:", "Process the following Norwegian text and output its English equivalent.", "Norwegian -> English: Translate.", "Assist me by translating this from Norwegian to English.", "Kindly transform the Norwegian input into English.", "Provide the English translation for the Norwegian content below:", "Transcribe this passage from Norwegian into English."
-]
-
-EN_PROMPTS_TO_NB = [
-    "Translate this text from English to Norwegian Bokmål:", "Please translate the following passage from English into Norwegian Bokmål.", "Could you convert this English text to Norwegian Bokmål?", "Render the text below from English to Norwegian Bokmål.", "English to Norwegian Bokmål translation task:", "Translate from English to Norwegian Bokmål:", "I need a Norwegian Bokmål translation of the following English text:", "Provide a Norwegian Bokmål version of the text (originally in English):", "Source: English. Target: Norwegian Bokmål. Translate the provided text:", "Translate this English text to Norwegian Bokmål:", "Please convert the following text into Norwegian Bokmål.", "Could you render the passage below in Norwegian Bokmål?", "To Norwegian Bokmål, please translate the text:", "Here is a text in English. Please provide the Norwegian Bokmål translation:", "Task: Translate the following from its original language (English) to Norwegian Bokmål.", "Rephrase this English text in Norwegian Bokmål.", "Convert the following from English into Norwegian Bokmål:", "Your task is to translate the upcoming English text into Norwegian Bokmål.", "Norwegian Bokmål rendition needed for this English text:", "Process the following English text and output its Norwegian Bokmål equivalent.", "English -> Norwegian Bokmål: Translate.", "Assist me by translating this from English to Norwegian Bokmål.", "Kindly transform the English input into Norwegian Bokmål.", "Provide the Norwegian Bokmål translation for the English content below:", "Transcribe this passage from English into Norwegian Bokmål.",
-    "Oversett denne teksten fra engelsk til norsk bokmål:", "Vennligst oversett følgende tekst fra engelsk til norsk bokmål:", "Kan du oversette teksten nedenfor fra engelsk til norsk bokmål?", "Oversett fra engelsk til norsk bokmål:", "Gjengi denne engelske teksten på norsk bokmål.", "Konverter dette tekstutdraget fra engelsk til norsk bokmål.", "Oversettelse fra engelsk til norsk bokmål ønskes for:", "Jeg trenger denne teksten oversatt fra engelsk til norsk bokmål:", "Oversett følgende til norsk bokmål (teksten er på engelsk):", "Engelsk tekst for oversettelse til norsk bokmål:", "Oversett denne teksten (fra engelsk) til norsk bokmål:", "Vennligst gjør om følgende engelske tekst til norsk bokmål:", "Kan du gjengi teksten under (som er på engelsk) på norsk bokmål?", "Til norsk bokmål, oversett denne engelske teksten:", "Kildespråk: Engelsk. Målspråk: Norsk bokmål. Oversett teksten:", "Formuler denne engelske teksten på norsk bokmål.", "Jeg ønsker en norsk bokmål-versjon av denne engelske teksten:", "Overfør meningen i denne teksten fra engelsk til norsk bokmål.", "Gi meg en norsk bokmål-oversettelse av det følgende (som er engelsk):", "Lag en norsk bokmål-gjengivelse av den engelske teksten nedenfor.", "Engelsk -> Norsk bokmål: Oversett.", "Hjelp meg å oversette dette fra engelsk til norsk bokmål.", "Vær snill og konverter engelsk tekst til norsk bokmål:", "Tekst for norsk bokmål-oversettelse (fra engelsk):", "Sett om denne passasjen fra engelsk til norsk bokmål.",
-    "Oversett denne teksten fra engelsk til norsk:", "Vennligst oversett følgende tekst fra engelsk til norsk:", "Kan du oversette teksten nedenfor fra engelsk til norsk?", "Oversett fra engelsk til norsk:", "Gjengi denne engelske teksten på norsk.", "Konverter dette tekstutdraget fra engelsk til norsk.", "Oversettelse fra engelsk til norsk ønskes for:", "Jeg trenger denne teksten oversatt fra engelsk til norsk:", "Oversett følgende til norsk (teksten er på engelsk):", "Engelsk tekst for oversettelse til norsk:", "Oversett denne teksten til norsk:", "Vennligst gjør om følgende tekst til norsk:", "Kan du gjengi teksten under på norsk?", "Til norsk, oversett:", "Kildespråk: Engelsk. Målspråk: Norsk. Oversett teksten:", "Formuler denne engelske teksten på norsk.", "Jeg ønsker en norsk versjon av denne engelske teksten:", "Overfør meningen i denne teksten fra engelsk til norsk.", "Gi meg en norsk oversettelse av det følgende (som er engelsk):", "Lag en norsk gjengivelse av teksten nedenfor.", "Engelsk -> Norsk: Oversett.", "Hjelp meg å oversette dette fra engelsk til norsk.", "Vær snill og konverter engelsk tekst til norsk:", "Tekst for norsk oversettelse (fra engelsk):", "Sett om denne passasjen fra engelsk til norsk."
-]
-
-DEFAULT_BATCH_SIZE = 5000
-
-def count_lines(filename: str) -> int:
-    try:
-        with open(filename, "r", encoding="utf-8") as f:
-            return sum(1 for _ in f)
-    except FileNotFoundError:
-        return 0
-
-def create_chat_messages(
-    record: Dict[str, Any],
-    swap: bool,
-    system_prompt_str: str # Explicitly pass the string
-) -> (List[Dict[str, str]], str):
-    source = record.get("source", "")
-    target = record.get("target", "")
-    if not source or not target:
-        return None, None
-
-    augmentation = None
-    if not swap:
-        augmentation = random.choice(EN_PROMPTS_TO_NB)
-        user_content = f"{augmentation}\n{source}"
-        assistant_content = target
-    else:
-        augmentation = random.choice(NB_PROMPTS_TO_EN)
-        user_content = f"{augmentation}\n{target}"
-        assistant_content = source
-
-    # Use the passed system_prompt_str directly
-    messages = [
-        {"role": "system", "content": system_prompt_str},
-        {"role": "user", "content": user_content},
-        {"role": "assistant", "content": assistant_content},
-    ]
-    return messages, augmentation
-
-def process_record_standard(
-    record: Dict[str, Any],
-    swap: bool,
-) -> Dict[str, Any]:
-    source = record.get("source", "")
-    target = record.get("target", "")
-    if not source or not target:
-        return None
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer
+from create_english_norwegian import create_chat_messages
+
+SYSTEM_PROMPT = "You are a helpful AI assistant."
 
-    out = dict(record)
-    en_label = random.choice(EN_LABELS)
-    nb_label = random.choice(NB_LABELS)
-    if not swap:
-        text_out = f"{en_label} {source}\n{nb_label} {target}"
+# Words per side: (log-normal median, sigma, cap)
+LENGTHS = {
+    "short": (12, 0.5, 60),
+    "medium": (60, 0.6, 400),
+    "long": (400, 0.5, 3000),
+}
+MIXED = {"short": 0.6, "medium": 0.3, "long": 0.1}
+
+NB_WORDS = (
+    "og i det som er på at en til for ikke med av har de seg jeg den så vi kan om var "
+    "ble også etter når mot skal bare over må kommer norske året regjeringen kommunen "
+    "barn skole arbeid været fjellet kysten båten hytta sommeren vinteren læreren elevene "
+    "bøkene språket nynorsk bokmål økonomi helse sykehus fylket Østlandet Trøndelag Tromsø "
+    "fiske olje strøm været sjøen gården været høsten våren rådmannen saken møtet forslaget"
+).split()
+EN_WORDS = (
+    "the and of to in is that for it with as was on be by this are from at have an not "
+    "government municipality children school work weather mountain coast boat cabin summer "
+    "winter teacher students books language economy health hospital county fishing oil "
+    "power sea farm autumn spring council case meeting proposal Norway Norwegian people"
+).split()
+
+DEFAULT_BATCH_SIZES = [100, 1000, 5000]
+
+
+# -------------------------------------------------------------------------
+# Synthetic records
+# -------------------------------------------------------------------------
+def sentence(rng: random.Random, words: List[str], n: int) -> str:
+    out, left = [], n
+    while left > 0:
+        k = min(left, rng.randint(6, 18))
+        s = " ".join(rng.choice(words) for _ in range(k))
+        out.append(s[0].upper() + s[1:] + rng.choice(".....?!"))
+        left -= k
+    return " ".join(out)
+
+
+def make_records(distribution: str, n: int, seed: int) -> List[Dict[str, str]]:
+    rng = random.Random(f"{seed}:{distribution}")
+    buckets = [distribution] * n if distribution != "mixed" else \
+        rng.choices(list(MIXED), weights=list(MIXED.values()), k=n)
+    records = []
+    for i, bucket in enumerate(buckets):
+        median, sigma, cap = LENGTHS[bucket]
+        words = max(1, min(cap, round(rng.lognormvariate(0, sigma) * median)))
+        records.append({
+            "id": f"bench_{distribution}_{i}",
+            "source": sentence(rng, EN_WORDS, words),
+            "target": sentence(rng, NB_WORDS, words),
+        })
+    return records
+
+
+def make_conversations(records: List[Dict[str, str]], seed: int) -> List[tuple]:
+    """(messages, augmentation) per record, built like create_english_norwegian.py does."""
+    # create_chat_messages draws its prompt from the global random state
+    random.seed(seed)
+    return [create_chat_messages(r, bool(i % 2), SYSTEM_PROMPT) for i, r in enumerate(records)]
+
+
+# -------------------------------------------------------------------------
+# Benchmarks
+# -------------------------------------------------------------------------
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(fn: Callable[[Any], Any], items: List[Any], batch_size: int = 1) -> List[float]:
+    """Call fn on every item (or every batch of items); return per-record latencies in seconds."""
+    latencies = []
+    clock = time.perf_counter
+    if batch_size == 1:
+        for item in items:
+            t0 = clock()
+            fn(item)
+            latencies.append(clock() - t0)
     else:
-        text_out = f"{nb_label} {target}\n{en_label} {source}"
-    out["text"] = text_out
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            t0 = clock()
+            fn(batch)
+            latencies.extend([(clock() - t0) / len(batch)] * len(batch))
+    return latencies
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    idx = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def build_benchmarks(tokenizer, batch_sizes: List[int]) -> Dict[str, Callable]:
+    """name -> setup(conversations, records) returning (fn, items, batch_size)."""
+    benches: Dict[str, Callable] = {}
+    if tokenizer is not None:
+        def template(conv):
+            return tokenizer.apply_chat_template(conv, tokenize=False, add_generation_prompt=False)
+        benches["template_record"] = lambda convs, recs: (template, convs, 1)
+        for bs in batch_sizes:
+            benches[f"template_batch_{bs}"] = lambda convs, recs, bs=bs: (template, convs, bs)
+
+        def native(convs, recs):
+            renderer = ChatRenderer(tokenizer, verify_records=0)
+            if not renderer.is_native:
+                return None
+            return renderer.render, convs, 1
+        benches["native"] = native
+
+    def encoded(recs, dumps):
+        return [dumps(r) for r in recs]
+
+    std_dumps = lambda r: json.dumps(r, ensure_ascii=False)
+    benches["json_dumps"] = lambda convs, recs: (std_dumps, recs, 1)
+    benches["json_loads"] = lambda convs, recs: (json.loads, encoded(recs, std_dumps), 1)
+    if orjson is not None:
+        benches["orjson_dumps"] = lambda convs, recs: (orjson.dumps, recs, 1)
+        benches["orjson_loads"] = lambda convs, recs: (orjson.loads, encoded(recs, orjson.dumps), 1)
+    return benches
+
+
+def output_records(records, conversations, tokenizer) -> List[Dict[str, Any]]:
+    """Records shaped like the generators' output lines (JSON benchmarks use these)."""
+    out = []
+    for rec, (messages, augmentation) in zip(records, conversations):
+        text = tokenizer.apply_chat_template(messages, tokenize=False) if tokenizer is not None else \
+            f"English: {rec['source']}\nNorsk: {rec['target']}"
+        out.append(dict(rec, augmentation=augmentation, text=text))
     return out
 
+
+def run_one(job) -> Optional[Dict[str, Any]]:
+    """Child process: run one benchmark on one distribution."""
+    setup, conversations, records, repeats = job
+    prepared = setup(conversations, records)
+    if prepared is None:
+        return None
+    fn, items, batch_size = prepared
+    fn(items[0] if batch_size == 1 else items[:batch_size])  # warm-up
+    rates, latencies = [], []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        lat = timed(fn, items, batch_size)
+        rates.append(len(items) / (time.perf_counter() - t0))
+        latencies.extend(lat)
+    latencies.sort()
+    rates.sort()
+    return {
+        "records": len(items),
+        "batch_size": batch_size,
+        "throughput_rps": rates[len(rates) // 2],
+        "p50_us": percentile(latencies, 0.50) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+_JOB = None  # set before forking; the benchmark closures cannot be pickled
+
+
+def _run_job() -> Optional[Dict[str, Any]]:
+    return run_one(_JOB)
+
+
+def run_isolated(job) -> Optional[Dict[str, Any]]:
+    global _JOB
+    _JOB = job
+    with get_context("fork").Pool(1) as pool:
+        return pool.apply(_run_job)
+
+
+# -------------------------------------------------------------------------
+# Reporting
+# -------------------------------------------------------------------------
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_results(results: List[Dict[str, Any]], baseline: Optional[Dict[str, Any]] = None) -> None:
+    header = f"{'benchmark':<20} {'lengths':<8} {'records/s':>12} {'p50 µs':>10} {'p99 µs':>10} {'peak MB':>9}"
+    if baseline is not None:
+        header += f" {'vs base':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        line = (f"{r['name']:<20} {r['lengths']:<8} {r['throughput_rps']:>12,.0f} "
+                f"{r['p50_us']:>10.1f} {r['p99_us']:>10.1f} {r['peak_rss_mb']:>9.0f}")
+        if baseline is not None:
+            base = baseline.get((r["name"], r["lengths"]))
+            line += f" {r['throughput_rps'] / base['throughput_rps']:>7.2f}x" if base else f" {'-':>8}"
+        print(line)
+
+
 def main():
-    parser = argparse.ArgumentParser(
-        description="Format and augment a parallel English-Norwegian(Bokmål) translation dataset."
-    )
-    parser.add_argument("--input_file", "-i", required=True, help="Path to the input JSONL file.")
-    parser.add_argument("--output_file", "-o", required=True, help="Path to the output JSONL file.")
-    parser.add_argument("--chat_template", help="HF model identifier with a built-in chat template.")
+    parser = argparse.ArgumentParser(description="Benchmark chat-template rendering and JSON codecs on synthetic Norwegian records.")
+    parser.add_argument("--chat_template", help="HF model identifier with a chat template (template benchmarks are skipped without it).")
+    parser.add_argument("--num_records", type=int, default=10000, help="Records per length distribution.")
+    parser.add_argument("--lengths", nargs="+", default=["short", "medium", "long", "mixed"],
+                        choices=list(LENGTHS) + ["mixed"], help="Length distributions to run.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=DEFAULT_BATCH_SIZES, help="Batch sizes for batched apply_chat_template.")
+    parser.add_argument("--benchmarks", nargs="+", default=None, help="Only run these benchmarks (default: all available).")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed passes per benchmark; throughput is the median.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for the synthetic records.")
+    parser.add_argument("--output_file", "-o", default="template_benchmark.json", help="Where to write the JSON results.")
+    parser.add_argument("--compare", help="Earlier result JSON to compare throughput against.")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
-    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Batch size for chat template processing (default: {DEFAULT_BATCH_SIZE}).")
-    parser.add_argument("--no_count_lines", action="store_true", help="Skip initial line count for faster startup.")
-
     args = parser.parse_args()
-    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(levelname)s: %(message)s")
-    logging.info(f"Using {JSON_LIB_USED} for JSON operations.")
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING, format="%(levelname)s: %(message)s")
 
     tokenizer = None
-    system_prompt_for_chat = "You are a helpful assistant." # Default system prompt string
-
     if args.chat_template:
         if AutoTokenizer is None:
-            logging.error("The 'transformers' library must be installed for --chat_template. Run: pip install transformers")
-            sys.exit(1)
-        try:
-            logging.info(f"Loading tokenizer for: {args.chat_template}")
-            tokenizer = AutoTokenizer.from_pretrained(args.chat_template, trust_remote_code=True)
-            logging.info(f"Tokenizer {args.chat_template} loaded successfully.")
-        except Exception as e:
-            logging.error(f"Error loading tokenizer '{args.chat_template}': {e}")
-            sys.exit(1)
-
-        if not hasattr(tokenizer, "apply_chat_template") or not callable(tokenizer.apply_chat_template):
-            logging.error(f"Tokenizer for '{args.chat_template}' lacks a callable 'apply_chat_template' method.")
-            sys.exit(1)
-        
-        # *** MODIFICATION HERE ***
-        # Determine system prompt string without getattr on tokenizer for this specific test
-        if "Llama-3" in args.chat_template: # Simple check for Llama 3 models
-            system_prompt_for_chat = "You are a helpful AI assistant." # Standard for Llama3 instruct
-            # Or, if you know the specific Llama 3.1 system prompt:
-            # system_prompt_for_chat = "This is a system prompt for Llama 3.1..." 
-        # else: system_prompt_for_chat remains "You are a helpful assistant."
-        
-        logging.info(f"Using chat template from '{args.chat_template}' with system prompt: \"{system_prompt_for_chat}\" and batch size: {args.batch_size}")
-    else:
-        logging.info("Running in standard (non-chat) mode.")
+            sys.exit("The 'transformers' library must be installed for --chat_template.")
+        tokenizer = AutoTokenizer.from_pretrained(args.chat_template, trust_remote_code=True)
 
-    total_input = 0
-    total_output = 0
-    error_list = []
-    pbar = None 
+    benches = build_benchmarks(tokenizer, args.batch_sizes)
+    names = args.benchmarks or list(benches)
+    unknown = [n for n in names if n not in benches]
+    if unknown:
+        sys.exit(f"Unknown or unavailable benchmarks: {unknown} (available: {list(benches)})")
+
+    results = []
+    for lengths in args.lengths:
+        records = make_records(lengths, args.num_records, args.seed)
+        conversations = make_conversations(records, args.seed)
+        outputs = output_records(records, conversations, tokenizer)
+        conversations = [messages for messages, _ in conversations]
+        words = sum(len(r["source"].split()) + len(r["target"].split()) for r in records) / len(records)
+        print(f"[{lengths}] {len(records):,} records, {words:,.0f} words per record on average", file=sys.stderr)
+        for name in names:
+            result = run_isolated((benches[name], conversations, outputs, args.repeats))
+            if result is None:
+                print(f"[{lengths}] {name}: not available for this tokenizer, skipped", file=sys.stderr)
+                continue
+            results.append(dict(name=name, lengths=lengths, **result))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "chat_template": args.chat_template,
+            "orjson": getattr(orjson, "__version__", None),
+            "num_records": args.num_records,
+            "repeats": args.repeats,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    Path(args.output_file).write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+
+    baseline = None
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        baseline = {(r["name"], r["lengths"]): r for r in old["results"]}
+        print(f"Baseline: {args.compare} (commit {old['meta'].get('commit')})")
+    print_results(results, baseline)
+    print(f"\nResults written to {args.output_file}")
 
-    try:
-        num_lines = 0
-        if not args.no_count_lines:
-            logging.info(f"Counting lines in '{args.input_file}'...")
-            num_lines = count_lines(args.input_file)
-            if num_lines == 0 and args.input_file:
-                 try:
-                    with open(args.input_file, "r", encoding="utf-8") as f_check:
-                        if not f_check.read(1):
-                             logging.warning(f"Input file '{args.input_file}' is empty.")
-                 except FileNotFoundError:
-                    logging.error(f"Input file '{args.input_file}' not found.")
-                    sys.exit(1)
-            logging.info(f"Found {num_lines} lines in '{args.input_file}'.")
-        else:
-            logging.info("Skipping initial line count.")
-
-        with open(args.input_file, "r", encoding="utf-8") as infile, \
-             open(args.output_file, "w", encoding="utf-8") as outfile:
-
-            pbar_params = {"desc": "Processing lines", "unit": "lines"}
-            if num_lines > 0:
-                pbar_params["total"] = num_lines
-            
-            pbar = tqdm(**pbar_params)
-
-            record_batch_originals = [] 
-            messages_batch_for_template = [] 
-            augmentation_batch_info = [] 
-            output_lines_buffer = [] 
-
-            for line_num, line in enumerate(infile, 1):
-                total_input += 1
-                line = line.strip()
-                if not line:
-                    pbar.update(1)
-                    continue
-                try:
-                    record = json_loads(line)
-                except Exception as e: 
-                    error_list.append((line_num, f"JSON load error: {e}. Line: '{line[:100]}...'"))
-                    pbar.update(1)
-                    continue
-                
-                swap = bool(random.getrandbits(1))
-
-                if args.chat_template and tokenizer:
-                    # Pass the determined system_prompt_for_chat string
-                    messages, augmentation = create_chat_messages(record, swap, system_prompt_for_chat) 
-                    if messages:
-                        record_batch_originals.append(dict(record)) 
-                        messages_batch_for_template.append(messages)
-                        augmentation_batch_info.append(augmentation)
-
-                    if len(messages_batch_for_template) >= args.batch_size:
-                        try:
-                            formatted_texts = tokenizer.apply_chat_template(
-                                messages_batch_for_template, tokenize=False, add_generation_prompt=False
-                            )
-                            for i, original_rec in enumerate(record_batch_originals):
-                                out_record = original_rec
-                                out_record["augmentation"] = augmentation_batch_info[i]
-                                out_record["text"] = formatted_texts[i]
-                                output_lines_buffer.append(json_dumps(out_record)) 
-                                total_output += 1
-                            outfile.write("\n".join(output_lines_buffer) + "\n")
-                        except Exception as e:
-                            logging.error(f"Error applying chat template to batch (lines approx {line_num-args.batch_size+1}-{line_num}): {e}")
-                            for i, _ in enumerate(record_batch_originals):
-                                error_list.append((f"Batch item {i}", f"Failed in batch processing: {e}"))
-                        finally:
-                            record_batch_originals.clear()
-                            messages_batch_for_template.clear()
-                            augmentation_batch_info.clear()
-                            output_lines_buffer.clear()
-                else: 
-                    out_record = process_record_standard(record, swap)
-                    if out_record is not None:
-                        outfile.write(json_dumps(out_record) + "\n")
-                        total_output += 1
-                pbar.update(1)
-
-            if args.chat_template and tokenizer and messages_batch_for_template:
-                logging.info(f"Processing final batch of {len(messages_batch_for_template)} items...")
-                try:
-                    formatted_texts = tokenizer.apply_chat_template(
-                        messages_batch_for_template, tokenize=False, add_generation_prompt=False
-                    )
-                    for i, original_rec in enumerate(record_batch_originals):
-                        out_record = original_rec
-                        out_record["augmentation"] = augmentation_batch_info[i]
-                        out_record["text"] = formatted_texts[i]
-                        output_lines_buffer.append(json_dumps(out_record))
-                        total_output += 1
-                    if output_lines_buffer: 
-                         outfile.write("\n".join(output_lines_buffer) + "\n")
-                except Exception as e:
-                    logging.error(f"Error applying chat template to the final batch: {e}")
-                    for i, _ in enumerate(record_batch_originals):
-                        error_list.append((f"Final batch item {i}", f"Failed in final batch processing: {e}"))
-                finally:
-                    record_batch_originals.clear()
-                    messages_batch_for_template.clear()
-                    augmentation_batch_info.clear()
-                    output_lines_buffer.clear()
-
-    except FileNotFoundError:
-        logging.error(f"Error: Input file '{args.input_file}' not found.")
-        sys.exit(1)
-    except IOError as e:
-        logging.error(f"File I/O error: {e}")
-        sys.exit(1)
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {e}", exc_info=args.debug)
-        sys.exit(1)
-    finally:
-        if pbar is not None:
-             pbar.close()
-
-    print(f"\n--- Processing Summary ---")
-    print(f"Total input lines read: {total_input}")
-    print(f"Total output lines generated: {total_output}")
-    if error_list:
-        print(f"\nEncountered {len(error_list)} errors during processing.")
-        max_errors_to_show = 10
-        for i, (line_info, err) in enumerate(error_list[:max_errors_to_show]):
-            print(f"  Error {i+1} (Line/Info: {line_info}): {err}")
-        if len(error_list) > max_errors_to_show:
-            print(f"  ... and {len(error_list) - max_errors_to_show} more errors.")
-    else:
-        print("No errors encountered.")
 
 if __name__ == "__main__":
     main()
@@ -5,13 +5,16 @@ import json
 import logging
 import sys
 import random
+from pathlib import Path
 from typing import Dict, Any, List
 from tqdm import tqdm
 
-try:
-    from transformers import AutoTokenizer
-except ImportError:
-    AutoTokenizer = None
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import ChatRenderer, set_chat_fields
+from common.record_rng import add_rng_arguments, shard_lines, stage_rng
+from common.tokenizer_provider import load_tokenizer
+
+STAGE = "3z_summary_english"
 
 # EuroEval-style base prompt templates (including minimal version)
 PROMPT_BASES = [
@@ -39,12 +42,12 @@ def count_lines(filename: str) -> int:
     with open(filename, "r", encoding="utf-8") as f:
         return sum(1 for _ in f)
 
-def create_chat_messages(record: Dict[str, Any], system_prompt: str) -> (List[Dict[str, str]], str):
+def create_chat_messages(record: Dict[str, Any], system_prompt: str, rng=random) -> (List[Dict[str, str]], str):
     article, highlights = record.get("article", ""), record.get("highlights", "")
     if not article or not highlights:
         return None, None
     # For this example, randomly choose an instruction
-    instruction = random.choice(INSTRUCTION_BASES).format(article=article)
+    instruction = rng.choice(INSTRUCTION_BASES).format(article=article)
     # Assistant always outputs the highlights
     return [
         {"role": "system",    "content": system_prompt},
@@ -52,12 +55,12 @@ def create_chat_messages(record: Dict[str, Any], system_prompt: str) -> (List[Di
         {"role": "assistant", "content": highlights}
     ], instruction
 
-def process_record_standard(record: Dict[str, Any]) -> Dict[str, Any]:
+def process_record_standard(record: Dict[str, Any], rng=random) -> Dict[str, Any]:
     article, highlights = record.get("article", ""), record.get("highlights", "")
     if not article or not highlights:
         return None
     out = dict(record)
-    template = random.choice(PROMPT_BASES)
+    template = rng.choice(PROMPT_BASES)
     out["text"] = template.format(article=article, highlights=highlights)
     return out
 
@@ -70,23 +73,24 @@ def main():
     parser.add_argument("--chat_template", help="HF model identifier with a built-in chat template.")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
     parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Batch size for chat template processing (default: {DEFAULT_BATCH_SIZE}).")
+    parser.add_argument("--emit_messages", action="store_true", help='Store the conversation as "messages" (role/content) instead of rendering "text"; it is rendered at export (7c_retargeted/transcode_chat.py).')
     parser.add_argument("--no_count_lines", action="store_true", help="Skip initial line count for faster startup.")
 
+    add_rng_arguments(parser)
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(levelname)s: %(message)s")
+    rngs = stage_rng(args, STAGE)
 
     tokenizer = None
     system_prompt_for_chat = "You are a helpful assistant."
     process_as_chat = False
 
     if args.chat_template:
-        if AutoTokenizer is None:
-            logging.error("transformers not installed, cannot use --chat_template")
-            sys.exit(1)
         try:
-            tokenizer = AutoTokenizer.from_pretrained(args.chat_template, trust_remote_code=True)
+            tokenizer = load_tokenizer(args.chat_template, trust_remote_code=True)
             if hasattr(tokenizer, "apply_chat_template") and callable(tokenizer.apply_chat_template):
                 process_as_chat = True
+                renderer = ChatRenderer(tokenizer, defer=args.emit_messages)
         except Exception as e:
             logging.error(f"Error loading tokenizer '{args.chat_template}': {e}", exc_info=args.debug)
 
@@ -95,14 +99,13 @@ def main():
     error_list = []
 
     num_lines = 0
-    if not args.no_count_lines:
+    if not args.no_count_lines and args.shard is None:
         try:
             num_lines = count_lines(args.input_file)
         except Exception:
             pass
 
-    with open(args.input_file, "r", encoding="utf-8") as infile, \
-         open(args.output_file, "w", encoding="utf-8") as outfile, \
+    with open(args.output_file, "w", encoding="utf-8") as outfile, \
          tqdm(desc="Processing lines", unit="lines", total=(num_lines or None)) as pbar:
 
         record_batch_originals = []
@@ -110,7 +113,7 @@ def main():
         instruction_batch_info = []
         output_lines_buffer = []
 
-        for line_num, line in enumerate(infile, 1):
+        for line_num, line in enumerate(shard_lines(args.input_file, args.shard), 1):
             total_input += 1
             line = line.strip()
             if not line:
@@ -123,21 +126,20 @@ def main():
                 pbar.update(1)
                 continue
 
+            rng = rngs(record.get("id") or record.get("article"))  # keyed on the record, not its position
             if process_as_chat:
-                messages, instruction = create_chat_messages(record, system_prompt_for_chat)
+                messages, instruction = create_chat_messages(record, system_prompt_for_chat, rng)
                 if messages:
                     record_batch_originals.append(dict(record))
                     messages_batch_for_template.append(messages)
                     instruction_batch_info.append(instruction)
                 if len(messages_batch_for_template) >= args.batch_size:
                     try:
-                        formatted_texts = tokenizer.apply_chat_template(
-                            messages_batch_for_template, tokenize=False, add_generation_prompt=False
-                        )
+                        formatted_fields = renderer.fields_batch(messages_batch_for_template)
                         for i, original_rec in enumerate(record_batch_originals):
                             out_record = original_rec
                             out_record["augmentation"] = instruction_batch_info[i]
-                            out_record["text"] = formatted_texts[i]
+                            set_chat_fields(out_record, formatted_fields[i])
                             output_lines_buffer.append(json.dumps(out_record, ensure_ascii=False))
                             total_output += 1
                         outfile.write("\n".join(output_lines_buffer) + "\n")
@@ -151,7 +153,7 @@ def main():
                         instruction_batch_info.clear()
                         output_lines_buffer.clear()
             else:
-                out_record = process_record_standard(record)
+                out_record = process_record_standard(record, rng)
                 if out_record:
                     outfile.write(json.dumps(out_record, ensure_ascii=False) + "\n")
                     total_output += 1
@@ -160,13 +162,11 @@ def main():
         # Final batch processing for chat mode
         if process_as_chat and messages_batch_for_template:
             try:
-                formatted_texts = tokenizer.apply_chat_template(
-                    messages_batch_for_template, tokenize=False, add_generation_prompt=False
-                )
+                formatted_fields = renderer.fields_batch(messages_batch_for_template)
                 for i, original_rec in enumerate(record_batch_originals):
                     out_record = original_rec
                     out_record["augmentation"] = instruction_batch_info[i]
-                    out_record["text"] = formatted_texts[i]
+                    set_chat_fields(out_record, formatted_fields[i])
                     output_lines_buffer.append(json.dumps(out_record, ensure_ascii=False))
                     total_output += 1
                 if output_lines_buffer:
@@ -2,10 +2,11 @@
 """
 clean.py
 ========
-Fix and filter JSON-Lines datasets (fields: id, text).
+Fix and filter JSON-Lines datasets (fields: id, text — or id, messages).
 
-• ftfy.fix_text on every text field
-• drop records whose fixed text is < 50 characters
+• ftfy.fix_text on every text field (every message content for records
+  stored with --emit_messages)
+• drop records whose fixed text (summed message contents) is < 50 characters
 • guarantee unique ids by appending _N where N is the 1-based line index
 • reads **all** .jsonl files from --input_folder and writes cleaned
   files with the same names to --output_folder
@@ -25,12 +26,16 @@ python clean.py --input_folder raw_dir --output_folder clean_dir \
 import argparse
 import json
 import os
+import sys
 from pathlib import Path
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from ftfy import fix_text
 from tqdm import tqdm
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import record_messages
+
 
 def clean_file(src_path: str, dst_path: str) -> tuple[str, int, int, int]:
     """
@@ -46,11 +51,26 @@ def clean_file(src_path: str, dst_path: str) -> tuple[str, int, int, int]:
         for n, line in enumerate(fin, 1):
             try:
                 rec = json.loads(line)
-                original = rec["text"]
+                messages = record_messages(rec)
+                original = rec["text"] if messages is None else None
             except Exception:
                 dropped += 1
                 continue
 
+            if messages is not None:
+                contents = [fix_text(m["content"]) for m in messages]
+                if sum(map(len, contents)) < 50:
+                    dropped += 1
+                    continue
+                if any(new != m["content"] for new, m in zip(contents, messages)):
+                    fixed += 1
+                kept += 1
+                rec["messages"] = [{**m, "content": new} for new, m in zip(contents, messages)]
+                rec["id"] = f"{rec['id']}_{n}"
+                json.dump(rec, fout, ensure_ascii=False)
+                fout.write("\n")
+                continue
+
             new = fix_text(original)
             if len(new) < 50:
                 dropped += 1
@@ -2,91 +2,321 @@
 
 import argparse
 import json
+import os
+import resource
+from contextlib import nullcontext
 import fasttext
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from collections import Counter, deque
+from itertools import islice
+from multiprocessing import cpu_count, get_context
 from huggingface_hub import hf_hub_download
 from pathlib import Path
-import re
 
-model = None  # global for worker
+from lid_cache import LidCache
+from lid_segments import aggregate, has_text, is_chat_record, split_record, turn_annotations
+from scandi_lid import classify_batch
 
-USER_PATTERN = re.compile(
-    r"<\|start_header_id\|>user<\|end_header_id\|>\n\n(.*?)<\|eot_id\|>",
-    re.DOTALL
-)
-ASSISTANT_PATTERN = re.compile(
-    r"<\|start_header_id\|>assistant<\|end_header_id\|>\n\n(.*?)<\|eot_id\|>",
-    re.DOTALL
-)
+MODEL_REPO = "cis-lmu/glotlid"
+MODEL_FILE = "model.bin"
+
+model = None  # loaded once in the parent, shared copy-on-write with forked workers
+cache_path = None  # optional LidCache file; each worker opens its own read-only connection
+_cache_reader = None
+keep_rules = None  # optional KeepRules; set in the parent before forking
+use_prefilter = False  # resolve clear nob/nno/dan/swe segments with scandi_lid before GlotLID
+
+class KeepRules:
+    """Which annotated records survive the LID stage.
+
+    A record is kept when its label is allowed and its confidence is strictly
+    above the threshold for that label (same semantics as 3a_clean/filter.py).
+    Labels in `policy` are allowed with their own threshold; all other allowed
+    labels use `min_confidence`. With no labels given, every label is allowed.
+    Thresholds are GlotLID confidences: segments resolved by the scandi_lid
+    prefilter only have to carry an allowed label (see record_keep).
+    """
+
+    __slots__ = ("labels", "min_confidence", "policy")
+
+    def __init__(self, labels=None, min_confidence=0.0, policy=None):
+        self.policy = dict(policy or {})
+        self.labels = set(labels or []) | set(self.policy)
+        self.min_confidence = min_confidence
+
+    def allows(self, label):
+        return not self.labels or label in self.labels
+
+    def keep(self, label, conf):
+        return self.allows(label) and conf > self.policy.get(label, self.min_confidence)
+
+    def describe(self):
+        allowed = ", ".join(sorted(self.labels)) if self.labels else "any label"
+        per_lang = ", ".join(f"{k}>{v}" for k, v in sorted(self.policy.items()))
+        return f"keep {allowed} with confidence >{self.min_confidence}" + (f" ({per_lang})" if per_lang else "")
+
+def policy_item(item):
+    """argparse type: 'nob_Latn=0.99' -> ('nob_Latn', 0.99)."""
+    label, sep, value = item.partition("=")
+    try:
+        threshold = float(value)
+    except ValueError:
+        threshold = None
+    if not sep or not label or threshold is None:
+        raise argparse.ArgumentTypeError(f"expected LABEL=MIN_CONFIDENCE, got '{item}'")
+    return label, threshold
 
 def init_model():
     global model
-    model_path = hf_hub_download(repo_id="cis-lmu/glotlid", filename="model.bin")
+    model_path = hf_hub_download(repo_id=MODEL_REPO, filename=MODEL_FILE)
     model = fasttext.load_model(model_path)
 
-def extract_clean_text(text: str) -> str:
-    if "<|start_header_id|>user<|end_header_id|>" in text and "<|start_header_id|>assistant<|end_header_id|>" in text:
-        user_match = USER_PATTERN.search(text)
-        assistant_match = ASSISTANT_PATTERN.search(text)
-        user_text = user_match.group(1).strip() if user_match else ""
-        assistant_text = assistant_match.group(1).strip() if assistant_match else ""
-        return f"{user_text}\n{assistant_text}".strip()
-    else:
-        return text.strip()
+def peak_rss_mb():
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def get_cache_reader():
+    global _cache_reader
+    if cache_path is not None and _cache_reader is None:
+        _cache_reader = LidCache(cache_path, f"{MODEL_REPO}/{MODEL_FILE}", readonly=True)
+    return _cache_reader
+
+def predict_texts(texts):
+    """Return ([(label, conf)], new_cache_entries, cache_hits, lexicon) for the texts.
+
+    `lexicon` flags the texts resolved by the scandi_lid prefilter; their
+    confidence is the lexicon's, not GlotLID's.
+    """
+    results = [None] * len(texts)
+    todo = range(len(texts))
+    lexicon = [False] * len(texts)
+    if use_prefilter:
+        for i, resolved in enumerate(classify_batch(texts)):
+            results[i] = resolved
+            lexicon[i] = resolved is not None
+        todo = [i for i in todo if results[i] is None]
+
+    cache = get_cache_reader()
+    keys = {}
+    hits = 0
+    if cache is not None:
+        keys = {i: cache.key(texts[i]) for i in todo}
+        known = cache.get_many(list(keys.values()))
+        for i in todo:
+            results[i] = known.get(keys[i])
+        todo = [i for i in todo if results[i] is None]
+        hits = len(keys) - len(todo)
+
+    new_entries = []
+    if todo:
+        preds, confs = model.predict([texts[i] for i in todo])
+        for i, label, conf in zip(todo, preds, confs):
+            results[i] = (label[0].replace("__label__", ""), float(conf[0]))
+            if cache is not None:
+                new_entries.append((keys[i], *results[i]))
+    return results, new_entries, hits, lexicon
 
-def clean_text(text):
-    return ' '.join(text.replace('\n', ' ').replace('\r', ' ').split())
+def language_source(lexicon):
+    if all(lexicon):
+        return "scandi_lid"
+    return "mixed" if any(lexicon) else "glotlid"
+
+def record_keep(label, conf, segments, preds, lexicon):
+    """keep_rules for one record; thresholds only apply to its GlotLID segments.
+
+    A record resolved entirely by the lexicon needs an allowed label; a mixed
+    record also needs its GlotLID segments, aggregated on their own, to pass.
+    """
+    if not any(lexicon):
+        return keep_rules.keep(label, conf)
+    if not keep_rules.allows(label):
+        return False
+    glot = [i for i, lex in enumerate(lexicon) if not lex]
+    return not glot or keep_rules.keep(*aggregate([segments[i] for i in glot], [preds[i] for i in glot]))
 
 def process_batch(lines):
-    global model
     records = [json.loads(line) for line in lines]
 
-    texts = [clean_text(extract_clean_text(rec.get("text", ""))) for rec in records]
-    preds, confs = model.predict(texts)
+    # One predict call over every turn of every record in the batch.
+    record_segments = [split_record(rec) for rec in records]
+    texts = [content for segments in record_segments for _, content in segments]
+    seg_results, new_entries, hits, seg_lexicon = predict_texts(texts)
 
-    for rec, label, conf in zip(records, preds, confs):
-        if "text" in rec:
-            rec["language"] = label[0].replace("__label__", "")
-            rec["language_confidence"] = float(conf[0])
-    return [json.dumps(rec, ensure_ascii=False) for rec in records]
+    kept, rejected = [], []
+    rejected_labels = Counter()
+    pos = 0
+    for rec, segments in zip(records, record_segments):
+        preds = seg_results[pos:pos + len(segments)]
+        lexicon = seg_lexicon[pos:pos + len(segments)]
+        pos += len(segments)
+        label, conf = aggregate(segments, preds)
+        annotated = has_text(rec)
+        if annotated:
+            rec["language"] = label
+            rec["language_confidence"] = conf
+            if use_prefilter:
+                rec["language_source"] = language_source(lexicon)
+            if is_chat_record(rec):
+                rec["language_turns"] = turn_annotations(segments, preds)
+                if use_prefilter:
+                    for turn, lex in zip(rec["language_turns"], lexicon):
+                        turn["source"] = "scandi_lid" if lex else "glotlid"
+        if keep_rules is None or (annotated and record_keep(label, conf, segments, preds, lexicon)):
+            kept.append(json.dumps(rec, ensure_ascii=False))
+        else:
+            rejected.append(json.dumps(rec, ensure_ascii=False))
+            rejected_labels[rec.get("language")] += 1
+    return {
+        "kept": kept,
+        "rejected": rejected,
+        "rejected_labels": rejected_labels,
+        "pid": os.getpid(),
+        "rss": peak_rss_mb(),
+        "new_entries": new_entries,
+        "hits": hits,
+        "prefiltered": sum(seg_lexicon),
+        "segments": len(texts),
+    }
 
 def chunked_iterable(iterable, chunk_size):
-    for i in range(0, len(iterable), chunk_size):
-        yield iterable[i:i + chunk_size]
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def process_file_parallel(pool, input_path: Path, output_path: Path, batch_size=100, max_in_flight=64,
+                          worker_rss=None, cache=None, rejected_path=None):
+    """Stream batches through an existing pool, keeping at most max_in_flight batches queued."""
+    pending = deque()
+    if worker_rss is None:
+        worker_rss = {}
+    total = hits = kept = segments = prefiltered = 0
+    rejected_labels = Counter()
 
-def process_file_parallel(input_path: Path, output_path: Path, batch_size=100):
-    with input_path.open("r", encoding="utf-8") as infile:
-        lines = infile.readlines()
+    with input_path.open("r", encoding="utf-8") as infile, \
+         output_path.open("w", encoding="utf-8") as outfile, \
+         (rejected_path.open("w", encoding="utf-8") if rejected_path else nullcontext()) as rejfile, \
+         tqdm(desc=f"Processing {input_path.name}", unit="line") as bar:
 
-    with Pool(processes=cpu_count(), initializer=init_model) as pool:
-        chunks = list(chunked_iterable(lines, batch_size))
-        with output_path.open("w", encoding="utf-8") as outfile:
-            for processed_batch in tqdm(pool.imap(process_batch, chunks), total=len(chunks), desc=f"Processing {input_path.name}"):
-                outfile.write('\n'.join(processed_batch) + '\n')
+        def write_oldest():
+            nonlocal total, hits, kept, segments, prefiltered
+            result = pending.popleft().get()
+            worker_rss[result["pid"]] = max(result["rss"], worker_rss.get(result["pid"], 0.0))
+            if cache is not None and result["new_entries"]:
+                cache.put_many(result["new_entries"])
+            batch_total = len(result["kept"]) + len(result["rejected"])
+            total += batch_total
+            hits += result["hits"]
+            segments += result["segments"]
+            prefiltered += result["prefiltered"]
+            kept += len(result["kept"])
+            rejected_labels.update(result["rejected_labels"])
+            if result["kept"]:
+                outfile.write('\n'.join(result["kept"]) + '\n')
+            if rejfile is not None and result["rejected"]:
+                rejfile.write('\n'.join(result["rejected"]) + '\n')
+            bar.update(batch_total)
 
-def process_all_files(input_dir: Path, output_dir: Path, batch_size=100):
+        for chunk in chunked_iterable(infile, batch_size):
+            if len(pending) >= max_in_flight:
+                write_oldest()
+            pending.append(pool.apply_async(process_batch, (chunk,)))
+        while pending:
+            write_oldest()
+
+    if use_prefilter:
+        print(f"{input_path.name}: {prefiltered:,}/{segments:,} segments resolved by the lexicon prefilter")
+    if cache is not None:
+        cache.commit()
+        print(f"{input_path.name}: {hits:,}/{segments:,} GlotLID lookups served from cache")
+    if keep_rules is not None:
+        top = ", ".join(f"{label}: {n:,}" for label, n in rejected_labels.most_common(5))
+        print(f"{input_path.name}: kept {kept:,}/{total:,}, rejected {total - kept:,}" + (f" ({top})" if top else ""))
+
+def process_all_files(input_dir: Path, output_dir: Path, batch_size=100, num_workers=None, max_in_flight=None,
+                      cache_file=None, rules=None, rejected_dir=None, prefilter=False):
+    global cache_path, keep_rules, use_prefilter
     input_dir = input_dir.resolve()
     output_dir = output_dir.resolve()
     output_dir.mkdir(parents=True, exist_ok=True)
+    if rejected_dir is not None:
+        rejected_dir = rejected_dir.resolve()
+        rejected_dir.mkdir(parents=True, exist_ok=True)
 
     jsonl_files = sorted(input_dir.glob("*.jsonl"))
     if not jsonl_files:
         print(f"No .jsonl files found in {input_dir}")
         return
 
-    for in_file in jsonl_files:
-        out_file = output_dir / in_file.name
-        process_file_parallel(in_file, out_file, batch_size=batch_size)
+    num_workers = num_workers or cpu_count()
+    max_in_flight = max_in_flight or 4 * num_workers
+
+    # GlotLID is >1 GB. Load it once here and fork the workers afterwards, so the
+    # model pages are shared copy-on-write instead of duplicated in every worker.
+    init_model()
+    print(f"Model loaded in parent (peak RSS {peak_rss_mb():,.0f} MB), forking {num_workers} workers")
+
+    # Workers only read the cache; new predictions are written back here in the parent.
+    cache = None
+    if cache_file is not None:
+        cache = LidCache(cache_file, f"{MODEL_REPO}/{MODEL_FILE}")
+        cache_path = str(cache_file)
+        print(f"Using language-ID cache {cache_file} ({len(cache):,} entries)")
+
+    keep_rules = rules
+    use_prefilter = prefilter
+    if keep_rules is not None:
+        print(f"Filtering: {keep_rules.describe()}")
+
+    worker_rss = {}
+    with get_context("fork").Pool(processes=num_workers) as pool:
+        for in_file in jsonl_files:
+            out_file = output_dir / in_file.name
+            rej_file = rejected_dir / in_file.name if rejected_dir is not None else None
+            process_file_parallel(pool, in_file, out_file, batch_size=batch_size,
+                                  max_in_flight=max_in_flight, worker_rss=worker_rss, cache=cache,
+                                  rejected_path=rej_file)
+
+    if cache is not None:
+        cache.close()
+    report_worker_rss(worker_rss)
+
+def report_worker_rss(worker_rss):
+    # Shared model pages count towards every worker's RSS, so the sum overstates real usage.
+    print("Peak RSS per worker:")
+    for pid, rss in sorted(worker_rss.items()):
+        print(f"  pid {pid}: {rss:,.0f} MB")
 
 def main():
     parser = argparse.ArgumentParser(description="Annotate all JSONL files in a directory with GlotLID language info.")
     parser.add_argument("--input_dir", required=True, help="Directory containing input .jsonl files.")
     parser.add_argument("--output_dir", required=True, help="Directory to save output .jsonl files.")
     parser.add_argument("--batch_size", type=int, default=100, help="Batch size for fastText predictions.")
+    parser.add_argument("--num_workers", type=int, default=cpu_count(), help="Number of worker processes (default: all cores).")
+    parser.add_argument("--max_in_flight", type=int, default=None, help="Max batches queued or in progress at once (default: 4 x workers).")
+    parser.add_argument("--cache_file", type=Path, default=None, help="Persistent sqlite cache of predictions keyed by text hash (reused across runs).")
+    parser.add_argument("--keep_labels", nargs="+", default=None, help="Only write records with these labels, e.g. nob_Latn nno_Latn.")
+    parser.add_argument("--min_confidence", type=float, default=None, help="Only write records with confidence strictly above this value.")
+    parser.add_argument("--language_policy", nargs="+", type=policy_item, default=None, metavar="LABEL=MIN",
+                        help="Per-language thresholds, e.g. nob_Latn=0.99 nno_Latn=0.9 (implies the label is kept).")
+    parser.add_argument("--rejected_dir", type=Path, default=None, help="Write rejected records here (default: only count them).")
+    parser.add_argument("--scandi_prefilter", action="store_true",
+                        help="Resolve clear Bokmål/Nynorsk/Danish/Swedish segments with the lexicon in scandi_lid.py; only the rest go to GlotLID. "
+                             "Records get language_source (glotlid, scandi_lid or mixed); confidence thresholds only apply to GlotLID segments.")
     args = parser.parse_args()
 
-    process_all_files(Path(args.input_dir), Path(args.output_dir), batch_size=args.batch_size)
+    rules = None
+    if args.keep_labels or args.min_confidence is not None or args.language_policy:
+        rules = KeepRules(args.keep_labels, args.min_confidence or 0.0, dict(args.language_policy or []))
+    elif args.rejected_dir is not None:
+        parser.error("--rejected_dir requires --keep_labels, --min_confidence or --language_policy")
+
+    process_all_files(Path(args.input_dir), Path(args.output_dir), batch_size=args.batch_size,
+                      num_workers=args.num_workers, max_in_flight=args.max_in_flight,
+                      cache_file=args.cache_file, rules=rules, rejected_dir=args.rejected_dir,
+                      prefilter=args.scandi_prefilter)
 
 if __name__ == "__main__":
     main()
@@ -5,54 +5,39 @@ import json
 import fasttext
 from tqdm import tqdm
 from huggingface_hub import hf_hub_download
-import re
 
-# Regular expressions for tag-based extraction
-USER_PATTERN = re.compile(
-    r"<\|start_header_id\|>user<\|end_header_id\|>\n\n(.*?)<\|eot_id\|>",
-    re.DOTALL
-)
-ASSISTANT_PATTERN = re.compile(
-    r"<\|start_header_id\|>assistant<\|end_header_id\|>\n\n(.*?)<\|eot_id\|>",
-    re.DOTALL
-)
+from lid_segments import aggregate, is_chat_record, split_record, turn_annotations
 
-def extract_clean_text(text: str) -> str:
-    if "<|start_header_id|>user<|end_header_id|>" in text and "<|start_header_id|>assistant<|end_header_id|>" in text:
-        user_match = USER_PATTERN.search(text)
-        assistant_match = ASSISTANT_PATTERN.search(text)
-        user_text = user_match.group(1).strip() if user_match else ""
-        assistant_text = assistant_match.group(1).strip() if assistant_match else ""
-        return f"{user_text}\n{assistant_text}".strip()
-    else:
-        return text.strip()
+def detect_languages(model, records):
+    """Return [(label, conf, turns)] per record; turns is None for non-chat records."""
+    text_segments = [split_record(rec) for rec in records]
+    flat = [content for segments in text_segments for _, content in segments]
+    preds, confs = model.predict(flat)
+    seg_preds = [(label[0].replace("__label__", ""), float(conf[0])) for label, conf in zip(preds, confs)]
 
-def clean_text(text: str) -> str:
-    return ' '.join(text.replace('\n', ' ').replace('\r', ' ').split())
-
-def detect_languages(model, texts):
-    cleaned_texts = [clean_text(extract_clean_text(text)) for text in texts]
-    preds, confs = model.predict(cleaned_texts)
-    return [
-        (label[0].replace("__label__", ""), float(conf[0]))
-        for label, conf in zip(preds, confs)
-    ]
+    results = []
+    pos = 0
+    for rec, segments in zip(records, text_segments):
+        p = seg_preds[pos:pos + len(segments)]
+        pos += len(segments)
+        lang, conf = aggregate(segments, p)
+        results.append((lang, conf, turn_annotations(segments, p) if is_chat_record(rec) else None))
+    return results
 
 def process_file(input_file, output_file, model, batch_size=100):
     with open(input_file, 'r', encoding='utf-8') as infile:
         lines = infile.readlines()
 
     records = [json.loads(line) for line in lines]
-    all_texts = [rec.get("text", "") for rec in records]
-
     output_lines = []
 
     for i in tqdm(range(0, len(records), batch_size), desc="Processing lines"):
-        batch = all_texts[i:i + batch_size]
-        batch_preds = detect_languages(model, batch)
-        for rec, (lang, conf) in zip(records[i:i + batch_size], batch_preds):
+        batch_preds = detect_languages(model, records[i:i + batch_size])
+        for rec, (lang, conf, turns) in zip(records[i:i + batch_size], batch_preds):
             rec["language"] = lang
             rec["language_confidence"] = conf
+            if turns is not None:
+                rec["language_turns"] = turns
             output_lines.append(json.dumps(rec, ensure_ascii=False))
 
     with open(output_file, 'w', encoding='utf-8') as outfile:
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+bench_segments.py
+
+Speed and agreement of common.chat_render.segment_llama3 against the regex
+and find() parsers it replaced, on a real Llama-3 formatted JSONL file.
+
+    lid    user/assistant turns for GlotLID  (lid_segments.split_segments
+           vs. the old TURN_PATTERN.findall)
+    dedup  user/assistant pairs for MinHash  (run_sem_dedup.extract_user_assistant
+           vs. the old lazy DOTALL pair regex)
+    play   system prompt swap                (process_play.swap_prompt
+           vs. the old find() loop)
+
+The old implementations are kept below verbatim. For every task the report
+has the time per pass (median over --repeats), MB/s, the speed-up and the
+number of records where old and new output differ; --show_diffs prints the
+first differing records. A task whose stage cannot be imported (datasketch
+or transformers missing) is skipped.
+
+Usage
+-----
+    python bench_segments.py --input_file ../6c_cleaned_glotlid_semdedup/train_play_llama3.jsonl [--limit 100000]
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import json
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# -------------------------------------------------------------------------
+# Old implementations (as they were before segment_llama3)
+# -------------------------------------------------------------------------
+OLD_TURN_PATTERN = re.compile(
+    r"<\|start_header_id\|>(user|assistant)<\|end_header_id\|>\n\n(.*?)<\|eot_id\|>",
+    re.DOTALL
+)
+OLD_PAIR_PATTERN = re.compile(r"<\|start_header_id\|>user<\|end_header_id\|>(.*?)<\|eot_id\|>\s*<\|start_header_id\|>assistant<\|end_header_id\|>(.*?)<\|eot_id\|>", re.DOTALL)
+OLD_START_TAG = "<|start_header_id|>system<|end_header_id|>"
+OLD_EOT_TAG = "<|eot_id|>"
+
+
+def clean_text(text: str) -> str:
+    return ' '.join(text.replace('\n', ' ').replace('\r', ' ').split())
+
+
+def old_split_segments(text: str) -> List[Tuple[str, str]]:
+    if "<|start_header_id|>user<|end_header_id|>" in text and "<|start_header_id|>assistant<|end_header_id|>" in text:
+        turns = [(role, clean_text(content)) for role, content in OLD_TURN_PATTERN.findall(text)]
+        turns = [(role, content) for role, content in turns if content]
+        if turns:
+            return turns
+    return [("text", clean_text(text))]
+
+
+def old_extract_user_assistant(text: str) -> str:
+    matches = OLD_PAIR_PATTERN.findall(text)
+    return "\n\n".join([q.strip() + "\n" + a.strip() for q, a in matches]) if matches else text
+
+
+def old_swap_prompt(text: str, new_prompt: Optional[str]) -> Optional[str]:
+    start = text.find(OLD_START_TAG)
+    if start == -1:
+        return None
+    start += len(OLD_START_TAG)
+    end = text.find(OLD_EOT_TAG, start)
+    if end == -1:
+        return None
+    if new_prompt is None:
+        return text
+    return text[:start] + "\n\n" + new_prompt.strip() + text[end:]
+
+
+# -------------------------------------------------------------------------
+# Current implementations
+# -------------------------------------------------------------------------
+def load_stage(directory: str, module: str, attribute: str) -> Optional[Callable]:
+    sys.path.insert(0, str(ROOT / directory))
+    try:
+        return getattr(importlib.import_module(module), attribute)
+    except ImportError as exc:
+        print(f"Skipping {module}.{attribute}: {exc}")
+        return None
+    finally:
+        sys.path.pop(0)
+
+
+def tasks(prompt: str) -> Dict[str, Tuple[Callable, Optional[Callable]]]:
+    """name -> (old fn(text), new fn(text) or None if the stage is not importable)."""
+    split_segments = load_stage("5a_cleaned_noglotlid", "lid_segments", "split_segments")
+    extract = load_stage("5b_cleaned_glotlid", "run_sem_dedup", "extract_user_assistant")
+    swap = load_stage("3h_playwithwords", "process_play", "swap_prompt")
+    return {
+        "lid": (old_split_segments, split_segments),
+        "dedup": (old_extract_user_assistant, extract),
+        "play": (lambda text: old_swap_prompt(text, prompt), swap and (lambda text: swap(text, prompt))),
+    }
+
+
+def load_texts(path: Path, limit: Optional[int]) -> List[str]:
+    texts: List[str] = []
+    with path.open(encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                text = json.loads(line).get("text")
+            except (json.JSONDecodeError, AttributeError):
+                continue
+            if isinstance(text, str):
+                texts.append(text)
+                if limit and len(texts) >= limit:
+                    break
+    return texts
+
+
+def time_pass(fn: Callable, texts: List[str], repeats: int) -> Tuple[float, list]:
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        out = [fn(text) for text in texts]
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times), out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark segment_llama3 against the old Llama-3 regex parsers.")
+    parser.add_argument("--input_file", type=Path, required=True, help="Llama-3 formatted JSONL file (id + text).")
+    parser.add_argument("--limit", type=int, default=None, help="Only read the first N records.")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed passes per parser (median is reported).")
+    parser.add_argument("--system_prompt", default="Du er en hjelpsom assistent.", help="Prompt for the play task.")
+    parser.add_argument("--show_diffs", type=int, default=0, help="Print up to N records where old and new differ.")
+    args = parser.parse_args()
+
+    texts = load_texts(args.input_file, args.limit)
+    megabytes = sum(len(t.encode("utf-8")) for t in texts) / 1e6
+    print(f"{len(texts):,} records, {megabytes:,.1f} MB from {args.input_file.name}\n")
+    print(f"{'task':<6} {'old s':>9} {'new s':>9} {'new MB/s':>9} {'speed-up':>9} {'differ':>8}")
+
+    for name, (old_fn, new_fn) in tasks(args.system_prompt).items():
+        if new_fn is None:
+            continue
+        old_time, old_out = time_pass(old_fn, texts, args.repeats)
+        new_time, new_out = time_pass(new_fn, texts, args.repeats)
+        diffs = [i for i, (a, b) in enumerate(zip(old_out, new_out)) if a != b]
+        print(f"{name:<6} {old_time:>9.3f} {new_time:>9.3f} {megabytes / new_time:>9.1f} "
+              f"{old_time / new_time:>8.2f}x {len(diffs):>8,}")
+        for i in diffs[:args.show_diffs]:
+            print(f"  record {i}:\n    old: {old_out[i]!r:.300}\n    new: {new_out[i]!r:.300}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+lid_cache.py
+
+Persistent, content-addressed cache of GlotLID predictions.
+
+Keys are a 16-byte BLAKE2b hash of the model id plus the normalized text that
+is passed to `model.predict`, so the same question seen in a *_best file, its
+aug1 variant and its _llama3 chat version is only predicted once. Values are
+the label (without "__label__") and the confidence.
+
+The table lives in a single sqlite file in WAL mode: one writer (the parent
+process) and any number of read-only connections (the pool workers).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+from typing import Dict, Iterable, List, Tuple
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER on older sqlite builds.
+_LOOKUP_CHUNK = 500
+
+
+class LidCache:
+    """sqlite-backed hash table: text hash -> (label, confidence)."""
+
+    def __init__(self, path: str, model_id: str, readonly: bool = False) -> None:
+        self.path = str(path)
+        self.model_id = model_id
+        self._salt = model_id.encode("utf-8") + b"\0"
+        if readonly:
+            self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        else:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lid ("
+                " key BLOB PRIMARY KEY,"
+                " label TEXT NOT NULL,"
+                " confidence REAL NOT NULL"
+                ") WITHOUT ROWID"
+            )
+            self._conn.commit()
+
+    def key(self, text: str) -> bytes:
+        return hashlib.blake2b(self._salt + text.encode("utf-8"), digest_size=16).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, Tuple[str, float]]:
+        found: Dict[bytes, Tuple[str, float]] = {}
+        unique = list(set(keys))
+        for i in range(0, len(unique), _LOOKUP_CHUNK):
+            part = unique[i:i + _LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(part))
+            rows = self._conn.execute(
+                f"SELECT key, label, confidence FROM lid WHERE key IN ({placeholders})", part
+            )
+            for key, label, conf in rows:
+                found[key] = (label, conf)
+        return found
+
+    def put_many(self, entries: Iterable[Tuple[bytes, str, float]]) -> None:
+        self._conn.executemany("INSERT OR REPLACE INTO lid VALUES (?, ?, ?)", entries)
+
+    def commit(self) -> None:
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM lid").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.commit()
+        self._conn.close()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+lid_segments.py
+
+Split records into the segments that are language-identified separately and
+combine the per-segment predictions again.
+
+Llama-3 chat records are split into one segment per user/assistant turn
+(common.chat_render.segment_llama3; the system prompt is skipped, it is the
+same English boilerplate everywhere);
+everything else is a single segment. Records stored as structured
+"messages" (--emit_messages) are split on their user/assistant messages
+directly. The record label is the one with the largest character-weighted
+confidence over its segments.
+"""
+
+from __future__ import annotations
+
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import record_messages, segment_llama3
+
+TURN_ROLES = ("user", "assistant")
+
+
+def clean_text(text: str) -> str:
+    return ' '.join(text.replace('\n', ' ').replace('\r', ' ').split())
+
+
+def is_chat(text: str) -> bool:
+    return "<|start_header_id|>user<|end_header_id|>" in text and "<|start_header_id|>assistant<|end_header_id|>" in text
+
+
+def split_segments(text: str) -> List[Tuple[str, str]]:
+    """Return [(role, cleaned_text)]; role is "text" for non-chat records."""
+    if is_chat(text):
+        turns = [(role, clean_text(text[start:end])) for role, start, end in segment_llama3(text)
+                 if role in TURN_ROLES]
+        turns = [(role, content) for role, content in turns if content]
+        if turns:
+            return turns
+    return [("text", clean_text(text))]
+
+
+def has_text(rec: dict) -> bool:
+    """True if the record has something to identify ("text" or structured "messages")."""
+    return "text" in rec or record_messages(rec) is not None
+
+
+def is_chat_record(rec: dict) -> bool:
+    messages = record_messages(rec)
+    if messages is None:
+        text = rec.get("text")
+        return isinstance(text, str) and is_chat(text)
+    roles = {m["role"] for m in messages}
+    return "user" in roles and "assistant" in roles
+
+
+def split_record(rec: dict) -> List[Tuple[str, str]]:
+    """split_segments() for a record, reading the turns of "messages" records directly."""
+    messages = record_messages(rec)
+    if messages is None:
+        return split_segments(rec.get("text", ""))
+    turns = [(m["role"], clean_text(m["content"])) for m in messages if m["role"] in TURN_ROLES]
+    turns = [(role, content) for role, content in turns if content]
+    return turns or [("text", clean_text(" ".join(m["content"] for m in messages)))]
+
+
+def aggregate(segments: List[Tuple[str, str]], preds: List[Tuple[str, float]]) -> Tuple[str, float]:
+    """Character-weighted vote: score(label) = sum(chars * conf) / total chars."""
+    if len(preds) == 1:
+        return preds[0]
+    scores: Dict[str, float] = defaultdict(float)
+    total = 0
+    for (_, content), (label, conf) in zip(segments, preds):
+        chars = max(len(content), 1)
+        scores[label] += chars * conf
+        total += chars
+    label = max(scores, key=scores.get)
+    return label, scores[label] / total
+
+
+def turn_annotations(segments: List[Tuple[str, str]], preds: List[Tuple[str, float]]) -> List[dict]:
+    return [
+        {"role": role, "language": label, "confidence": conf, "chars": len(content)}
+        for (role, content), (label, conf) in zip(segments, preds)
+    ]
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+scandi_lid.py
+
+Cheap lexicon-based Bokmål / Nynorsk / Danish / Swedish discriminator, used as
+a prefilter in front of GlotLID.
+
+Every text is scored against a compiled table of marker words (function words
+and frequent spellings that differ between the varieties) plus character
+n-grams (ä/ö vs. æ/ø, -sjon/-tion, -het/-heit/-hed, definite plurals, ...).
+A text is only resolved when it has enough marker hits and one variety
+clearly dominates; everything else (too short, mixed, English, other
+languages) is deferred to GlotLID.
+
+Scores work like a naive-Bayes log-likelihood: a marker word unique to one
+variety adds one unit to it, a word shared by k varieties adds 1/k to each,
+and n-grams add a quarter of that. Each distinct word's contribution is
+computed once (word_vector), and a batch is scored as one array operation
+over its vocabulary. The confidence is softmax(ALPHA * scores) for the
+winner, so a lead of a few unique marker words is needed to pass the default
+0.99. Labels are returned in GlotLID format ("nob_Latn", ...).
+
+The confidence is the lexicon's own and is not calibrated against GlotLID's;
+annotate_multi_glotlid.py marks lexicon-resolved records (language_source)
+and does not apply GlotLID confidence thresholds to those segments. The
+evaluation below prints agreement per confidence band for picking
+--min_confidence.
+
+Usage (agreement with GlotLID on a held-out file + speedup)
+-----
+    python scandi_lid.py --input_file held_out.jsonl [--limit 100000]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import time
+from collections import Counter
+from functools import lru_cache
+from itertools import chain
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from lid_segments import split_record
+
+LANGS = ("nob_Latn", "nno_Latn", "dan_Latn", "swe_Latn", "eng_Latn")
+NOB, NNO, DAN, SWE, ENG = range(len(LANGS))
+
+# word -> varieties where it is a normal spelling. A word shared by k varieties
+# contributes 1/k to each of them.
+_MARKERS = {
+    # personal pronouns
+    "jeg": (NOB, DAN), "eg": (NNO,), "jag": (SWE,),
+    "meg": (NOB, NNO), "deg": (NOB, NNO), "mig": (DAN, SWE), "dig": (DAN, SWE), "sig": (DAN, SWE),
+    "hun": (NOB, DAN), "ho": (NNO,), "hon": (SWE,),
+    "dere": (NOB,), "de": (NOB, DAN, SWE), "dei": (NNO,), "dem": (NOB, DAN, SWE),
+    # negation, question words
+    "ikke": (NOB, DAN), "ikkje": (NNO,), "inte": (SWE,), "icke": (SWE,),
+    "hva": (NOB,), "kva": (NNO,), "hvad": (DAN,), "vad": (SWE,),
+    "hvordan": (NOB, DAN), "korleis": (NNO,), "hur": (SWE,),
+    "hvorfor": (NOB, DAN), "kvifor": (NNO,), "varför": (SWE,),
+    "hvor": (NOB, DAN), "var": (NOB, NNO, DAN, SWE),
+    "hvem": (NOB, DAN), "kven": (NNO,), "vem": (SWE,),
+    "hvis": (NOB, DAN), "dersom": (NOB, NNO), "om": (NOB, NNO, DAN, SWE),
+    # quantifiers, determiners
+    "noen": (NOB,), "nokon": (NNO,), "nokre": (NNO,), "nogen": (DAN,), "nogle": (DAN,),
+    "någon": (SWE,), "några": (SWE,), "något": (SWE,),
+    "mye": (NOB,), "mykje": (NNO,), "meget": (DAN,), "mycket": (SWE,),
+    "mange": (NOB, NNO, DAN), "många": (SWE,),
+    "andre": (NOB, NNO, DAN), "andra": (SWE,),
+    "ein": (NNO,), "eit": (NNO,), "ei": (NOB, NNO), "et": (NOB, DAN), "ett": (SWE,),
+    "dette": (NOB, NNO, DAN), "detta": (SWE,), "disse": (NOB, DAN), "desse": (NNO,), "dessa": (SWE,),
+    "selv": (NOB, DAN), "sjølv": (NNO,), "själv": (SWE,),
+    # conjunctions, prepositions, adverbs
+    "og": (NOB, NNO, DAN), "och": (SWE,),
+    "at": (NOB, NNO, DAN), "att": (SWE,),
+    "til": (NOB, NNO, DAN), "till": (SWE,),
+    "fra": (NOB, DAN), "frå": (NNO,), "från": (SWE,),
+    "for": (NOB, NNO, DAN), "för": (SWE,),
+    "av": (NOB, NNO, SWE), "af": (DAN,),
+    "etter": (NOB, NNO), "efter": (DAN, SWE),
+    "mellom": (NOB, NNO), "mellem": (DAN,), "mellan": (SWE,),
+    "gjennom": (NOB, NNO), "gennem": (DAN,), "genom": (SWE,),
+    "enn": (NOB, NNO), "end": (DAN,), "än": (SWE,),
+    "ut": (NOB, NNO, SWE), "ud": (DAN,), "opp": (NOB, NNO), "op": (DAN,), "upp": (SWE,),
+    "også": (NOB, NNO, DAN), "òg": (NNO,), "också": (SWE,),
+    "bare": (NOB, DAN), "berre": (NNO,), "bara": (SWE,),
+    "nå": (NOB,), "no": (NNO,), "nu": (DAN, SWE),
+    "her": (NOB, NNO, DAN), "här": (SWE,), "der": (NOB, NNO, DAN), "där": (SWE,),
+    "da": (NOB, DAN), "då": (NNO, SWE),
+    "sammen": (NOB, DAN), "saman": (NNO,), "tillsammans": (SWE,),
+    "hjem": (NOB, DAN), "heim": (NNO,), "hem": (SWE,),
+    "veldig": (NOB,), "svært": (NOB, NNO), "meir": (NNO,), "mer": (NOB, SWE), "mere": (DAN,),
+    # verbs
+    "er": (NOB, NNO, DAN), "är": (SWE,),
+    "være": (NOB, DAN), "vere": (NNO,), "vera": (NNO,), "vara": (SWE,),
+    "ble": (NOB,), "blei": (NNO,), "vart": (NNO, SWE), "blev": (DAN, SWE),
+    "blir": (NOB, NNO), "bliver": (DAN,), "blive": (DAN,), "bli": (NOB, NNO), "bliva": (SWE,),
+    "hadde": (NOB, NNO), "havde": (DAN,), "hade": (SWE,),
+    "gjør": (NOB,), "gjer": (NNO,), "gør": (DAN,), "gör": (SWE,),
+    "gjøre": (NOB,), "gjere": (NNO,), "gøre": (DAN,), "göra": (SWE,),
+    "kunne": (NOB, NNO, DAN), "kunde": (SWE,),
+    "skal": (NOB, NNO, DAN), "ska": (SWE,), "skall": (SWE,),
+    "vil": (NOB, NNO, DAN), "vill": (SWE,),
+    "sier": (NOB,), "seier": (NNO,), "siger": (DAN,), "säger": (SWE,),
+    # English guard: an English winner is always deferred to GlotLID
+    "the": (ENG,), "and": (ENG,), "is": (ENG,), "of": (ENG,), "to": (ENG,), "that": (ENG,),
+    "with": (ENG,), "this": (ENG,), "are": (ENG,), "you": (ENG,), "what": (ENG,), "which": (ENG,),
+}
+
+# character n-grams -> varieties; a space marks a word boundary (" hv" starts a
+# word, "ene " ends one). Spelling and inflection patterns that separate the
+# varieties on words the marker list does not cover.
+_NGRAMS = {
+    # letters
+    "ä": (SWE,), "ö": (SWE,), "æ": (NOB, NNO, DAN), "ø": (NOB, NNO, DAN), "ò": (NNO,),
+    "ck": (SWE,), "w": (ENG,), "th": (ENG,), "wh": (ENG,),
+    # spelling: arbeid/arbejde, høy/høj, hvordan/korleis, haust/høst
+    "ei": (NOB, NNO), "ej": (DAN, SWE), "øy": (NOB, NNO), "øj": (DAN,), " hv": (NOB, DAN), "au": (NNO,),
+    # suffixes: stasjon/station, -het/-heit/-hed, -lig/-leg, -ighet/-ighed
+    "sjon": (NOB, NNO), "tion": (DAN, SWE, ENG), "het ": (NOB, SWE), "heit ": (NNO,), "hed ": (DAN,),
+    "lig ": (NOB, DAN, SWE), "leg ": (NNO,), "lege ": (NNO,), "igt ": (DAN, SWE), "ough": (ENG,), "ly ": (ENG,),
+    # inflection: definite plurals, past tense, present tense, ikkje/mykje
+    "ene ": (NOB, NNO), "ane ": (NNO,), "erne ": (DAN,), "erna ": (SWE,), "arna ": (SWE,), "orna ": (SWE,),
+    "ede ": (DAN,), "ade ": (SWE,), "ar ": (NNO, SWE), "kje ": (NNO,),
+}
+_NGRAM_WEIGHT = 0.25  # per occurrence, relative to a whole marker word
+LETTERS = "a-zæøåäöò"
+
+
+def _compile(table, weight=1.0):
+    """Keys and (keys x varieties) weight matrix; a key shared by k varieties gives weight/k to each."""
+    keys = list(table)
+    matrix = np.zeros((len(keys), len(LANGS)))
+    for row, key in enumerate(keys):
+        for lang in table[key]:
+            matrix[row, lang] = weight / len(table[key])
+    return keys, matrix
+
+
+def _ngram_pattern(gram: str) -> str:
+    body = re.escape(gram.strip())
+    if gram.startswith(" "):
+        body = f"(?<![{LETTERS}]){body}"
+    if gram.endswith(" "):
+        body = f"{body}(?![{LETTERS}])"
+    return body
+
+
+WORDS, WORD_WEIGHTS = _compile(_MARKERS)
+NGRAMS, NGRAM_WEIGHTS = _compile(_NGRAMS, _NGRAM_WEIGHT)
+WORD_ID = {word: i for i, word in enumerate(WORDS)}
+NGRAM_ID = {gram.strip(): i for i, gram in enumerate(NGRAMS)}
+# A lookahead, so overlapping n-grams all count; longest alternatives first.
+NGRAM_RE = re.compile(f"(?=({'|'.join(_ngram_pattern(g) for g in sorted(NGRAMS, key=len, reverse=True))}))")
+WORD_RE = re.compile(f"[{LETTERS}]+")
+ALPHA = 1.5  # log-odds per unit of marker score
+
+
+@lru_cache(maxsize=1 << 18)
+def word_vector(word: str) -> Tuple[float, ...]:
+    """Scores one occurrence of `word` adds to each variety, then 1.0 if it is a marker word."""
+    vec = np.zeros(len(LANGS) + 1)
+    marker = WORD_ID.get(word)
+    if marker is not None:
+        vec[:-1] += WORD_WEIGHTS[marker]
+        vec[-1] = 1.0
+    for m in NGRAM_RE.finditer(word):
+        vec[:-1] += NGRAM_WEIGHTS[NGRAM_ID[m.group(1)]]
+    return tuple(vec)
+
+
+def score_batch(texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """(texts x varieties) scores and marker-word hits per text.
+
+    Every word occurrence in the batch is mapped to a row of the batch
+    vocabulary's (words x varieties) table, and the rows of each text are
+    summed with one reduceat over the whole batch.
+    """
+    words = [WORD_RE.findall(text.lower()) for text in texts]
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    vocab: dict = {}
+    ids = np.fromiter((vocab.setdefault(w, len(vocab)) for w in chain.from_iterable(words)),
+                      dtype=np.int64, count=int(lengths.sum()))
+    sums = np.zeros((len(texts), len(LANGS) + 1))
+    if len(ids):
+        table = np.array([word_vector(w) for w in vocab])
+        nonempty = lengths > 0
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        sums[nonempty] = np.add.reduceat(table[ids], offsets[nonempty], axis=0)
+    return sums[:, :-1], sums[:, -1].astype(np.int64)
+
+
+def classify_batch(texts: List[str], min_hits: int = 5, min_confidence: float = 0.99) -> List[Optional[Tuple[str, float]]]:
+    """(label, confidence) for texts a Scandinavian variety clearly wins, None for texts to defer."""
+    if not texts:
+        return []
+    scores, hits = score_batch(texts)
+    best = scores.argmax(axis=1)
+    conf = 1.0 / np.exp(ALPHA * (scores - scores.max(axis=1, keepdims=True))).sum(axis=1)
+    resolved = (hits >= min_hits) & (best != ENG) & (conf >= min_confidence)
+    return [(LANGS[b], float(c)) if ok else None for b, c, ok in zip(best.tolist(), conf.tolist(), resolved.tolist())]
+
+
+# -------------------------------------------------------------------------
+# Evaluation against GlotLID
+# -------------------------------------------------------------------------
+CONFIDENCE_BANDS = (0.99999, 0.9999, 0.999, 0.99, 0.0)
+
+
+def load_segments(path: str, limit: Optional[int]) -> List[str]:
+    texts: List[str] = []
+    with open(path, "r", encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            texts.extend(content for _, content in split_record(rec))
+            if limit and len(texts) >= limit:
+                return texts[:limit]
+    return texts
+
+
+def evaluate(texts: List[str], min_hits: int, min_confidence: float, batch_size: int) -> None:
+    import fasttext
+    from huggingface_hub import hf_hub_download
+
+    model = fasttext.load_model(hf_hub_download(repo_id="cis-lmu/glotlid", filename="model.bin"))
+
+    t0 = time.perf_counter()
+    lex = []
+    for i in range(0, len(texts), batch_size):
+        lex.extend(classify_batch(texts[i:i + batch_size], min_hits, min_confidence))
+    lex_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    glot = []
+    for i in range(0, len(texts), batch_size):
+        preds, _ = model.predict(texts[i:i + batch_size])
+        glot.extend(p[0].replace("__label__", "") for p in preds)
+    glot_time = time.perf_counter() - t0
+
+    deferred = [i for i, r in enumerate(lex) if r is None]
+    t0 = time.perf_counter()
+    for i in range(0, len(deferred), batch_size):
+        model.predict([texts[j] for j in deferred[i:i + batch_size]])
+    deferred_time = time.perf_counter() - t0
+
+    resolved = [(r[0], glot[i]) for i, r in enumerate(lex) if r is not None]
+    agree = sum(1 for a, b in resolved if a == b)
+    confusion = Counter(resolved)
+    bands = Counter()
+    for i, r in enumerate(lex):
+        if r is not None:
+            band = next(b for b in CONFIDENCE_BANDS if r[1] >= b)
+            bands[band, r[0] == glot[i]] += 1
+
+    print(f"Segments:  {len(texts):,}")
+    print(f"Resolved:  {len(resolved):,} ({len(resolved) / max(len(texts), 1):.1%}), deferred {len(deferred):,}")
+    print(f"Agreement with GlotLID on resolved: {agree:,}/{len(resolved):,} ({agree / max(len(resolved), 1):.2%})")
+    print("Lexicon label -> GlotLID label:")
+    for (a, b), n in confusion.most_common(15):
+        print(f"  {a:9s} -> {b:9s} {n:,}")
+    print("Agreement by lexicon confidence:")
+    for band in CONFIDENCE_BANDS:
+        n = bands[band, True] + bands[band, False]
+        if n:
+            print(f"  >= {band:<8g} {bands[band, True] / n:.2%} of {n:,}")
+    cascade = lex_time + deferred_time
+    print(f"GlotLID only: {glot_time:.2f}s  |  lexicon {lex_time:.2f}s + GlotLID on deferred {deferred_time:.2f}s")
+    print(f"Speedup: {glot_time / cascade:.2f}x" if cascade > 0 else "Speedup: n/a")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Evaluate the Scandinavian lexicon prefilter against GlotLID on a held-out JSONL file.")
+    parser.add_argument("--input_file", required=True, help="Held-out JSONL file with a 'text' field.")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N segments.")
+    parser.add_argument("--min_hits", type=int, default=5, help="Marker words required before a text can be resolved.")
+    parser.add_argument("--min_confidence", type=float, default=0.99, help="Lexicon confidence required to resolve a text.")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Batch size for both classifiers.")
+    args = parser.parse_args()
+
+    texts = load_segments(args.input_file, args.limit)
+    evaluate(texts, args.min_hits, args.min_confidence, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,13 @@ count lines and tokens per file (tokens counted **only** in the `"text"` field
 of each JSON line) using a specified tokenizer, and output a neatly-formatted
 Markdown table.
 
-✓ Uses nested tqdm progress bars: one for files, one for lines inside each file.  
+✓ Batched encoding; files are split into byte ranges counted by --num_workers processes.  
 ✓ Defaults to the meta-llama/Llama-3.1-8B-Instruct tokenizer.  
 ✓ Debug logging switch (--debug).
 
 Usage
 -----
-    python stats.py [--folder <path>] [--tokenizer <model-name>] [--debug]
+    python stats.py [--folder <path>] [--tokenizer <model-name>] [--num_workers N] [--debug]
 
 Example
 -------
@@ -23,13 +23,14 @@ Example
 from __future__ import annotations
 
 import argparse
-import json
 import logging
+import os
+import sys
 from pathlib import Path
-from typing import Iterable, List
+from typing import List
 
-from tqdm import tqdm
-from transformers import AutoTokenizer
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.token_counting import count_files
 
 
 class FileStats:
@@ -59,6 +60,12 @@ def parse_args() -> argparse.Namespace:
         default="meta-llama/Llama-3.1-8B-Instruct",
         help="Hugging Face tokenizer to use.",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes (default: all cores).",
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -72,44 +79,14 @@ def init_logging(debug: bool) -> None:
     logging.basicConfig(level=level, format="%(asctime)s - %(levelname)s - %(message)s")
 
 
-def safe_json_parse(line: str, file_name: str, line_no: int) -> dict | None:
-    try:
-        return json.loads(line)
-    except json.JSONDecodeError as err:
-        logging.warning("JSON error in %s line %d: %s", file_name, line_no, err)
-        return None
-
-
-def iter_jsonl(path: Path) -> Iterable[tuple[str, int]]:
-    """Yield (text, line_number) tuples from JSON-Lines file; skip malformed rows."""
-    with path.open("r", encoding="utf-8") as fp:
-        for i, raw in enumerate(fp, start=1):
-            obj = safe_json_parse(raw, path.name, i)
-            if obj and isinstance(obj.get("text"), str):
-                yield obj["text"], i
-            else:
-                logging.debug("Missing 'text' in %s line %d – skipped", path.name, i)
-
-
-def count_file_stats(path: Path, tokenizer) -> FileStats:
-    """Count lines and tokens (in the 'text' field) for one file."""
-    total_lines = 0
-    total_tokens = 0
-
-    for text, _ in tqdm(iter_jsonl(path), desc=path.name, leave=False):
-        total_lines += 1
-        total_tokens += len(tokenizer.encode(text, add_special_tokens=False))
-
-    logging.debug("Processed %s: %s lines, %s tokens", path.name, total_lines, total_tokens)
-    return FileStats(path.name, total_lines, total_tokens)
-
-
-def gather_stats(folder: Path, tokenizer) -> List[FileStats]:
+def gather_stats(folder: Path, tokenizer_name: str, num_workers: int) -> List[FileStats]:
     files = sorted(folder.glob("*.jsonl"))
-    stats: List[FileStats] = []
+    counts = count_files(files, tokenizer_name, num_workers=num_workers)
 
-    for file_path in tqdm(files, desc="Files", unit="file"):
-        stats.append(count_file_stats(file_path, tokenizer))
+    stats: List[FileStats] = []
+    for file_path, c in zip(files, counts):
+        logging.debug("Processed %s: %s lines, %s tokens (%s malformed)", file_path.name, c.text_lines, c.tokens, c.malformed)
+        stats.append(FileStats(file_path.name, c.text_lines, c.tokens))
 
     return stats
 
@@ -146,9 +123,8 @@ def main() -> None:
         raise SystemExit(1)
 
     logging.info("Scanning folder: %s", folder)
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=True)
 
-    statistics = gather_stats(folder, tokenizer)
+    statistics = gather_stats(folder, args.tokenizer, args.num_workers)
 
     if not statistics:
         logging.warning("No *.jsonl files found in %s", folder)
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 import argparse
 import json
-import re
+import sys
+from pathlib import Path
 from datasketch import MinHash, MinHashLSH
 from tqdm import tqdm
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import record_messages, segment_llama3
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Deduplicate a JSONLines corpus using MinHash and datasketch.")
@@ -17,11 +21,24 @@ def parse_args():
 
 
 def extract_user_assistant(text):
-    pattern = re.compile(r"<\|start_header_id\|>user<\|end_header_id\|>(.*?)<\|eot_id\|>\s*<\|start_header_id\|>assistant<\|end_header_id\|>(.*?)<\|eot_id\|>", re.DOTALL)
-    matches = pattern.findall(text)
+    segments = segment_llama3(text)
+    matches = [(text[q0:q1], text[a0:a1]) for (q, q0, q1), (a, a0, a1) in zip(segments, segments[1:])
+               if q == "user" and a == "assistant"]
     return "\n\n".join([q.strip() + "\n" + a.strip() for q, a in matches]) if matches else text
 
 
+def dedup_content(doc):
+    """The user/assistant pairs of a record, read from "messages" when it has them."""
+    messages = record_messages(doc)
+    if messages is None:
+        return extract_user_assistant(doc['text'])
+    pairs = [(q["content"], a["content"]) for q, a in zip(messages, messages[1:])
+             if q["role"] == "user" and a["role"] == "assistant"]
+    if not pairs:
+        return "\n\n".join(m["content"] for m in messages)
+    return "\n\n".join([q.strip() + "\n" + a.strip() for q, a in pairs])
+
+
 def get_minhash(text, num_perm):
     m = MinHash(num_perm=num_perm)
     for word in text.split():
@@ -42,14 +59,14 @@ def main():
 
     print("Indexing and deduplicating...")
     for i, doc in tqdm(enumerate(documents), total=len(documents)):
-        content = extract_user_assistant(doc['text'])
+        content = dedup_content(doc)
         m = get_minhash(content, args.num_perm)
         duplicates = lsh.query(m)
         if duplicates:
             keep_flags[i] = False
             if len(duplicate_examples) < args.show_examples:
                 ref_idx = int(duplicates[0].split('_')[1])
-                ref_content = extract_user_assistant(documents[ref_idx]['text'])
+                ref_content = dedup_content(documents[ref_idx])
                 duplicate_examples.append((ref_content, content))
         else:
             lsh.insert(f"doc_{i}", m)
@@ -1,24 +1,14 @@
 import argparse
 import json
+import math
 import random
-from tqdm import tqdm
 import sys
 import os # For input_file basename
+from pathlib import Path
 
-from transformers import AutoTokenizer
-from huggingface_hub.utils import HfHubHTTPError
-
-try:
-    from transformers.utils.hub import OfflineModeIsEnabled
-except ImportError:
-    try:
-        from transformers import OfflineModeIsEnabled
-    except ImportError:
-        try:
-            from transformers.file_utils import OfflineModeIsEnabled
-        except ImportError:
-            print("Warning: Could not import 'OfflineModeIsEnabled'. Offline functionality checks may be affected.")
-            class OfflineModeIsEnabled(Exception): pass # type: ignore
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.token_counting import batch_token_lengths, count_files
+from common.tokenizer_provider import REGISTRY_ENV, load_tokenizer
 
 def human_format(num: float) -> str:
     """Formats a number into a human-readable string with k, M, B, T suffixes."""
@@ -35,11 +25,33 @@ def human_format(num: float) -> str:
     # If it's larger than Tera, show with 'P' (Peta)
     return f"{num:.1f}P"
 
-def count_tokens_in_text(text_content: str, tokenizer) -> int:
-    """Counts tokens in a single text string, excluding special tokens."""
-    if not isinstance(text_content, str):
-        return 0
-    return len(tokenizer.encode(text_content, add_special_tokens=False))
+def line_at(fp, offset: int, block: int = 1 << 16) -> bytes:
+    """Return the whole line containing byte `offset` (found by scanning back to the previous newline)."""
+    start = offset
+    while start > 0:
+        lo = max(0, start - block)
+        fp.seek(lo)
+        nl = fp.read(start - lo).rfind(b"\n")
+        if nl >= 0:
+            start = lo + nl + 1
+            break
+        start = lo
+    fp.seek(start)
+    return fp.readline()
+
+def hansen_hurwitz(values, sizes, total_bytes: int, z: float = 1.96):
+    """Estimate sum(values) over a file from lines drawn with probability size/total_bytes.
+
+    Each draw gives the unbiased estimate total_bytes * value / size; the result is
+    their mean and the half-width of its normal-approximation confidence interval.
+    """
+    estimates = [total_bytes * v / s for v, s in zip(values, sizes)]
+    n = len(estimates)
+    mean = sum(estimates) / n
+    if n < 2:
+        return mean, float("inf")
+    var = sum((e - mean) ** 2 for e in estimates) / (n - 1)
+    return mean, z * math.sqrt(var / n)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -62,7 +74,13 @@ def main():
         type=int,
         default=None,
         metavar="N",
-        help="Sample N lines to estimate total tokens. If not provided, processes the entire file."
+        help="Estimate total tokens from N records read at random byte offsets. If not provided, processes the entire file."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Random seed for --sample (default: unseeded)."
     )
     parser.add_argument(
         '--hf_token',
@@ -70,18 +88,24 @@ def main():
         default=None,
         help="Hugging Face API token, if required for private/gated models."
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Worker processes for full-file counting; the file is split into byte ranges (default: all cores)."
+    )
 
     args = parser.parse_args()
     input_file_basename = os.path.basename(args.input_file)
 
     print(f"Loading tokenizer: {args.tokenizer_name}...")
     try:
-        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, token=args.hf_token)
-    except (HfHubHTTPError, OfflineModeIsEnabled, ValueError, OSError) as e:
+        tokenizer = load_tokenizer(args.tokenizer_name, token=args.hf_token)
+    except Exception as e:  # hub/offline errors come from transformers, which is only imported when needed
         print(f"Error loading tokenizer '{args.tokenizer_name}': {e.__class__.__name__}: {e}")
         print("\nPlease ensure:")
         print("1. The tokenizer name is correct.")
-        print("2. You have an active internet connection (or the model is cached).")
+        print(f"2. You have an active internet connection (or the tokenizer is cached or in ${REGISTRY_ENV}).")
         print("3. For gated models (e.g., Llama): you are logged in (`huggingface-cli login`) "
               "or provided a valid --hf_token with permissions.")
         print("4. The model/tokenizer files exist and are accessible.")
@@ -100,125 +124,67 @@ def main():
 
     if args.sample is not None and args.sample > 0:
         # --- Sampling Mode ---
-        print(f"\nSampling mode: estimating tokens for '{input_file_basename}' based on {args.sample} lines.")
-
-        total_lines_in_file = 0
-        print("Counting total lines in file (this may take a while for large files)...")
-        try:
-            with open(args.input_file, 'r', encoding='utf-8') as f:
-                for _ in tqdm(f, desc="Counting lines", unit=" lines"):
-                    total_lines_in_file += 1
-        except Exception as e:
-            print(f"Error reading file to count lines: {e}")
-            sys.exit(1)
-
-        if total_lines_in_file == 0:
+        print(f"\nSampling mode: estimating tokens for '{input_file_basename}' from {args.sample:,} random byte offsets.")
+        total_bytes = os.path.getsize(args.input_file)
+        if total_bytes == 0:
             print("Input file is empty. Estimated tokens: 0")
             return
 
-        actual_sample_size = args.sample
-        if args.sample >= total_lines_in_file:
-            print(f"Sample size ({args.sample}) is >= total lines ({total_lines_in_file:,}). Switching to full file processing.")
-            args.sample = None 
-        else:
-            line_indices_to_sample = sorted(random.sample(range(total_lines_in_file), actual_sample_size))
-            
-            sampled_texts = []
-            malformed_sampled_lines = 0
-            empty_text_fields_in_sample = 0
-            
-            print(f"Reading {actual_sample_size} random lines for sampling...")
-            with open(args.input_file, 'r', encoding='utf-8') as f:
-                current_line_idx = 0
-                sample_ptr = 0
-                for line in tqdm(f, total=total_lines_in_file, desc="Scanning for samples", unit=" lines"):
-                    if sample_ptr < len(line_indices_to_sample) and current_line_idx == line_indices_to_sample[sample_ptr]:
-                        try:
-                            data = json.loads(line)
-                            text_content = data.get("text")
-                            if text_content is None:
-                                pass
-                            elif isinstance(text_content, str):
-                                if text_content:
-                                    sampled_texts.append(text_content)
-                                else:
-                                    empty_text_fields_in_sample +=1
-                            else:
-                                print(f"Warning: 'text' field in sampled line {current_line_idx + 1} is not a string (type: {type(text_content)}), skipping.")
-                        except json.JSONDecodeError:
-                            malformed_sampled_lines += 1
-                        sample_ptr += 1
-                    current_line_idx += 1
-                    if sample_ptr >= len(line_indices_to_sample) and len(line_indices_to_sample) > 0:
-                        break 
-            
-            estimated_total_tokens = 0
-            avg_tokens_per_valid_sampled_line = 0
-
-            if sampled_texts:
-                tokens_in_sample = 0
-                print(f"Tokenizing {len(sampled_texts):,} sampled texts...")
-                for text in tqdm(sampled_texts, desc="Tokenizing samples", unit=" texts"):
-                    tokens_in_sample += count_tokens_in_text(text, tokenizer)
-                
-                avg_tokens_per_valid_sampled_line = tokens_in_sample / len(sampled_texts)
-                
-                proportion_of_valid_lines_in_sample = len(sampled_texts) / actual_sample_size
-                estimated_total_valid_lines_in_file = total_lines_in_file * proportion_of_valid_lines_in_sample
-                estimated_total_tokens = avg_tokens_per_valid_sampled_line * estimated_total_valid_lines_in_file
-            
-            print("\n--- Sampling Estimate ---")
-            print(f"File: {input_file_basename} ({total_lines_in_file:,} lines total)")
-            print(f"Sampled: {actual_sample_size:,} lines")
-            if malformed_sampled_lines > 0:
-                 print(f" - Malformed JSON lines skipped in sample: {malformed_sampled_lines:,}")
-            if empty_text_fields_in_sample > 0:
-                 print(f" - Empty 'text' fields in sample: {empty_text_fields_in_sample:,}")
-            
-            if not sampled_texts:
-                print(" - No valid, non-empty 'text' fields found in the sampled lines to estimate tokens.")
-            else:
-                print(f" - Valid 'text' fields processed from sample: {len(sampled_texts):,}")
-                print(f" - Avg. tokens/valid line in sample: {avg_tokens_per_valid_sampled_line:.2f}")
-            
-            print(f"==> Estimated Total Tokens: {estimated_total_tokens:,.0f} (~{human_format(estimated_total_tokens)} tokens) <==")
-            return
+        rng = random.Random(args.seed)
+        with open(args.input_file, 'rb') as fp:
+            records = [line_at(fp, rng.randrange(total_bytes)) for _ in range(args.sample)]
+
+        texts, text_idx = [], []
+        malformed_sampled_lines = 0
+        for i, raw in enumerate(records):
+            try:
+                text_content = json.loads(raw).get("text")
+            except (ValueError, AttributeError):  # bad JSON or UTF-8, or not an object
+                malformed_sampled_lines += 1
+                continue
+            if isinstance(text_content, str) and text_content:
+                texts.append(text_content)
+                text_idx.append(i)
+        tokens = [0] * len(records)
+        for i, n in zip(text_idx, batch_token_lengths(tokenizer, texts)):
+            tokens[i] = n
+        sizes = [len(raw) for raw in records]
+        has_text = [0] * len(records)
+        for i in text_idx:
+            has_text[i] = 1
+
+        est_tokens, ci_tokens = hansen_hurwitz(tokens, sizes, total_bytes)
+        est_lines, ci_lines = hansen_hurwitz([1] * len(records), sizes, total_bytes)
+        est_text_lines, _ = hansen_hurwitz(has_text, sizes, total_bytes)
+
+        print("\n--- Sampling Estimate ---")
+        print(f"File: {input_file_basename} ({human_format(total_bytes)}B)")
+        print(f"Sampled: {len(records):,} records (byte-offset sampling, seed {args.seed})")
+        if malformed_sampled_lines > 0:
+            print(f" - Malformed JSON lines in sample: {malformed_sampled_lines:,}")
+        print(f" - Estimated lines: {est_lines:,.0f} ± {ci_lines:,.0f}")
+        print(f" - Estimated lines with non-empty 'text': {est_text_lines:,.0f}")
+        if est_text_lines > 0:
+            print(f" - Estimated avg. tokens/valid line: {est_tokens / est_text_lines:.2f}")
+        print(f"==> Estimated Total Tokens: {est_tokens:,.0f} ± {ci_tokens:,.0f} "
+              f"(95% CI, ~{human_format(est_tokens)} tokens) <==")
+        return
 
     # --- Full File Processing Mode ---
-    if args.sample is None: # This condition ensures this block runs if --sample was not used or if it was reset
-        print(f"\nProcessing entire file '{input_file_basename}' (this may take a while)...")
-        total_tokens = 0
-        lines_with_text_field = 0
-        lines_with_empty_text_field = 0
-        malformed_lines = 0
-        total_lines_processed = 0
-
+    if args.sample is None:
+        print(f"\nProcessing entire file '{input_file_basename}' with {args.num_workers} workers...")
         try:
-            with open(args.input_file, 'r', encoding='utf-8') as f:
-                for i, line in enumerate(tqdm(f, desc="Processing file", unit=" lines")):
-                    total_lines_processed += 1
-                    try:
-                        data = json.loads(line)
-                        text_content = data.get("text")
-                        if text_content is not None:
-                            if isinstance(text_content, str):
-                                if text_content:
-                                    total_tokens += count_tokens_in_text(text_content, tokenizer)
-                                    lines_with_text_field += 1
-                                else:
-                                    lines_with_empty_text_field +=1
-                            else:
-                                print(f"Warning: 'text' field in line {i+1} is not a string (type: {type(text_content)}), skipping.")
-                    except json.JSONDecodeError:
-                        if malformed_lines < 5: # Show first few errors
-                            print(f"Warning: Skipping malformed JSON line {i+1}: {line.strip()[:80]}...")
-                        elif malformed_lines == 5:
-                            print("Warning: Further malformed line warnings will be suppressed.")
-                        malformed_lines += 1
+            counts = count_files([Path(args.input_file)], args.tokenizer_name,
+                                 num_workers=args.num_workers, hf_token=args.hf_token)[0]
         except Exception as e:
             print(f"Error during full file processing: {e}")
             sys.exit(1)
-        
+        total_tokens = counts.tokens
+        lines_with_text_field = counts.text_lines - counts.empty_text
+        lines_with_empty_text_field = counts.empty_text
+        malformed_lines = counts.malformed
+        total_lines_processed = counts.lines
+
         print("\n--- Full File Scan Results ---")
         print(f"File: {input_file_basename} ({total_lines_processed:,} lines processed)")
         if malformed_lines > 0:
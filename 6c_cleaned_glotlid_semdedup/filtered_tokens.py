@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+filtered_tokens.py
+
+Answer "how many tokens are left after this filter?" from the per-record
+token-count sidecar written by stats.py, without tokenizing anything.
+
+The JSONL file is read once to evaluate the filter; the token count of every
+kept record is looked up in the sidecar by line number.
+
+Usage
+-----
+    python filtered_tokens.py --input_file train_x.jsonl \\
+        --where language=nob_Latn --min language_confidence=0.99
+
+    --where FIELD=VALUE   keep records whose FIELD equals VALUE (repeat to AND;
+                          give one FIELD several times to accept any of the values)
+    --min FIELD=NUMBER    keep records whose numeric FIELD is > NUMBER
+    --max FIELD=NUMBER    keep records whose numeric FIELD is <= NUMBER
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.token_counting import NO_TEXT
+from common.token_sidecar import TokenSidecar
+
+# Optional: use orjson if available
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+
+def field_value(item: str) -> tuple[str, str]:
+    field, sep, value = item.partition("=")
+    if not sep or not field:
+        raise argparse.ArgumentTypeError(f"expected FIELD=VALUE, got '{item}'")
+    return field, value
+
+
+def field_number(item: str) -> tuple[str, float]:
+    field, value = field_value(item)
+    try:
+        return field, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected FIELD=NUMBER, got '{item}'")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Count tokens of the records matching a filter, using the stats.py sidecar.")
+    parser.add_argument("--input_file", type=Path, required=True, help="JSONL file that stats.py has already counted.")
+    parser.add_argument("--tokenizer", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="Tokenizer the sidecar was built with.")
+    parser.add_argument("--where", type=field_value, action="append", default=[], metavar="FIELD=VALUE")
+    parser.add_argument("--min", type=field_number, action="append", default=[], metavar="FIELD=NUMBER")
+    parser.add_argument("--max", type=field_number, action="append", default=[], metavar="FIELD=NUMBER")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    sidecar = TokenSidecar(args.input_file, args.tokenizer)
+    if not sidecar.is_valid():
+        sys.exit(f"No up-to-date sidecar for {args.input_file.name} / {args.tokenizer}; run stats.py on its folder first.")
+    lengths = sidecar.lengths()
+
+    allowed = defaultdict(set)
+    for field, value in args.where:
+        allowed[field].add(value)
+
+    def keep(rec: dict) -> bool:
+        for field, values in allowed.items():
+            if str(rec.get(field)) not in values:
+                return False
+        for field, bound in args.min:
+            v = rec.get(field)
+            if not isinstance(v, (int, float)) or v <= bound:
+                return False
+        for field, bound in args.max:
+            v = rec.get(field)
+            if not isinstance(v, (int, float)) or v > bound:
+                return False
+        return True
+
+    kept_lines = kept_tokens = total_lines = total_tokens = 0
+    with open(args.input_file, "rb") as fp:
+        for idx, raw in enumerate(tqdm(fp, total=len(lengths), desc="Filtering", unit="line")):
+            n = lengths[idx]
+            if n == NO_TEXT:
+                continue
+            total_lines += 1
+            total_tokens += n
+            rec = json.loads(raw)
+            if keep(rec):
+                kept_lines += 1
+                kept_tokens += n
+
+    print(f"File: {args.input_file.name}")
+    print(f"Kept lines:  {kept_lines:,} / {total_lines:,} ({kept_lines / max(total_lines, 1):.1%})")
+    print(f"Kept tokens: {kept_tokens:,} / {total_tokens:,} ({kept_tokens / max(total_tokens, 1):.1%})")
+
+
+if __name__ == "__main__":
+    main()
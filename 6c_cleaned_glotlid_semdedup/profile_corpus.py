@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+profile_corpus.py
+
+One-pass corpus profile for every *.jsonl file in a folder. Replaces running
+stats.py, first_line_csv.py, result_stats.py and analyse.py separately.
+
+Per file:
+- records, malformed lines
+- character (and, with --tokenizer, token) length quantiles of "text"
+- language label distribution and language_confidence bands
+- estimated unique texts and unique ids (HyperLogLog)
+- eval score histograms (error_freeness, coherence, ... read from the record
+  or from the ```json block in its "result" field)
+- user/assistant turns per record ("conversations"/"messages" lists or Llama-3 headers)
+
+Files are cut into byte ranges that are profiled in parallel; the partial
+profiles are merged with mergeable sketches (log-bucket length histograms,
+HyperLogLog, counters), so the result does not depend on --num_workers.
+
+Usage
+-----
+    python profile_corpus.py --folder . --output profile.md --output_json profile.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json as std_json
+import logging
+import os
+import re
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.hyperloglog import HyperLogLog
+from common.length_histogram import LengthHistogram
+from common.token_counting import batch_token_lengths, byte_ranges, iter_range_lines, load_tokenizer_once
+
+# Optional: use orjson if available
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+DEFAULT_SCORE_FIELDS = ["error_freeness", "coherence", "answerability", "general_knowledge_fit"]
+QUANTILES = (0.5, 0.9, 0.99)
+CONFIDENCE_BANDS = (0.5, 0.9, 0.99)
+RESULT_JSON = re.compile(r"```(?:json)?\s*\n(.*?)\n\s*```", re.DOTALL)
+TURN_HEADER = re.compile(r"<\|start_header_id\|>(?:user|assistant)<\|end_header_id\|>")
+TURN_ROLES = {"user", "assistant", "human", "gpt"}  # role/"from" values counted as turns (no system)
+
+_settings: dict = {}
+
+
+class FileProfile:
+    """Mergeable profile of one file (or one byte range of it)."""
+
+    __slots__ = ("records", "malformed", "chars", "tokens", "languages", "confidence",
+                 "texts", "ids", "with_id", "scores", "turns")
+
+    def __init__(self) -> None:
+        self.records = 0
+        self.malformed = 0
+        self.chars = LengthHistogram()
+        self.tokens = LengthHistogram()
+        self.languages: Counter = Counter()
+        self.confidence: Counter = Counter()  # basis-point bin (0..10000) -> records
+        self.texts = HyperLogLog()
+        self.ids = HyperLogLog()
+        self.with_id = 0
+        self.scores: Dict[str, Counter] = {}
+        self.turns: Counter = Counter()
+
+    def merge(self, other: "FileProfile") -> "FileProfile":
+        self.records += other.records
+        self.malformed += other.malformed
+        self.chars.merge(other.chars)
+        self.tokens.merge(other.tokens)
+        self.languages.update(other.languages)
+        self.confidence.update(other.confidence)
+        self.texts.merge(other.texts)
+        self.ids.merge(other.ids)
+        self.with_id += other.with_id
+        for field, counter in other.scores.items():
+            self.scores.setdefault(field, Counter()).update(counter)
+        self.turns.update(other.turns)
+        return self
+
+    def add(self, obj: dict, score_fields: Sequence[str], id_field: str) -> Optional[str]:
+        """Profile one parsed record; returns its text for optional tokenization."""
+        self.records += 1
+        text = obj.get("text")
+        if isinstance(text, str) and text:
+            self.chars.add(len(text))
+            self.texts.add(text.encode("utf-8"))
+        else:
+            text = None
+
+        language = obj.get("language")
+        if language is not None:
+            self.languages[str(language)] += 1
+        conf = obj.get("language_confidence")
+        if isinstance(conf, (int, float)):
+            self.confidence[min(int(conf * 10000), 10000)] += 1
+
+        record_id = obj.get(id_field)
+        if record_id is not None:
+            self.with_id += 1
+            self.ids.add(str(record_id).encode("utf-8"))
+
+        result = None
+        for field in score_fields:
+            value = obj.get(field)
+            if value is None:
+                if result is None:
+                    result = parse_result(obj.get("result"))
+                value = result.get(field)
+            if isinstance(value, (int, float, str)) and not isinstance(value, bool):
+                self.scores.setdefault(field, Counter())[value] += 1
+
+        turns = chat_turns(obj, text)
+        if turns is not None:
+            self.turns[turns] += 1
+        return text
+
+    def to_dict(self) -> dict:
+        conf_total = sum(self.confidence.values())
+        return {
+            "records": self.records,
+            "malformed": self.malformed,
+            "chars": histogram_summary(self.chars) if self.chars.count else None,
+            "tokens": histogram_summary(self.tokens) if self.tokens.count else None,
+            "unique_texts_est": len(self.texts),
+            "records_with_id": self.with_id,
+            "unique_ids_est": len(self.ids) if self.with_id else None,
+            "languages": dict(self.languages.most_common()),
+            "language_confidence": {
+                f">={band}": sum(n for b, n in self.confidence.items() if b >= band * 10000) / conf_total
+                for band in CONFIDENCE_BANDS
+            } if conf_total else None,
+            "scores": {field: dict(sorted(c.items(), key=lambda kv: str(kv[0]))) for field, c in sorted(self.scores.items())},
+            "turns": dict(sorted(self.turns.items())),
+        }
+
+
+def parse_result(result) -> dict:
+    """The JSON object in an eval "result" string (```json ... ``` block), or {}."""
+    if not isinstance(result, str):
+        return {}
+    match = RESULT_JSON.search(result)
+    try:
+        parsed = json.loads(match.group(1) if match else result)
+    except Exception:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+def chat_turns(obj: dict, text: Optional[str]) -> Optional[int]:
+    """User/assistant turns, the same count for a conversation stored as a list or as Llama-3 text."""
+    for field in ("messages", "conversations"):
+        value = obj.get(field)
+        if isinstance(value, list):
+            return sum(1 for m in value
+                       if isinstance(m, dict) and (m.get("role") or m.get("from")) in TURN_ROLES)
+    if text and "<|start_header_id|>" in text:
+        return len(TURN_HEADER.findall(text))
+    return None
+
+
+def histogram_summary(hist: LengthHistogram) -> dict:
+    return {
+        "count": hist.count,
+        "total": hist.total,
+        "mean": hist.total / hist.count if hist.count else 0.0,
+        **{f"p{q * 100:g}": hist.quantile(q) for q in QUANTILES},
+        "max": hist.max,
+    }
+
+
+def init_worker(settings: dict) -> None:
+    if settings.get("tokenizer"):
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+        load_tokenizer_once(settings["tokenizer"])
+    _settings.update(settings)
+
+
+def profile_range(job: Tuple[int, str, int, int]) -> Tuple[int, int, FileProfile]:
+    """Worker: profile the lines starting inside one byte range."""
+    file_idx, path, start, end = job
+    profile = FileProfile()
+    tokenizer = load_tokenizer_once(_settings["tokenizer"]) if _settings.get("tokenizer") else None
+    batch: List[str] = []
+
+    def flush() -> None:
+        profile.tokens.update(batch_token_lengths(tokenizer, batch))
+        batch.clear()
+
+    for raw in iter_range_lines(Path(path), start, end):
+        try:
+            obj = json.loads(raw)
+        except Exception:
+            obj = None
+        if not isinstance(obj, dict):
+            profile.records += 1
+            profile.malformed += 1
+            continue
+        text = profile.add(obj, _settings["score_fields"], _settings["id_field"])
+        if tokenizer is not None and text is not None:
+            batch.append(text)
+            if len(batch) >= 1000:
+                flush()
+    if tokenizer is not None:
+        flush()
+    return file_idx, end - start, profile
+
+
+def profile_files(files: List[Path], settings: dict, num_workers: int, chunk_bytes: int) -> List[FileProfile]:
+    jobs = [(i, str(path), start, end) for i, path in enumerate(files) for start, end in byte_ranges(path, chunk_bytes)]
+    profiles = [FileProfile() for _ in files]
+    with tqdm(total=sum(end - start for _, _, start, end in jobs), desc="Profiling", unit="B", unit_scale=True) as bar:
+        def collect(done) -> None:
+            for file_idx, nbytes, partial in done:
+                profiles[file_idx].merge(partial)
+                bar.update(nbytes)
+
+        if num_workers <= 1:
+            init_worker(settings)
+            collect(map(profile_range, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(settings,)) as executor:
+                collect(executor.map(profile_range, jobs))
+    return profiles
+
+
+def fmt(n: float) -> str:
+    return f"{n:,.0f}"
+
+
+def make_markdown(report: Dict[str, dict]) -> str:
+    out = ["## Overview", "",
+           "| File | Records | Malformed | Unique texts (est.) | Unique ids (est.) | Top languages | Chat turns (median) |",
+           "| --- | ---: | ---: | ---: | ---: | --- | ---: |"]
+    for name, r in report.items():
+        top = ", ".join(f"{lang} {n / max(r['records'], 1):.0%}" for lang, n in list(r["languages"].items())[:3]) or "-"
+        turns = Counter({int(k): v for k, v in r["turns"].items()})
+        median_turns = LengthHistogram()
+        for k, v in turns.items():
+            median_turns.add(k, v)
+        med = fmt(median_turns.quantile(0.5)) if turns else "-"
+        ids = fmt(r["unique_ids_est"]) if r["unique_ids_est"] is not None else "-"
+        out.append(f"| {name} | {fmt(r['records'])} | {fmt(r['malformed'])} | {fmt(r['unique_texts_est'])} | {ids} | {top} | {med} |")
+
+    for key, title in (("chars", "Characters per text"), ("tokens", "Tokens per text")):
+        rows = [(name, r[key]) for name, r in report.items() if r[key]]
+        if not rows:
+            continue
+        out += ["", f"## {title}", "",
+                "| File | Texts | Mean | " + " | ".join(f"p{q * 100:g}" for q in QUANTILES) + " | Max |",
+                "| --- | ---: | ---: | " + " | ".join("---:" for _ in QUANTILES) + " | ---: |"]
+        for name, s in rows:
+            out.append(f"| {name} | {fmt(s['count'])} | {fmt(s['mean'])} | "
+                       + " | ".join(fmt(s[f'p{q * 100:g}']) for q in QUANTILES) + f" | {fmt(s['max'])} |")
+
+    conf_rows = [(name, r["language_confidence"]) for name, r in report.items() if r["language_confidence"]]
+    if conf_rows:
+        out += ["", "## Language confidence", "",
+                "| File | " + " | ".join(f"≥ {b}" for b in CONFIDENCE_BANDS) + " |",
+                "| --- | " + " | ".join("---:" for _ in CONFIDENCE_BANDS) + " |"]
+        for name, bands in conf_rows:
+            out.append(f"| {name} | " + " | ".join(f"{v:.1%}" for v in bands.values()) + " |")
+
+    score_rows = [(name, field, c) for name, r in report.items() for field, c in r["scores"].items()]
+    if score_rows:
+        out += ["", "## Eval scores", "", "| File | Field | Distribution |", "| --- | --- | --- |"]
+        for name, field, c in score_rows:
+            out.append(f"| {name} | {field} | " + ", ".join(f"{k}: {fmt(v)}" for k, v in c.items()) + " |")
+    return "\n".join(out) + "\n"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Profile every *.jsonl file in a folder in one parallel pass.")
+    parser.add_argument("--folder", type=Path, default=Path("."), help="Folder to scan (default: current directory).")
+    parser.add_argument("--output", type=Path, default=Path("profile.md"), help="Markdown report.")
+    parser.add_argument("--output_json", type=Path, default=Path("profile.json"), help="JSON report.")
+    parser.add_argument("--tokenizer", type=str, default=None, help="Also profile token lengths with this HF tokenizer.")
+    parser.add_argument("--id_field", type=str, default="id", help="Record field counted for unique ids.")
+    parser.add_argument("--score_fields", type=str, nargs="+", default=DEFAULT_SCORE_FIELDS, help="Eval score fields to histogram.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of worker processes (default: all cores).")
+    parser.add_argument("--chunk_mb", type=int, default=64, help="Byte-range size per job in MB.")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    folder = args.folder.resolve()
+    files = sorted(folder.glob("*.jsonl"))
+    if not files:
+        logging.warning("No *.jsonl files found in %s", folder)
+        return
+    logging.info("Profiling %d files in %s", len(files), folder)
+    settings = {"tokenizer": args.tokenizer, "id_field": args.id_field, "score_fields": args.score_fields}
+    profiles = profile_files(files, settings, args.num_workers, args.chunk_mb * 2**20)
+
+    report = {fp.name: p.to_dict() for fp, p in zip(files, profiles)}
+    args.output_json.write_text(std_json.dumps(report, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+    args.output.write_text(make_markdown(report), encoding="utf-8")
+    print(f"Profile written to: {args.output.resolve()} and {args.output_json.resolve()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,72 +3,54 @@
 Efficient, parallelized .jsonl stats script.
 - Scans for *.jsonl files in a folder (default: CWD).
 - Counts lines and tokens (from 'text' field) per file using HF tokenizer.
-- Runs file processing in parallel using multiprocessing.
-- Outputs Markdown table (default: stats.md, override with --output).
+- Splits files into byte ranges counted in parallel (a single huge file uses all cores),
+  with batched encoding in every worker (see common/token_counting.py).
+- Keeps per-record token counts in .token_cache/ sidecars and only re-tokenizes
+  new or changed files (see common/token_sidecar.py; disable with --no_cache).
+- Reports token-length quantiles per file and, per context length (--context_lengths),
+  how many tokens are truncated/padded with one document per sequence and how many
+  sequences packing yields; derived from log-bucketed length histograms stored in
+  the sidecars (see common/length_histogram.py), so no extra tokenization pass.
+- Several --tokenizer values are counted in the same scan (each record is parsed
+  once and encoded by all tokenizers); the report then has one token column per
+  tokenizer and a tokens-per-character table.
+- Outputs Markdown tables (default: stats.md, override with --output).
 """
 
 from __future__ import annotations
 import argparse
 import logging
+import sys
 from pathlib import Path
 from typing import List, Tuple
-import concurrent.futures
 import os
 
-from tqdm import tqdm
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.token_counting import DEFAULT_BATCH_SIZE, DEFAULT_CHUNK_BYTES, TokenCounts, count_files_multi, load_tokenizer_once
+from common.length_histogram import ContextReport, LengthHistogram
+from common.token_sidecar import TokenSidecar, length_histogram
 
-# Optional: use orjson if available
-try:
-    import orjson as json
-except ImportError:
-    import json
-
-_TOKENIZER = None
+QUANTILES = (0.5, 0.9, 0.99)
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Compute line/token stats for *.jsonl files (from 'text' field, parallelized).")
     parser.add_argument("--folder", type=Path, default=Path("."), help="Folder to scan (default: current directory).")
-    parser.add_argument("--tokenizer", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="HF tokenizer name or path.")
+    parser.add_argument("--tokenizer", type=str, nargs="+", default=["meta-llama/Llama-3.1-8B-Instruct"],
+                        help="HF tokenizer name(s) or path(s); several are compared in one pass.")
     parser.add_argument("--output", type=Path, default=Path("stats.md"), help="Markdown file to write results (default: stats.md).")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
     parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of worker processes (default: all cores).")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help="Texts per batch encode call.")
+    parser.add_argument("--chunk_mb", type=int, default=DEFAULT_CHUNK_BYTES // 2**20, help="Byte-range size per job in MB.")
+    parser.add_argument("--no_cache", action="store_true", help="Ignore and don't write the per-record token-count sidecars.")
+    parser.add_argument("--context_lengths", type=int, nargs="+", default=[2048, 4096, 8192], help="Context lengths for the packing report.")
+    parser.add_argument("--eos_tokens", type=int, default=1, help="Separator tokens added per document when packing.")
     return parser.parse_args()
 
 def init_logging(debug: bool) -> None:
     level = logging.DEBUG if debug else logging.INFO
     logging.basicConfig(level=level, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def load_tokenizer_once(tokenizer_name: str):
-    """Load tokenizer only once per process (multiprocessing safe)."""
-    global _TOKENIZER
-    if _TOKENIZER is None:
-        from transformers import AutoTokenizer
-        _TOKENIZER = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
-    return _TOKENIZER
-
-def safe_json_parse(line: str | bytes, file_name: str, line_no: int) -> dict | None:
-    try:
-        if isinstance(line, bytes):
-            line = line.decode("utf-8")
-        return json.loads(line)
-    except Exception as err:
-        logging.debug("JSON error in %s line %d: %s", file_name, line_no, err)
-        return None
-
-def count_file_stats_worker(args: Tuple[str, str]) -> Tuple[str, int, int]:
-    """Worker: counts lines and tokens in a file."""
-    file_path, tokenizer_name = args
-    tokenizer = load_tokenizer_once(tokenizer_name)
-    total_lines = 0
-    total_tokens = 0
-    with open(file_path, "r", encoding="utf-8") as fp:
-        for i, raw in enumerate(fp, start=1):
-            obj = safe_json_parse(raw, file_path, i)
-            if obj and isinstance(obj.get("text"), str):
-                total_lines += 1
-                total_tokens += len(tokenizer.encode(obj["text"], add_special_tokens=False))
-    return (Path(file_path).name, total_lines, total_tokens)
-
 def fmt(n: int) -> str:
     return f"{n:,}"
 
@@ -85,6 +67,58 @@ def make_markdown_table(stats: List[Tuple[str, int, int]]) -> str:
     rows.append(f"| **Total** | **{fmt(tot_lines)}** | **{fmt(tot_tokens)}** |")
     return "\n".join(rows)
 
+def short_name(tokenizer: str) -> str:
+    return tokenizer.rstrip("/").rsplit("/", 1)[-1]
+
+def make_multi_table(files: List[str], counts: List[List[TokenCounts]], tokenizers: List[str]) -> str:
+    names = [short_name(t) for t in tokenizers]
+    rows = [
+        "| File | Lines | Chars | " + " | ".join(names) + " |",
+        "| --- | ---: | ---: | " + " | ".join("---:" for _ in names) + " |",
+    ]
+    ratio_rows = [
+        "| File | " + " | ".join(names) + " |",
+        "| --- | " + " | ".join("---:" for _ in names) + " |",
+    ]
+    totals = [TokenCounts() for _ in tokenizers]
+    for name, per_tok in list(zip(files, counts)) + [("**Total**", totals)]:
+        if per_tok is not totals:
+            for total, c in zip(totals, per_tok):
+                total.merge(c)
+        first = per_tok[0]
+        rows.append(f"| {name} | {fmt(first.text_lines)} | {fmt(first.chars)} | "
+                    + " | ".join(fmt(c.tokens) for c in per_tok) + " |")
+        ratio_rows.append(f"| {name} | " + " | ".join(f"{c.tokens / c.chars:.3f}" if c.chars else "-" for c in per_tok) + " |")
+    return "\n".join(rows) + "\n\n### Tokens per character\n\n" + "\n".join(ratio_rows)
+
+def pct(part: float, whole: float) -> str:
+    return f"{part / whole:.1%}" if whole else "-"
+
+def make_length_table(hists: List[Tuple[str, LengthHistogram]]) -> str:
+    rows = [
+        "| File | Docs | Mean | " + " | ".join(f"p{q * 100:g}" for q in QUANTILES) + " | Max |",
+        "| --- | ---: | ---: | " + " | ".join("---:" for _ in QUANTILES) + " | ---: |",
+    ]
+    for name, hist in hists:
+        mean = hist.total / hist.count if hist.count else 0
+        quantiles = " | ".join(f"{hist.quantile(q):,.0f}" for q in QUANTILES)
+        rows.append(f"| {name} | {fmt(hist.count)} | {mean:,.0f} | {quantiles} | {fmt(hist.max)} |")
+    return "\n".join(rows)
+
+def make_context_table(hists: List[Tuple[str, LengthHistogram]], contexts: List[int], eos: int) -> str:
+    rows = [
+        "| File | Context | Docs ≥ ctx | Truncated tokens | Padding (1 doc/seq) | Padded efficiency | Packed sequences | Packed efficiency |",
+        "| --- | ---: | ---: | ---: | ---: | ---: | ---: | ---: |",
+    ]
+    for name, hist in hists:
+        for context in contexts:
+            r = ContextReport(hist, context, eos)
+            rows.append(
+                f"| {name} | {fmt(context)} | {pct(r.docs_over, r.docs)} | {fmt(round(r.truncated))} ({pct(r.truncated, r.tokens)}) "
+                f"| {fmt(round(r.padding))} | {r.padded_efficiency:.1%} | {fmt(r.packed_sequences)} | {r.packed_efficiency:.1%} |"
+            )
+    return "\n".join(rows)
+
 def main() -> None:
     args = parse_args()
     init_logging(args.debug)
@@ -97,14 +131,48 @@ def main() -> None:
     if not files:
         logging.warning("No *.jsonl files found in %s", folder)
         return
-    # Pre-load tokenizer in main process (for HF cache warmup)
-    load_tokenizer_once(args.tokenizer)
-    jobs = [(str(fp), args.tokenizer) for fp in files]
-    stats: List[Tuple[str, int, int]] = []
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.num_workers) as executor:
-        for result in tqdm(executor.map(count_file_stats_worker, jobs), total=len(jobs), desc="Files", unit="file"):
-            stats.append(result)
-    md_table = make_markdown_table(stats)
+    tokenizers = args.tokenizer
+    sidecars = [[TokenSidecar(fp, t) for t in tokenizers] for fp in files]
+    # Per file, the tokenizers whose sidecar is missing or out of date.
+    stale = [tuple(k for k, sc in enumerate(row) if args.no_cache or not sc.is_valid()) for row in sidecars]
+    counts = [[None if k in stale[i] else sc.counts() for k, sc in enumerate(row)] for i, row in enumerate(sidecars)]
+    hists = [[None if k in stale[i] else sc.histogram() for k, sc in enumerate(row)] for i, row in enumerate(sidecars)]
+    n_stale = sum(1 for s in stale if s)
+    logging.info("%d of %d files need tokenizing (%d reused from sidecars)", n_stale, len(files), len(files) - n_stale)
+    groups = {}
+    for i, ks in enumerate(stale):
+        if ks:
+            groups.setdefault(ks, []).append(i)
+    for ks, idxs in groups.items():
+        # Pre-load tokenizers in main process (for HF cache warmup)
+        for k in ks:
+            load_tokenizer_once(tokenizers[k])
+        new_counts, new_lengths = count_files_multi([files[i] for i in idxs], [tokenizers[k] for k in ks],
+                                                    num_workers=args.num_workers, chunk_bytes=args.chunk_mb * 2**20,
+                                                    batch_size=args.batch_size, per_record=True)
+        for i, file_counts, file_lengths in zip(idxs, new_counts, new_lengths):
+            for k, c, lengths in zip(ks, file_counts, file_lengths):
+                counts[i][k] = c
+                hists[i][k] = length_histogram(lengths)
+                if not args.no_cache:
+                    sidecars[i][k].write(lengths, c, hists[i][k])
+    if len(tokenizers) == 1:
+        stats: List[Tuple[str, int, int]] = [(fp.name, c[0].text_lines, c[0].tokens) for fp, c in zip(files, counts)]
+        main_table = make_markdown_table(stats)
+        hist_title = ""
+    else:
+        main_table = make_multi_table([fp.name for fp in files], counts, tokenizers)
+        hist_title = f" ({short_name(tokenizers[0])})"
+    named_hists = [(fp.name, h[0]) for fp, h in zip(files, hists)]
+    total_hist = LengthHistogram()
+    for _, h in named_hists:
+        total_hist.merge(h)
+    named_hists.append(("**Total**", total_hist))
+    md_table = "\n\n".join([
+        main_table,
+        f"### Token lengths{hist_title} (non-empty texts)\n\n" + make_length_table(named_hists),
+        f"### Context lengths{hist_title}\n\n" + make_context_table(named_hists, args.context_lengths, args.eos_tokens),
+    ])
     # Write output
     args.output.write_text(md_table + "\n", encoding="utf-8")
     print(f"Stats written to: {args.output.resolve()}")
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+pack_sequences.py
+
+Tokenize training files once and pack the documents into fixed-length
+sequences, so training jobs read a uint32 memmap instead of parsing JSONL.
+
+Output (see common/token_bin.py):
+    <output_prefix>.bin    uint32 token ids, n_sequences x seq_len
+    <output_prefix>.idx    uint64 [start, end) span of every document piece
+                           (document tokens + EOS) in the flat token array
+    <output_prefix>.json   tokenizer, seq_len, packing mode and efficiency report
+
+Modes:
+    greedy  concatenate documents with an EOS separator and cut every seq_len
+            tokens; documents may straddle sequences, only the last sequence
+            is padded.
+    ffd     first-fit-decreasing bin packing inside a window of --window
+            documents: no document piece straddles a sequence, gaps are
+            filled with --pad_id. Documents longer than seq_len are cut into
+            seq_len chunks first.
+
+Input files (a mixture is given as several files) are streamed in order;
+tokenization runs in a worker pool with at most --max_in_flight batches
+queued, so memory is bounded by the batch queue and the FFD window.
+
+Usage
+-----
+    python pack_sequences.py --input_files ../6c_cleaned_glotlid_semdedup/train_play_llama3.jsonl \\
+        --output_prefix train_play_llama3.4096 --seq_len 4096 --mode ffd
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from array import array
+from collections import deque
+from itertools import islice
+from multiprocessing import get_context
+from pathlib import Path
+from typing import List, Optional
+
+from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.token_bin import TokenBinWriter
+from common.token_counting import batch_token_ids, load_tokenizer_once
+
+# Optional: use orjson if available
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+tokenizer = None  # per worker, loaded by the pool initializer
+
+
+def init_worker(tokenizer_name: str, hf_token: Optional[str]) -> None:
+    global tokenizer
+    tokenizer = load_tokenizer_once(tokenizer_name, hf_token)
+
+
+def tokenize_batch(lines: List[bytes]) -> List[array]:
+    """Token ids of every non-empty "text" in the batch (other lines are skipped)."""
+    texts = []
+    for raw in lines:
+        try:
+            text = json.loads(raw).get("text")
+        except Exception:
+            continue
+        if isinstance(text, str) and text:
+            texts.append(text)
+    return [array("I", ids) for ids in batch_token_ids(tokenizer, texts)]
+
+
+def first_fit(sizes: List[int], capacity: int) -> List[int]:
+    """Bin index for every size, first fit (O(log n) per item with a max segment tree)."""
+    leaves = 1
+    while leaves < max(len(sizes), 1):
+        leaves *= 2
+    tree = [capacity] * (2 * leaves)  # remaining capacity; unused bins are empty
+    bins = []
+    for size in sizes:
+        i = 1
+        while i < leaves:
+            i = 2 * i if tree[2 * i] >= size else 2 * i + 1
+        tree[i] -= size
+        bins.append(i - leaves)
+        i //= 2
+        while i:
+            tree[i] = max(tree[2 * i], tree[2 * i + 1])
+            i //= 2
+    return bins
+
+
+class Packer:
+    """Writes documents into seq_len blocks and keeps the efficiency counters."""
+
+    def __init__(self, writer: TokenBinWriter, seq_len: int, eos_id: int, pad_id: int,
+                 mode: str = "greedy", window: int = 20000) -> None:
+        self.writer = writer
+        self.seq_len = seq_len
+        self.eos_id = eos_id
+        self.pad_id = pad_id
+        self.mode = mode
+        self.window_size = window
+        self.window: List[array] = []
+        self.docs = 0
+        self.tokens = 0          # document tokens, without EOS
+        self.padding = 0
+        self.split_docs = 0      # documents spread over more than one sequence
+
+    def add(self, ids: array) -> None:
+        self.docs += 1
+        self.tokens += len(ids)
+        ids.append(self.eos_id)
+        if self.mode == "greedy":
+            start = self.writer.tokens
+            self._write_piece(ids)
+            if start // self.seq_len != (self.writer.tokens - 1) // self.seq_len:
+                self.split_docs += 1
+            return
+        if len(ids) > self.seq_len:
+            self.split_docs += 1
+            while len(ids) > self.seq_len:
+                self._write_piece(ids[:self.seq_len])
+                del ids[:self.seq_len]
+        self.window.append(ids)
+        if len(self.window) >= self.window_size:
+            self._pack_window()
+
+    def _write_piece(self, ids: array) -> None:
+        start = self.writer.tokens
+        self.writer.write(ids)
+        self.writer.add_span(start, self.writer.tokens)
+
+    def _pad(self, n: int) -> None:
+        if n:
+            self.writer.write(array("I", [self.pad_id]) * n)
+            self.padding += n
+
+    def _pack_window(self) -> None:
+        self.window.sort(key=len, reverse=True)
+        assignment = first_fit([len(piece) for piece in self.window], self.seq_len)
+        bins: List[List[array]] = [[] for _ in range(max(assignment, default=-1) + 1)]
+        for piece, b in zip(self.window, assignment):
+            bins[b].append(piece)
+        for pieces in bins:
+            for piece in pieces:
+                self._write_piece(piece)
+            self._pad(-self.writer.tokens % self.seq_len)
+        self.window = []
+
+    def finish(self) -> dict:
+        self._pack_window()
+        self._pad(-self.writer.tokens % self.seq_len)
+        sequences = self.writer.tokens // self.seq_len
+        return {
+            "docs": self.docs,
+            "doc_tokens": self.tokens,
+            "eos_tokens": self.docs,
+            "padding_tokens": self.padding,
+            "sequences": sequences,
+            "split_docs": self.split_docs,
+            "efficiency": self.tokens / (sequences * self.seq_len) if sequences else 0.0,
+        }
+
+
+def chunked_lines(fp, batch_size: int):
+    while True:
+        chunk = list(islice(fp, batch_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def pack_files(pool, input_files: List[Path], packer: Packer, batch_size: int, max_in_flight: int) -> None:
+    pending = deque()
+    for path in input_files:
+        with path.open("rb") as fp, tqdm(desc=f"Packing {path.name}", unit="line") as bar:
+            def add_oldest():
+                batch = pending.popleft()
+                for ids in batch[0].get():
+                    packer.add(ids)
+                bar.update(batch[1])
+
+            for chunk in chunked_lines(fp, batch_size):
+                if len(pending) >= max_in_flight:
+                    add_oldest()
+                pending.append((pool.apply_async(tokenize_batch, (chunk,)), len(chunk)))
+            while pending:
+                add_oldest()
+
+
+def print_report(report: dict, seq_len: int) -> None:
+    total = report["sequences"] * seq_len
+    print("\n--- Packing report ---")
+    print(f"Documents:        {report['docs']:,} ({report['split_docs']:,} spread over more than one sequence)")
+    print(f"Sequences:        {report['sequences']:,} x {seq_len:,} = {total:,} tokens")
+    print(f"Document tokens:  {report['doc_tokens']:,}")
+    print(f"EOS tokens:       {report['eos_tokens']:,}")
+    print(f"Padding tokens:   {report['padding_tokens']:,} ({report['padding_tokens'] / max(total, 1):.2%})")
+    print(f"==> Packing efficiency: {report['efficiency']:.2%} <==")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Tokenize JSONL files once and pack them into fixed-length uint32 sequences.")
+    parser.add_argument("--input_files", type=Path, nargs="+", required=True, help="JSONL files with a 'text' field, packed in this order.")
+    parser.add_argument("--output_prefix", type=Path, required=True, help="Writes <prefix>.bin, <prefix>.idx and <prefix>.json.")
+    parser.add_argument("--tokenizer", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="HF tokenizer name or path.")
+    parser.add_argument("--hf_token", type=str, default=None, help="Hugging Face token for gated tokenizers.")
+    parser.add_argument("--seq_len", type=int, default=4096, help="Tokens per packed sequence.")
+    parser.add_argument("--mode", choices=["greedy", "ffd"], default="greedy", help="Packing strategy (see module docstring).")
+    parser.add_argument("--window", type=int, default=20000, help="Documents per first-fit-decreasing window (ffd mode).")
+    parser.add_argument("--eos_id", type=int, default=None, help="Separator token id (default: the tokenizer's EOS).")
+    parser.add_argument("--pad_id", type=int, default=None, help="Padding token id (default: the EOS id).")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Tokenizer worker processes.")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Lines per tokenization batch.")
+    parser.add_argument("--max_in_flight", type=int, default=None, help="Batches queued at once (default: 4 x workers).")
+    args = parser.parse_args()
+
+    # The parent only packs; one tokenizer process per core is enough.
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    tok = load_tokenizer_once(args.tokenizer, args.hf_token)
+    eos_id = args.eos_id if args.eos_id is not None else tok.eos_token_id
+    if eos_id is None:
+        sys.exit(f"Tokenizer {args.tokenizer} has no EOS token; pass --eos_id.")
+    pad_id = args.pad_id if args.pad_id is not None else eos_id
+    max_in_flight = args.max_in_flight or 4 * args.num_workers
+
+    meta = {
+        "tokenizer": args.tokenizer,
+        "seq_len": args.seq_len,
+        "mode": args.mode,
+        "eos_id": eos_id,
+        "pad_id": pad_id,
+        "sources": [p.name for p in args.input_files],
+    }
+    with TokenBinWriter(args.output_prefix, index="spans", meta=meta) as writer:
+        packer = Packer(writer, args.seq_len, eos_id, pad_id, args.mode, args.window)
+        with get_context("fork").Pool(args.num_workers, initializer=init_worker,
+                                      initargs=(args.tokenizer, args.hf_token)) as pool:
+            pack_files(pool, args.input_files, packer, args.batch_size, max_in_flight)
+        report = packer.finish()
+        writer.meta["report"] = report
+
+    print_report(report, args.seq_len)
+    print(f"Written: {writer.bin_path}, {writer.idx_path}, {writer.meta_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+export_tokens.py
+
+Export train_*.jsonl files as pre-tokenized .bin/.idx shards, so training
+jobs stop re-tokenizing them (see common/token_bin.py for the format).
+
+Each input file is cut into line-aligned byte ranges of --shard_mb; every
+range becomes one shard and is tokenized by its own worker process. Shard
+boundaries depend only on the file and --shard_mb, never on --num_workers,
+so re-running gives byte-identical shards.
+
+Document i of the export is line i of the input file: lines without a
+non-empty "text" string become empty documents, so line numbers stay valid.
+
+Output per input file <name>.jsonl:
+    <output_dir>/<name>.00000.bin/.idx/.json, <name>.00001..., one per shard
+    <output_dir>/<name>.shards.json           manifest with per-shard counts
+
+Reading:
+    from common.token_bin import TokenShards
+    ds = TokenShards.open("train_tinycode_llama3.shards.json")
+    ds[123]    # uint32 numpy view of document 123, no copy
+
+Usage
+-----
+    python export_tokens.py --input_files ../6c_cleaned_glotlid_semdedup/train_*.jsonl --output_dir .
+"""
+
+from __future__ import annotations
+
+import argparse
+import json as std_json
+import os
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.token_bin import TokenBinWriter
+from common.token_counting import batch_token_ids, byte_ranges, iter_range_lines, load_tokenizer_once
+
+# Optional: use orjson if available
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+_TOKENIZER = None
+
+
+def init_worker(tokenizer_name: str, hf_token: Optional[str]) -> None:
+    global _TOKENIZER
+    _TOKENIZER = load_tokenizer_once(tokenizer_name, hf_token)
+
+
+def line_text(raw: bytes) -> str:
+    try:
+        text = json.loads(raw).get("text")
+    except Exception:
+        return ""
+    return text if isinstance(text, str) else ""
+
+
+def export_shard(job: Tuple[str, int, int, str, dict, int, Optional[int]]) -> dict:
+    """Worker: tokenize the lines of one byte range into one shard."""
+    path, start, end, prefix, meta, batch_size, eos_id = job
+    with TokenBinWriter(Path(prefix), index="offsets", meta=meta) as writer:
+        batch: List[str] = []
+
+        def flush() -> None:
+            nonempty = [t for t in batch if t]
+            ids = iter(batch_token_ids(_TOKENIZER, nonempty))
+            for text in batch:
+                doc = array("I", next(ids)) if text else array("I")
+                if eos_id is not None:
+                    doc.append(eos_id)
+                writer.write(doc)
+            batch.clear()
+
+        for raw in iter_range_lines(Path(path), start, end):
+            batch.append(line_text(raw))
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+    return writer.meta
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export JSONL files as pre-tokenized uint32 .bin/.idx shards.")
+    parser.add_argument("--input_files", type=Path, nargs="+", required=True, help="JSONL files with a 'text' field.")
+    parser.add_argument("--output_dir", type=Path, default=Path("."), help="Directory for shards and manifests.")
+    parser.add_argument("--tokenizer", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="HF tokenizer name or path.")
+    parser.add_argument("--hf_token", type=str, default=None, help="Hugging Face token for gated tokenizers.")
+    parser.add_argument("--shard_mb", type=float, default=256, help="Input megabytes per shard (fixes the shard boundaries).")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Texts per batch encode call.")
+    parser.add_argument("--append_eos", action="store_true", help="Append the tokenizer's EOS token to every document.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Worker processes (one shard each at a time).")
+    args = parser.parse_args()
+
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    eos_id = load_tokenizer_once(args.tokenizer, args.hf_token).eos_token_id if args.append_eos else None
+    if args.append_eos and eos_id is None:
+        parser.error(f"--append_eos: tokenizer {args.tokenizer} has no EOS token")
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    shard_bytes = max(1, int(args.shard_mb * 2**20))
+
+    jobs, manifests = [], {}
+    for path in args.input_files:
+        ranges = byte_ranges(path, shard_bytes)
+        manifests[path] = []
+        for k, (start, end) in enumerate(ranges):
+            prefix = args.output_dir / f"{path.stem}.{k:05d}"
+            meta = {"tokenizer": args.tokenizer, "source": path.name, "shard": k,
+                    "byte_range": [start, end], "eos_id": eos_id}
+            jobs.append((str(path), start, end, str(prefix), meta, args.batch_size, eos_id))
+
+    total_bytes = sum(job[2] - job[1] for job in jobs)
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=init_worker,
+                             initargs=(args.tokenizer, args.hf_token)) as executor, \
+         tqdm(total=total_bytes, desc="Exporting", unit="B", unit_scale=True) as bar:
+        for job, meta in zip(jobs, executor.map(export_shard, jobs)):
+            manifests[Path(job[0])].append({"prefix": Path(job[3]).name, "docs": meta["docs"], "tokens": meta["tokens"]})
+            bar.update(job[2] - job[1])
+
+    for path, shards in manifests.items():
+        manifest = args.output_dir / f"{path.stem}.shards.json"
+        summary = {
+            "source": path.name,
+            "tokenizer": args.tokenizer,
+            "shard_bytes": shard_bytes,
+            "eos_id": eos_id,
+            "docs": sum(s["docs"] for s in shards),
+            "tokens": sum(s["tokens"] for s in shards),
+            "shards": shards,
+        }
+        manifest.write_text(std_json.dumps(summary, indent=2) + "\n", encoding="utf-8")
+        print(f"{path.name}: {summary['docs']:,} docs, {summary['tokens']:,} tokens in {len(shards)} shards -> {manifest}")
+
+
+if __name__ == "__main__":
+    main()
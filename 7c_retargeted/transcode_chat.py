@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+transcode_chat.py
+
+Render finished training files into a chat format: either files whose
+records carry structured "messages" (generated with --emit_messages, so
+the template is only applied here, at export), or finished Llama-3 "text"
+re-emitted in another format or with another system prompt without
+regenerating it from the source datasets.
+
+A record's "messages" are used as they are; otherwise its "text" is split
+into messages with common.chat_render.parse_llama3 (one linear scan over
+the special tokens; the Llama-3.1 date preamble is dropped from the system
+message). The messages are then rendered, either
+
+    --target chatml|gemma|mistral|llama3|llama3.1   a built-in format (FORMATS), or
+    --chat_template <model>                         that tokenizer's template (ChatRenderer:
+                                                    native when verified, else apply_chat_template)
+
+--system_prompt replaces (or adds) the system message, --drop_system removes
+it. All other fields of a record are kept; "messages" is replaced by the
+rendered "text" unless --keep_messages. Records whose text is not plain
+Llama-3 chat (plain documents, tool calls, ...) are counted and dropped, or
+copied unchanged with --keep_unparsed.
+
+Files are streamed in order through a worker pool with at most
+--max_in_flight batches queued, so a whole instruct mix is one pass with
+bounded memory.
+
+Output: <output_dir>/<name>.jsonl with "_llama3" in the name replaced by
+"_<suffix>" (default suffix: the target name), e.g.
+train_tinycode_llama3.jsonl -> train_tinycode_chatml.jsonl.
+
+Usage
+-----
+    python transcode_chat.py --input_files ../6c_cleaned_glotlid_semdedup/train_*_llama3.jsonl \\
+        --output_dir . --target chatml
+    python transcode_chat.py --input_files ../6c_cleaned_glotlid_semdedup/train_*_llama3.jsonl \\
+        --output_dir . --chat_template google/gemma-3-4b-it --suffix gemma3
+    python transcode_chat.py --input_files ../6c_cleaned_glotlid_semdedup/train_*.jsonl \\
+        --output_dir . --target llama3    # deferred (--emit_messages) records
+"""
+
+from __future__ import annotations
+
+import argparse
+import json as std_json
+import os
+import sys
+from collections import Counter, deque
+from itertools import islice
+from multiprocessing import get_context
+from pathlib import Path
+from typing import List, Optional
+
+from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.chat_render import FORMATS, ChatRenderer, parse_llama3, record_messages
+from common.tokenizer_provider import load_tokenizer
+
+# Optional: use orjson if available
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+# Set in the parent before forking (target format, system prompt policy) or
+# by the pool initializer (tokenizer-backed renderer).
+render = None
+system_policy: tuple = ("keep", None)
+keep_unparsed = False
+keep_messages = False
+
+
+def init_worker(chat_template: Optional[str], hf_token: Optional[str]) -> None:
+    global render
+    if chat_template is not None:
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+        tokenizer = load_tokenizer(chat_template, trust_remote_code=True, token=hf_token)
+        render = ChatRenderer(tokenizer).render
+
+
+def target_renderer(name: str):
+    builder, context = FORMATS[name]
+    return lambda messages: builder(messages, False, **context)
+
+
+def apply_system_policy(messages: List[dict]) -> List[dict]:
+    action, prompt = system_policy
+    if action == "keep":
+        return messages
+    if messages and messages[0]["role"] == "system":
+        messages = messages[1:]
+    if action == "replace":
+        messages = [{"role": "system", "content": prompt}] + messages
+    return messages
+
+
+def transcode_batch(lines: List[bytes]):
+    """Worker: transcode a batch of raw lines; returns (output lines, counters)."""
+    out, stats = [], Counter()
+    for raw in lines:
+        stats["records"] += 1
+        try:
+            rec = json.loads(raw)
+        except Exception:
+            stats["malformed"] += 1
+            continue
+        messages = record_messages(rec)
+        if messages is None:
+            text = rec.get("text") if isinstance(rec, dict) else None
+            messages = parse_llama3(text) if isinstance(text, str) else None
+        new_text = render(apply_system_policy(messages)) if messages else None
+        if new_text is None:
+            stats["unparsed"] += 1
+            if keep_unparsed:
+                out.append(raw.decode("utf-8").rstrip("\n"))
+            continue
+        rec["text"] = new_text
+        if not keep_messages:
+            rec.pop("messages", None)
+        out.append(std_json.dumps(rec, ensure_ascii=False))
+        stats["written"] += 1
+    return out, stats
+
+
+def chunked_lines(fp, batch_size: int):
+    while True:
+        chunk = list(islice(fp, batch_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def output_path(path: Path, output_dir: Path, suffix: str) -> Path:
+    stem = path.stem.replace("_llama3", f"_{suffix}") if "_llama3" in path.stem else f"{path.stem}_{suffix}"
+    return output_dir / f"{stem}{path.suffix}"
+
+
+def transcode_file(pool, path: Path, out_path: Path, batch_size: int, max_in_flight: int) -> Counter:
+    pending = deque()
+    totals = Counter()
+    with path.open("rb") as fin, out_path.open("w", encoding="utf-8") as fout, \
+         tqdm(desc=f"Transcoding {path.name}", unit="line") as bar:
+        def write_oldest():
+            lines, stats = pending.popleft().get()
+            if lines:
+                fout.write("\n".join(lines) + "\n")
+            totals.update(stats)
+            bar.update(stats["records"])
+
+        for chunk in chunked_lines(fin, batch_size):
+            if len(pending) >= max_in_flight:
+                write_oldest()
+            pending.append(pool.apply_async(transcode_batch, (chunk,)))
+        while pending:
+            write_oldest()
+    return totals
+
+
+def main() -> None:
+    global render, system_policy, keep_unparsed, keep_messages
+    parser = argparse.ArgumentParser(description="Render JSONL files with messages, or Llama-3 formatted text, into a chat format.")
+    parser.add_argument("--input_files", type=Path, nargs="+", required=True, help="JSONL files (id + messages, or id + Llama-3 text, ...).")
+    parser.add_argument("--output_dir", type=Path, required=True, help="Directory for the transcoded files.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--target", choices=sorted(FORMATS), help="Built-in target format.")
+    target.add_argument("--chat_template", help="HF model id whose chat template is the target.")
+    parser.add_argument("--suffix", help="Replaces '_llama3' in output names (default: target name or model name).")
+    system = parser.add_mutually_exclusive_group()
+    system.add_argument("--system_prompt", help="Replace (or add) the system message.")
+    system.add_argument("--drop_system", action="store_true", help="Remove the system message.")
+    parser.add_argument("--keep_unparsed", action="store_true", help="Copy records that are not Llama-3 chat unchanged instead of dropping them.")
+    parser.add_argument("--keep_messages", action="store_true", help="Keep the 'messages' field next to the rendered 'text'.")
+    parser.add_argument("--hf_token", type=str, default=None, help="Hugging Face token for gated tokenizers.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Worker processes.")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Lines per worker batch.")
+    parser.add_argument("--max_in_flight", type=int, default=None, help="Batches queued at once (default: 4 x workers).")
+    args = parser.parse_args()
+
+    if args.target is not None:
+        render = target_renderer(args.target)
+    if args.system_prompt is not None:
+        system_policy = ("replace", args.system_prompt)
+    elif args.drop_system:
+        system_policy = ("drop", None)
+    keep_unparsed = args.keep_unparsed
+    keep_messages = args.keep_messages
+    suffix = args.suffix or args.target or args.chat_template.rstrip("/").split("/")[-1]
+    max_in_flight = args.max_in_flight or 4 * args.num_workers
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    with get_context("fork").Pool(args.num_workers, initializer=init_worker,
+                                  initargs=(args.chat_template, args.hf_token)) as pool:
+        for path in args.input_files:
+            out_path = output_path(path, args.output_dir, suffix)
+            if out_path.resolve() == path.resolve():
+                sys.exit(f"Refusing to overwrite the input file {path}; choose another --output_dir or --suffix.")
+            stats = transcode_file(pool, path, out_path, args.batch_size, max_in_flight)
+            print(f"{path.name} -> {out_path.name}: {stats['written']:,}/{stats['records']:,} transcoded, "
+                  f"{stats['unparsed']:,} not Llama-3 chat ({'copied' if keep_unparsed else 'dropped'}), "
+                  f"{stats['malformed']:,} malformed")
+
+
+if __name__ == "__main__":
+    main()
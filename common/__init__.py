@@ -0,0 +1,9 @@
+"""
+Helpers shared by the stage scripts.
+
+The stage scripts are run directly from their own folder, so they put the
+repository root on sys.path before importing from here:
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from common.token_counting import count_files
+"""
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+chat_render.py
+
+Fast chat-template rendering for the instruct generators.
+
+`tokenizer.apply_chat_template(..., tokenize=False)` renders a Jinja template
+per record. For the chat formats we produce (Llama-3 and Llama-3.1/3.2/3.3)
+the output is plain string concatenation, so ChatRenderer uses hand-written
+builders from a small registry instead:
+
+    renderer = ChatRenderer(tokenizer)
+    text = renderer.render(messages)                 # one conversation
+    texts = renderer.render_batch(conversations)     # several
+
+The native builder is only used after it has produced byte-identical output
+to apply_chat_template on a set of probe conversations and on the first
+`verify_records` real conversations; on any mismatch (or an unknown template,
+or messages a builder does not handle, e.g. tool calls) the renderer falls
+back to apply_chat_template, so the output never changes.
+
+Generators run with --emit_messages store the conversation itself instead
+(`renderer.fields(messages)` gives {"messages": [...]} rather than
+{"text": ...}); later stages read the turns with record_messages() and the
+final export (7c_retargeted/transcode_chat.py) renders them.
+
+parse_llama3() goes the other way: it splits finished Llama-3 text back into
+messages with one linear scan, so finished files can be re-emitted in
+another family from FORMATS (ChatML, Gemma, Mistral, ...) without going back
+to the source datasets. segment_llama3() is the lenient variant used by the
+LID, dedup and prompt-swap stages: (role, start, end) offsets of every
+complete block, whatever surrounds them.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+Messages = List[Dict[str, str]]
+Segment = Tuple[str, int, int]  # (role, content start, content end) offsets into the text
+
+BOS = "<|begin_of_text|>"
+HEADER = "<|start_header_id|>{role}<|end_header_id|>\n\n"
+HEADER_START = "<|start_header_id|>"
+HEADER_END = "<|end_header_id|>\n\n"
+_HEADERS = {role: HEADER.format(role=role) for role in ("system", "user", "assistant")}
+EOT = "<|eot_id|>"
+GENERATION_PROMPT = "<|start_header_id|>assistant<|end_header_id|>\n\n"
+
+_PROBES: List[Messages] = [
+    [{"role": "user", "content": "Hei"}, {"role": "assistant", "content": "Hei! Hva kan jeg hjelpe med?"}],
+    [{"role": "system", "content": "You are a helpful assistant."},
+     {"role": "user", "content": "  Oversett til nynorsk:\n\nJeg er ikke her.  "},
+     {"role": "assistant", "content": "\nEg er ikkje her.\n"}],
+    [{"role": "system", "content": " Du er en hjelpsom assistent.\n"},
+     {"role": "user", "content": "Første spørsmål {med} klammer"},
+     {"role": "assistant", "content": "Svar æ ø å"},
+     {"role": "user", "content": "Andre spørsmål\t"},
+     {"role": "assistant", "content": "```python\nprint('x')\n```"}],
+    [{"role": "user", "content": ""}, {"role": "assistant", "content": "tomt"}],
+]
+
+
+# -------------------------------------------------------------------------
+# Native builders
+# -------------------------------------------------------------------------
+def _plain_messages(messages: Messages, roles=("system", "user", "assistant")) -> bool:
+    return all(
+        isinstance(m.get("content"), str) and m.get("role") in roles and "tool_calls" not in m
+        for m in messages
+    )
+
+
+def build_llama3(messages: Messages, add_generation_prompt: bool, bos: str, **_) -> Optional[str]:
+    """Meta-Llama-3-*-Instruct: bos, then header + trimmed content + eot per message."""
+    if not _plain_messages(messages):
+        return None
+    parts = [bos] if messages else []
+    for m in messages:
+        parts.append(_HEADERS[m["role"]])
+        parts.append(m["content"].strip())
+        parts.append(EOT)
+    if add_generation_prompt:
+        parts.append(GENERATION_PROMPT)
+    return "".join(parts)
+
+
+def build_llama31(messages: Messages, add_generation_prompt: bool, bos: str, date_string: str = "", **_) -> Optional[str]:
+    """Llama-3.1/3.2/3.3-Instruct without tools: a system block with the knowledge/today dates is always emitted."""
+    if not messages or not _plain_messages(messages):
+        return None
+    if messages[0]["role"] == "system":
+        system_message = messages[0]["content"].strip()
+        messages = messages[1:]
+    else:
+        system_message = ""
+    parts = [bos, _HEADERS["system"], "Cutting Knowledge Date: December 2023\n",
+             "Today Date: ", date_string, "\n\n", system_message, EOT]
+    for m in messages:
+        parts.append(_HEADERS[m["role"]])
+        parts.append(m["content"].strip())
+        parts.append(EOT)
+    if add_generation_prompt:
+        parts.append(GENERATION_PROMPT)
+    return "".join(parts)
+
+
+def build_chatml(messages: Messages, add_generation_prompt: bool, **_) -> Optional[str]:
+    """ChatML (Qwen, many fine-tunes): content is emitted as is, no bos."""
+    if not _plain_messages(messages):
+        return None
+    parts = [f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages]
+    if add_generation_prompt:
+        parts.append("<|im_start|>assistant\n")
+    return "".join(parts)
+
+
+def build_gemma(messages: Messages, add_generation_prompt: bool, bos: str = "<bos>", **_) -> Optional[str]:
+    """Gemma-3: no system role, the system message is prefixed to the first turn; assistant is "model"."""
+    if not messages or not _plain_messages(messages):
+        return None
+    prefix = ""
+    if messages[0]["role"] == "system":
+        prefix = messages[0]["content"] + "\n\n"
+        messages = messages[1:]
+    parts = [bos]
+    for m in messages:
+        role = "model" if m["role"] == "assistant" else m["role"]
+        parts.append(f"<start_of_turn>{role}\n{prefix}{m['content'].strip()}<end_of_turn>\n")
+        prefix = ""
+    if add_generation_prompt:
+        parts.append("<start_of_turn>model\n")
+    return "".join(parts)
+
+
+def build_mistral(messages: Messages, add_generation_prompt: bool, bos: str = "<s>", eos: str = "</s>",
+                  **_) -> Optional[str]:
+    """Mistral-Instruct [INST] format; the system message is prefixed to the first user turn."""
+    if not messages or not _plain_messages(messages):
+        return None
+    prefix = ""
+    if messages[0]["role"] == "system":
+        prefix = messages[0]["content"] + "\n\n"
+        messages = messages[1:]
+    parts = [bos]
+    for m in messages:
+        if m["role"] == "user":
+            parts.append(f"[INST] {prefix}{m['content']} [/INST]")
+            prefix = ""
+        elif m["role"] == "assistant":
+            parts.append(f"{m['content']}{eos}")
+        else:
+            return None
+    return "".join(parts)
+
+
+# name -> (detects the tokenizer's chat template, builder)
+REGISTRY: Dict[str, tuple] = {
+    "llama3.1": (lambda t: "<|start_header_id|>" in t and "Cutting Knowledge Date" in t, build_llama31),
+    "llama3": (lambda t: "<|start_header_id|>" in t and "<|eot_id|>" in t and "Cutting Knowledge Date" not in t, build_llama3),
+}
+
+
+# Target families for transcoding: name -> (builder, default special tokens/context)
+FORMATS: Dict[str, tuple] = {
+    "llama3": (build_llama3, {"bos": BOS}),
+    "llama3.1": (build_llama31, {"bos": BOS, "date_string": "26 Jul 2024"}),
+    "chatml": (build_chatml, {}),
+    "gemma": (build_gemma, {"bos": "<bos>"}),
+    "mistral": (build_mistral, {"bos": "<s>", "eos": "</s>"}),
+}
+
+_LLAMA31_PREAMBLE = re.compile(r"Cutting Knowledge Date: [^\n]*\nToday Date: [^\n]*\n\n")
+
+
+def record_messages(record) -> Optional[Messages]:
+    """The structured "messages" of a record, or None if it has none (or they are not role/content strings)."""
+    messages = record.get("messages") if isinstance(record, dict) else None
+    if not isinstance(messages, list) or not messages:
+        return None
+    for m in messages:
+        if not isinstance(m, dict) or not isinstance(m.get("role"), str) or not isinstance(m.get("content"), str):
+            return None
+    return messages
+
+
+def set_chat_fields(record: dict, fields: Dict[str, object]) -> dict:
+    """Store ChatRenderer.fields() output in an existing record (a deferred record drops any "text" it came with)."""
+    if "messages" in fields:
+        record.pop("text", None)
+    record.update(fields)
+    return record
+
+
+def detect_format(chat_template: Optional[str]) -> Optional[str]:
+    if not isinstance(chat_template, str):
+        return None
+    for name, (detect, _) in REGISTRY.items():
+        if detect(chat_template):
+            return name
+    return None
+
+
+# -------------------------------------------------------------------------
+# Parsing
+# -------------------------------------------------------------------------
+# group 1: <|start_header_id|>, group 2: <|end_header_id|>, neither: <|eot_id|>
+_SPECIAL_TOKEN = re.compile(r"<\|(?:(start_header_id)|(end_header_id)|eot_id)\|>")
+
+
+def iter_llama3(text: str) -> Iterator[Segment]:
+    """Lazy segment_llama3(): stops scanning when the caller stops (e.g. at the first system block)."""
+    role_start = -1
+    role = None
+    content_start = 0
+    for match in _SPECIAL_TOKEN.finditer(text):
+        token = match.lastindex
+        if token == 1:
+            role_start, role = match.end(), None
+        elif token == 2:
+            if role_start >= 0:
+                role = text[role_start:match.start()]
+                content_start = match.end()
+                if text.startswith("\n\n", content_start):
+                    content_start += 2
+                role_start = -1
+        elif role is not None:
+            yield role, content_start, match.start()
+            role = None
+
+
+def segment_llama3(text: str) -> List[Segment]:
+    """(role, start, end) of every complete header/content/eot block, in one pass over the special tokens.
+
+    The content span starts after the header's "\n\n" (when present) and
+    ends before <|eot_id|>; text[start:end] is the message content. Text
+    outside blocks (BOS, tool tags, stray words) is skipped, and a block
+    without <|eot_id|> before the next header is dropped. Unlike
+    parse_llama3() this never fails, so it also reads records that are only
+    partly chat.
+    """
+    return list(iter_llama3(text))
+
+
+def parse_llama3(text: str, strip_preamble: bool = True) -> Optional[Messages]:
+    """Split Llama-3 chat text into messages, or None if it is not exactly header/content/eot blocks.
+
+    With strip_preamble, the Llama-3.1 "Cutting Knowledge Date/Today Date"
+    lines are removed from the system message (and a system message that
+    only held them is dropped), since every 3.1 rendering adds them again.
+    """
+    pos = len(BOS) if text.startswith(BOS) else 0
+    end_of_text = len(text)
+    messages: Messages = []
+    while pos < end_of_text:
+        if not text.startswith(HEADER_START, pos):
+            return None
+        role_start = pos + len(HEADER_START)
+        role_end = text.find(HEADER_END, role_start)
+        if role_end == -1:
+            return None
+        role = text[role_start:role_end]
+        if "<|" in role:
+            return None
+        content_start = role_end + len(HEADER_END)
+        content_end = text.find(EOT, content_start)
+        if content_end == -1:
+            return None
+        messages.append({"role": role, "content": text[content_start:content_end]})
+        pos = content_end + len(EOT)
+    if strip_preamble and messages and messages[0]["role"] == "system":
+        match = _LLAMA31_PREAMBLE.match(messages[0]["content"])
+        if match:
+            content = messages[0]["content"][match.end():]
+            if content:
+                messages[0]["content"] = content
+            else:
+                del messages[0]
+    return messages or None
+
+
+# -------------------------------------------------------------------------
+# Renderer
+# -------------------------------------------------------------------------
+class ChatRenderer:
+    """Render conversations like tokenizer.apply_chat_template(tokenize=False), natively when verified."""
+
+    def __init__(self, tokenizer, add_generation_prompt: bool = False, verify_records: int = 100,
+                 native: bool = True, defer: bool = False) -> None:
+        self.tokenizer = tokenizer
+        self.defer = defer  # fields() stores the messages instead of rendering them
+        self.add_generation_prompt = add_generation_prompt
+        self.verify_records = verify_records
+        self.format = detect_format(getattr(tokenizer, "chat_template", None)) if native else None
+        self._builder: Optional[Callable[..., Optional[str]]] = None
+        self._context = {"bos": getattr(tokenizer, "bos_token", None) or ""}
+        if self.format is not None:
+            self._builder = REGISTRY[self.format][1]
+            self._calibrate()
+            self._verify_probes()
+        if self._builder is None:
+            logging.info("Chat rendering: using apply_chat_template")
+        else:
+            logging.info("Chat rendering: native %s builder (verified on probes)", self.format)
+
+    @property
+    def is_native(self) -> bool:
+        return self._builder is not None
+
+    def _template(self, messages: Messages) -> str:
+        return self.tokenizer.apply_chat_template(messages, tokenize=False,
+                                                  add_generation_prompt=self.add_generation_prompt)
+
+    def _calibrate(self) -> None:
+        # The 3.1 templates put "today" in the system block; take it from the template itself
+        # (it is either strftime_now() or the template's fixed default).
+        match = re.search(r"Today Date: (.*?)\n", self._template([{"role": "user", "content": "x"}]))
+        if match:
+            self._context["date_string"] = match.group(1)
+
+    def _disable(self, reason: str) -> None:
+        logging.warning("Chat rendering: native %s builder disabled (%s); falling back to apply_chat_template",
+                        self.format, reason)
+        self._builder = None
+
+    def _verify_probes(self) -> None:
+        for messages in _PROBES:
+            native = self._builder(messages, self.add_generation_prompt, **self._context)
+            expected = self._template(messages)
+            if native != expected:
+                self._disable(f"probe mismatch at char {_first_difference(native or '', expected)}")
+                return
+
+    def render(self, messages: Messages) -> str:
+        if self._builder is not None:
+            text = self._builder(messages, self.add_generation_prompt, **self._context)
+            if text is not None:
+                if self.verify_records > 0:
+                    self.verify_records -= 1
+                    expected = self._template(messages)
+                    if text != expected:
+                        self._disable(f"record mismatch at char {_first_difference(text, expected)}")
+                        return expected
+                return text
+        return self._template(messages)
+
+    def render_batch(self, conversations: List[Messages]) -> List[str]:
+        if self._builder is None:
+            return self.tokenizer.apply_chat_template(conversations, tokenize=False,
+                                                      add_generation_prompt=self.add_generation_prompt)
+        return [self.render(messages) for messages in conversations]
+
+    def fields(self, messages: Messages) -> Dict[str, object]:
+        """Output fields for one conversation: {"text": rendered} or, when deferred, {"messages": messages}."""
+        if self.defer:
+            return {"messages": [{"role": m["role"], "content": m["content"]} for m in messages]}
+        return {"text": self.render(messages)}
+
+    def fields_batch(self, conversations: List[Messages]) -> List[Dict[str, object]]:
+        if self.defer:
+            return [self.fields(messages) for messages in conversations]
+        return [{"text": text} for text in self.render_batch(conversations)]
+
+    __call__ = render
+
+
+def _first_difference(a: str, b: str) -> int:
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    return min(len(a), len(b))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+hyperloglog.py
+
+Mergeable distinct-count sketch (HyperLogLog with the small-range linear
+counting correction). With the default p=14 the sketch is 16 KB and the
+typical relative error about 0.8%; merging two sketches is a register-wise
+max, so per-worker sketches combine into exact per-file sketches.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import math
+
+
+class HyperLogLog:
+    __slots__ = ("p", "registers")
+
+    def __init__(self, p: int = 14) -> None:
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, data: bytes) -> None:
+        h = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        if other.p != self.p:
+            raise ValueError(f"cannot merge HyperLogLog with p={other.p} into p={self.p}")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)
+        return raw
+
+    def __len__(self) -> int:
+        return round(self.estimate())
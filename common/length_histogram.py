@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+length_histogram.py
+
+Mergeable log-bucketed histogram of token lengths, plus the truncation /
+padding / packing report that training planning needs per context length.
+
+Buckets follow the HDR-histogram layout: values below 16 get one bucket each,
+every octave [2^e, 2^(e+1)) above that is split into 8 equal sub-buckets, so
+the relative bucket width is at most 1/8 and every power of two is a bucket
+boundary. Each bucket keeps its count and the exact sum of its values, which
+makes totals exact and lets reports at power-of-two context lengths
+(2048, 4096, 8192, ...) be exact as well.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+SUB_BUCKETS = 8
+_SUB_BITS = 3            # log2(SUB_BUCKETS)
+_LINEAR = 2 * SUB_BUCKETS  # values below this get exact buckets
+
+
+def bucket_index(n: int) -> int:
+    if n < _LINEAR:
+        return n
+    e = n.bit_length() - 1
+    return _LINEAR + (e - _SUB_BITS - 1) * SUB_BUCKETS + ((n >> (e - _SUB_BITS)) & (SUB_BUCKETS - 1))
+
+
+def bucket_bounds(idx: int) -> Tuple[int, int]:
+    """[low, high) range of values in a bucket."""
+    if idx < _LINEAR:
+        return idx, idx + 1
+    e, sub = divmod(idx - _LINEAR, SUB_BUCKETS)
+    e += _SUB_BITS + 1
+    width = 1 << (e - _SUB_BITS)
+    low = (SUB_BUCKETS + sub) * width
+    return low, low + width
+
+
+class LengthHistogram:
+    """Sparse bucket -> [count, sum]; add() is cheap, merge() is exact."""
+
+    __slots__ = ("buckets", "max")
+
+    def __init__(self) -> None:
+        self.buckets: Dict[int, List[int]] = {}
+        self.max = 0
+
+    def add(self, n: int, count: int = 1) -> None:
+        idx = bucket_index(n)
+        b = self.buckets.get(idx)
+        if b is None:
+            self.buckets[idx] = [count, n * count]
+        else:
+            b[0] += count
+            b[1] += n * count
+        if n > self.max:
+            self.max = n
+
+    def update(self, values: Iterable[int]) -> "LengthHistogram":
+        for n in values:
+            self.add(n)
+        return self
+
+    def merge(self, other: "LengthHistogram") -> "LengthHistogram":
+        for idx, (count, total) in other.buckets.items():
+            b = self.buckets.setdefault(idx, [0, 0])
+            b[0] += count
+            b[1] += total
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def count(self) -> int:
+        return sum(b[0] for b in self.buckets.values())
+
+    @property
+    def total(self) -> int:
+        return sum(b[1] for b in self.buckets.values())
+
+    def items(self) -> Iterator[Tuple[int, int, int, int]]:
+        """(low, high, count, sum) per non-empty bucket, in increasing order."""
+        for idx in sorted(self.buckets):
+            low, high = bucket_bounds(idx)
+            count, total = self.buckets[idx]
+            yield low, high, count, total
+
+    def quantile(self, q: float) -> float:
+        """Approximate q-quantile: the mean of the bucket holding it (exact below 16)."""
+        n = self.count
+        if n == 0:
+            return 0.0
+        rank = q * (n - 1)
+        seen = 0
+        for _, _, count, total in self.items():
+            seen += count
+            if seen > rank:
+                return total / count
+        return float(self.max)
+
+    def to_dict(self) -> dict:
+        return {"max": self.max, "buckets": {str(k): v for k, v in sorted(self.buckets.items())}}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LengthHistogram":
+        hist = cls()
+        hist.max = data.get("max", 0)
+        hist.buckets = {int(k): list(v) for k, v in data.get("buckets", {}).items()}
+        return hist
+
+
+class ContextReport:
+    """What happens to a length distribution at one context length.
+
+    padded:  one document per sequence, truncated to the context and padded
+             up to it; docs_over counts documents of at least `context` tokens.
+    packed:  documents concatenated with `eos` separator tokens and
+             cut into full sequences (only the last one is padded).
+
+    Exact when `context` is a power of two (a bucket boundary); otherwise the
+    bucket straddling the context is split proportionally.
+    """
+
+    __slots__ = ("context", "docs", "tokens", "docs_over", "truncated", "kept", "padding",
+                 "packed_sequences", "packed_efficiency")
+
+    def __init__(self, hist: LengthHistogram, context: int, eos: int = 1) -> None:
+        self.context = context
+        self.docs = hist.count
+        self.tokens = hist.total
+        self.docs_over = 0
+        self.truncated = 0
+        for low, high, count, total in hist.items():
+            if low >= context:
+                over_count, over_sum = count, total
+            elif high - 1 > context:
+                # Straddling bucket: assume values are spread evenly over it.
+                frac = (high - 1 - context) / (high - low)
+                over_count, over_sum = count * frac, total * frac
+            else:
+                continue
+            self.docs_over += over_count
+            self.truncated += over_sum - over_count * context
+        self.kept = self.tokens - self.truncated
+        self.padding = self.docs * context - self.kept
+        packed_tokens = self.tokens + self.docs * eos
+        self.packed_sequences = math.ceil(packed_tokens / context) if packed_tokens else 0
+        self.packed_efficiency = self.tokens / (self.packed_sequences * context) if self.packed_sequences else 0.0
+
+    @property
+    def padded_efficiency(self) -> float:
+        return self.kept / (self.docs * self.context) if self.docs else 0.0
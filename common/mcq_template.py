@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+mcq_template.py
+
+Compiled prompt templates for the MCQ converters (3b_spm, 3c_spm_eval).
+
+A template such as "Spørsmål: {question}\\n{letters}\\n\\nSvar: {answer}" is
+parsed once into a render function that only asks for the placeholders it
+contains. The values come from a LazyFields mapping: a field (letters,
+plain_commas, ...) is built by its builder the first time a template asks
+for it and memoized, so rendering one record with many templates
+(--prompt_id -99, few-shot) formats each choice layout at most once.
+
+    FIELDS = {"question": lambda e: e["question"].strip(), ...}
+    tpl = compile_template("Spørsmål: {question}", FIELDS)
+    tpl.fields                          # frozenset({'question'})
+    tpl.render(LazyFields(item, FIELDS))
+
+compile_template raises TemplateError for unknown placeholders, positional
+or indexed fields ({}, {0}, {a.b}, {a[0]}), conversions, format specs and
+unbalanced braces, so a bad prompts.txt fails at load time. The output is
+the same as template.format(**all_fields).
+"""
+
+from __future__ import annotations
+
+from string import Formatter
+from typing import Callable, Dict, Mapping
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class LazyFields(dict):
+    """Template values for one record; each field is built on first use and memoized."""
+
+    __slots__ = ("item", "builders")
+
+    def __init__(self, item, builders: Mapping[str, Callable]) -> None:
+        super().__init__()
+        self.item = item
+        self.builders = builders
+
+    def __missing__(self, name: str) -> str:
+        value = self[name] = self.builders[name](self.item)
+        return value
+
+
+class CompiledTemplate:
+    __slots__ = ("source", "fields", "render")
+
+    def __init__(self, source: str, fields: frozenset, render: Callable[[Mapping[str, str]], str]) -> None:
+        self.source = source
+        self.fields = fields     # placeholders the template uses
+        self.render = render     # render(values) -> str
+
+    def __repr__(self) -> str:
+        return f"CompiledTemplate({self.source!r})"
+
+
+def compile_template(source: str, known: Mapping[str, Callable]) -> CompiledTemplate:
+    """Parse `source` once into a render function over the placeholders in `known`."""
+    parts = []              # (literal, placeholder or None), in template order
+    names = set()
+    try:
+        parsed = list(Formatter().parse(source))
+    except ValueError as exc:
+        raise TemplateError(f"{exc} in template {source!r}") from None
+    for literal, name, spec, conversion in parsed:
+        if name is None:
+            if literal:
+                parts.append((literal, None))
+            continue
+        if not name.isidentifier():
+            raise TemplateError(f"unsupported placeholder {{{name}}} in template {source!r}")
+        if name not in known:
+            raise TemplateError(f"unknown placeholder {{{name}}} in template {source!r} "
+                                f"(known: {', '.join(sorted(known))})")
+        if spec or conversion:
+            raise TemplateError(f"format spec/conversion on {{{name}}} is not supported in template {source!r}")
+        names.add(name)
+        parts.append((literal, name))
+    parts = tuple(parts)
+
+    def render(v: Mapping[str, str]) -> str:
+        return "".join([literal + v[name] if name else literal for literal, name in parts])
+
+    return CompiledTemplate(source, frozenset(names), render)
+
+
+def compile_templates(sources: Mapping[int, str], known: Mapping[str, Callable]) -> Dict[int, CompiledTemplate]:
+    return {key: compile_template(source, known) for key, source in sources.items()}
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+parallel_render.py
+
+Multi-process chat rendering for the Hugging Face dataset converters.
+
+The dataset is cut into index ranges of `shard_size` rows. Forked workers
+each load the tokenizer once (and build one ChatRenderer), convert their
+rows with the caller's `convert(row, idx, renderer)` function and return
+the finished JSON lines. The parent yields the lines in dataset order; at
+most `max_in_flight` shards are queued, so memory stays bounded whatever
+the dataset size.
+
+    def convert(row, idx, renderer):
+        return {"id": f"x_{idx}", "text": renderer.render([...])}   # or None to skip
+
+    for line in render_dataset(ds, convert, "meta-llama/Meta-Llama-3-8B-Instruct"):
+        fout.write(line + "\\n")
+
+The output is the same for every --num_workers.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from collections import deque
+from multiprocessing import cpu_count, get_context
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from common.chat_render import ChatRenderer
+from common.tokenizer_provider import load_tokenizer
+
+DEFAULT_SHARD_SIZE = 1000
+
+# Set in the parent before forking; the Arrow dataset is memory-mapped, so the
+# workers share its pages instead of copying them.
+_DATASET = None
+_CONVERT: Optional[Callable] = None
+_RENDERER: Optional[ChatRenderer] = None
+
+
+def _init_worker(tokenizer_name: str, hf_token: Optional[str], single_process: bool, defer: bool = False) -> None:
+    global _RENDERER
+    if not single_process:
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    tokenizer = load_tokenizer(tokenizer_name, trust_remote_code=True, token=hf_token)
+    _RENDERER = ChatRenderer(tokenizer, defer=defer)
+
+
+def render_range(job: Tuple[int, int]) -> Tuple[int, List[str]]:
+    """Worker: convert rows [start, end) and return (rows read, JSON lines)."""
+    start, end = job
+    columns = _DATASET[start:end]  # one columnar read instead of end-start row lookups
+    names = list(columns)
+    lines = []
+    for offset, values in enumerate(zip(*(columns[name] for name in names))):
+        record = _CONVERT(dict(zip(names, values)), start + offset, _RENDERER)
+        if record is not None:
+            lines.append(json.dumps(record, ensure_ascii=False))
+    return end - start, lines
+
+
+def render_dataset(
+    dataset,
+    convert: Callable[[dict, int, ChatRenderer], Optional[dict]],
+    tokenizer_name: str,
+    num_workers: Optional[int] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    max_in_flight: Optional[int] = None,
+    hf_token: Optional[str] = None,
+    desc: str = "Rendering",
+    defer: bool = False,
+) -> Iterator[str]:
+    """Yield one JSON line (without newline) per converted row, in dataset order.
+
+    With defer=True the workers' ChatRenderer stores messages instead of
+    rendering (renderer.fields(), see --emit_messages).
+    """
+    global _DATASET, _CONVERT
+    _DATASET, _CONVERT = dataset, convert
+    num_workers = num_workers or cpu_count()
+    max_in_flight = max_in_flight or 4 * num_workers
+    jobs = ((start, min(start + shard_size, len(dataset))) for start in range(0, len(dataset), shard_size))
+
+    with tqdm(total=len(dataset), desc=desc, unit="ex") as bar:
+        if num_workers <= 1:
+            _init_worker(tokenizer_name, hf_token, True, defer)
+            for job in jobs:
+                rows, lines = render_range(job)
+                bar.update(rows)
+                yield from lines
+            return
+
+        with get_context("fork").Pool(num_workers, initializer=_init_worker,
+                                      initargs=(tokenizer_name, hf_token, False, defer)) as pool:
+            pending = deque()
+            for job in jobs:
+                if len(pending) >= max_in_flight:
+                    rows, lines = pending.popleft().get()
+                    bar.update(rows)
+                    yield from lines
+                pending.append(pool.apply_async(render_range, (job,)))
+            while pending:
+                rows, lines = pending.popleft().get()
+                bar.update(rows)
+                yield from lines
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+record_rng.py
+
+Per-record random generators keyed on (seed, record id).
+
+A script that draws from the global `random` module gets results that depend
+on the order the records are processed in, so it can neither be split over
+processes nor resumed halfway with the same output. record_rng hashes the
+seed and the record key (BLAKE2b, 64 bits) into the seed of a fresh
+random.Random: a record gets the same draws (shuffle, sample, randint, ...)
+whatever process, shard or position it is handled in.
+
+    rng = record_rng(args.seed, rec["id"])
+    rng.shuffle(choices)
+
+Creating a generator costs a few microseconds, about the price of parsing a
+short JSON line.
+
+The augmentation generators (3k, 3l, 3o, 3y, 3z) share the command line
+part through add_rng_arguments(): --seed, and --shard K/N to convert only
+the K-th of N line-aligned byte ranges of the input (or of N row ranges of
+a dataset). RecordRNG adds the stage name to the key, so two generators fed
+the same record ids do not make the same draws:
+
+    rngs = stage_rng(args, "3o_acceptability")
+    for line in shard_lines(args.input_file, args.shard):
+        rng = rngs(rec.get("id") or rec["text"])
+
+    # same bytes as one run without --shard:
+    for k in 0 1 2 3; do python create_x.py ... --seed 1 --shard $k/4 -o part$k.jsonl & done; wait
+    cat part0.jsonl part1.jsonl part2.jsonl part3.jsonl > all.jsonl
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import random
+import sys
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+KEY_SEPARATOR = b"\x1f"  # ASCII unit separator between key parts
+
+
+def record_seed(seed: int, *key) -> int:
+    """64-bit seed for one record; key parts are compared as str()."""
+    h = hashlib.blake2b(str(seed).encode("utf-8"), digest_size=8)
+    for part in key:
+        h.update(KEY_SEPARATOR)
+        h.update(str(part).encode("utf-8"))
+    return int.from_bytes(h.digest(), "little")
+
+
+def record_rng(seed: int, *key) -> random.Random:
+    """A random.Random that only depends on (seed, *key)."""
+    return random.Random(record_seed(seed, *key))
+
+
+def fresh_seed() -> int:
+    """A random seed for runs without --seed (print it so the run can be repeated)."""
+    return random.SystemRandom().randrange(2**32)
+
+
+class RecordRNG:
+    """record_rng(seed, stage, record id) for one generator script.
+
+    `stage` names the script (its STAGE constant, e.g. "3o_acceptability") and
+    is part of every key: generators run with the same seed over the same
+    record ids still draw independently. Renaming a stage changes its output.
+    """
+
+    __slots__ = ("seed", "stage")
+
+    def __init__(self, seed: int, stage: str) -> None:
+        self.seed = seed
+        self.stage = stage
+
+    def __call__(self, record_id) -> random.Random:
+        return record_rng(self.seed, self.stage, record_id)
+
+
+# -------------------------------------------------------------------------
+# Command line: --seed and --shard K/N
+# -------------------------------------------------------------------------
+def parse_shard(value: str) -> Tuple[int, int]:
+    try:
+        k, n = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K/N, got {value!r}") from None
+    if not 0 <= k < n:
+        raise argparse.ArgumentTypeError(f"shard {value!r}: need 0 <= K < N")
+    return k, n
+
+
+def add_rng_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for the per-record random choices (random and printed if omitted).")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="K/N",
+                        help="Only convert shard K (0-based) of N; the shards' outputs concatenated in order "
+                             "equal the unsharded output for the same --seed.")
+
+
+def stage_rng(args: argparse.Namespace, stage: str) -> RecordRNG:
+    """RecordRNG(args.seed, stage); draws and prints a seed when none was given."""
+    if args.seed is None:
+        args.seed = fresh_seed()
+        print(f"Seed: {args.seed} (pass --seed {args.seed} to reproduce)", file=sys.stderr)
+    return RecordRNG(args.seed, stage)
+
+
+def shard_range(n: int, shard: Optional[Tuple[int, int]]) -> range:
+    """Rows of shard K/N of a dataset with n rows (contiguous, in order)."""
+    if shard is None:
+        return range(n)
+    k, parts = shard
+    return range(n * k // parts, n * (k + 1) // parts)
+
+
+def shard_lines(path, shard: Optional[Tuple[int, int]]) -> Iterator[str]:
+    """The lines of a UTF-8 file whose first byte is in byte range K of N (all lines without a shard)."""
+    from common.token_counting import iter_range_lines
+
+    path = Path(path)
+    k, parts = shard or (0, 1)
+    size = path.stat().st_size
+    for raw in iter_range_lines(path, size * k // parts, size * (k + 1) // parts):
+        yield raw.decode("utf-8")
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+token_bin.py
+
+Pre-tokenized corpus files that training jobs read with np.memmap instead of
+parsing and tokenizing JSONL.
+
+One dataset (or one shard of it) is three files sharing a prefix:
+
+    <prefix>.bin    token ids, uint32 little-endian, all documents back to back
+    <prefix>.idx    uint64 index into .bin, either
+                      "offsets": docs + 1 start offsets (doc i = [off[i], off[i+1]))
+                      "spans":   docs x 2 [start, end) pairs, used by packed files
+                                 where padding sits between documents
+    <prefix>.json   metadata: tokenizer, index kind, counts, sequence length, ...
+
+TokenBin opens one prefix and returns zero-copy numpy views of documents or of
+fixed-length sequences; TokenShards reads the shards of one exported file as a
+single document sequence.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+from array import array
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+
+TOKEN_DTYPE = np.dtype("<u4")
+INDEX_DTYPE = np.dtype("<u8")
+_FLUSH_TOKENS = 1 << 22
+
+assert array("I").itemsize == 4 and array("Q").itemsize == 8
+assert sys.byteorder == "little", "array.tofile writes native byte order; .bin/.idx are little-endian"
+
+
+def prefix_paths(prefix: Path) -> tuple[Path, Path, Path]:
+    prefix = Path(prefix)
+    return (prefix.with_name(prefix.name + ".bin"), prefix.with_name(prefix.name + ".idx"),
+            prefix.with_name(prefix.name + ".json"))
+
+
+def _memmap(path: Path, dtype: np.dtype) -> np.ndarray:
+    # np.memmap refuses empty files.
+    return np.memmap(path, dtype=dtype, mode="r") if path.stat().st_size else np.zeros(0, dtype)
+
+
+class TokenBinWriter:
+    """Append token sequences to <prefix>.bin and write the index/metadata on close().
+
+    index="offsets": every write() is one document.
+    index="spans":   write() appends raw tokens (e.g. a packed sequence) and
+                     add_span() records document boundaries inside them.
+    """
+
+    def __init__(self, prefix: Path, index: str = "offsets", meta: Optional[dict] = None) -> None:
+        if index not in ("offsets", "spans"):
+            raise ValueError(f"unknown index kind '{index}'")
+        self.bin_path, self.idx_path, self.meta_path = prefix_paths(prefix)
+        self.bin_path.parent.mkdir(parents=True, exist_ok=True)
+        self.index = index
+        self.meta = dict(meta or {})
+        self.tokens = 0
+        self.docs = 0
+        self._buffer = array("I")
+        self._index = array("Q", [0] if index == "offsets" else [])
+        self._fp = open(self.bin_path.with_suffix(".bin.tmp"), "wb")
+        self._idx_fp = open(self.idx_path.with_suffix(".idx.tmp"), "wb")
+
+    def write(self, ids: Iterable[int]) -> None:
+        start = len(self._buffer)
+        self._buffer.extend(ids)
+        self.tokens += len(self._buffer) - start
+        if self.index == "offsets":
+            self._index.append(self.tokens)
+            self.docs += 1
+        if len(self._buffer) >= _FLUSH_TOKENS:
+            self._flush()
+
+    def add_span(self, start: int, end: int) -> None:
+        self._index.extend((start, end))
+        self.docs += 1
+
+    def _flush(self) -> None:
+        # Both files are streamed, so memory stays bounded for any corpus size.
+        self._buffer.tofile(self._fp)
+        del self._buffer[:]
+        self._index.tofile(self._idx_fp)
+        del self._index[:]
+
+    def close(self) -> dict:
+        self._flush()
+        for fp, path in ((self._fp, self.bin_path), (self._idx_fp, self.idx_path)):
+            fp.close()
+            os.replace(fp.name, path)
+        self.meta.update({"index": self.index, "docs": self.docs, "tokens": self.tokens,
+                          "dtype": TOKEN_DTYPE.str, "index_dtype": INDEX_DTYPE.str})
+        self.meta_path.write_text(json.dumps(self.meta, indent=2) + "\n", encoding="utf-8")
+        return self.meta
+
+    def __enter__(self) -> "TokenBinWriter":
+        return self
+
+    def __exit__(self, exc_type, *_) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # Nothing was published yet; drop the partial temp files.
+            for fp in (self._fp, self._idx_fp):
+                fp.close()
+                Path(fp.name).unlink(missing_ok=True)
+
+
+class TokenBin:
+    """Read-only memmap view of one <prefix>.bin/.idx pair."""
+
+    def __init__(self, prefix: Path) -> None:
+        bin_path, idx_path, meta_path = prefix_paths(prefix)
+        self.meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        self.tokens = _memmap(bin_path, TOKEN_DTYPE)
+        index = _memmap(idx_path, INDEX_DTYPE)
+        if self.meta["index"] == "spans":
+            self.starts, self.ends = index[0::2], index[1::2]
+        else:
+            self.starts, self.ends = index[:-1], index[1:]
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """Token ids of document i (a view into the memmap, no copy)."""
+        return self.tokens[self.starts[i]:self.ends[i]]
+
+    def lengths(self) -> np.ndarray:
+        return (self.ends - self.starts).astype(np.int64)
+
+    def sequences(self, seq_len: Optional[int] = None) -> np.ndarray:
+        """The token array as (n, seq_len) rows; seq_len defaults to the packed length."""
+        seq_len = seq_len or self.meta["seq_len"]
+        n = len(self.tokens) // seq_len
+        return self.tokens[:n * seq_len].reshape(n, seq_len)
+
+
+class TokenShards:
+    """The shards of one exported file (see 7b_tokenized/export_tokens.py) read as one document sequence."""
+
+    def __init__(self, prefixes: Sequence[Path]) -> None:
+        self.shards: List[TokenBin] = [TokenBin(p) for p in prefixes]
+        self._first = np.cumsum([0] + [len(s) for s in self.shards])
+
+    @classmethod
+    def open(cls, manifest: Path) -> "TokenShards":
+        """Open all shards listed in a <name>.shards.json manifest."""
+        manifest = Path(manifest)
+        data = json.loads(manifest.read_text(encoding="utf-8"))
+        return cls([manifest.parent / shard["prefix"] for shard in data["shards"]])
+
+    def __len__(self) -> int:
+        return int(self._first[-1])
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """Token ids of document i across shards (a view into that shard's memmap)."""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        shard = int(np.searchsorted(self._first, i, side="right")) - 1
+        return self.shards[shard][i - int(self._first[shard])]
+
+    @property
+    def num_tokens(self) -> int:
+        return sum(int(s.meta["tokens"]) for s in self.shards)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+token_counting.py
+
+Batched, multi-process token counting for *.jsonl files (tokens are counted
+in the "text" field only, without special tokens).
+
+Files are cut into byte ranges of about `chunk_bytes`, aligned to line starts,
+so one huge file is spread over all workers instead of pinning a single core.
+Every worker loads the tokenizer(s) once and encodes `batch_size` texts per
+call with the fast (Rust) backend. Several tokenizers can be compared in one
+pass: each line is parsed once and its text is encoded by all of them.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+from tqdm import tqdm
+
+# Optional: use orjson if available
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+DEFAULT_BATCH_SIZE = 1000
+NO_TEXT = 0xFFFFFFFF  # per-record length of a line without a "text" string
+
+_TOKENIZERS: dict = {}
+
+
+class TokenCounts:
+    """Mergeable per-file (or per-range) counters."""
+
+    __slots__ = ("lines", "malformed", "text_lines", "empty_text", "chars", "tokens")
+
+    def __init__(self) -> None:
+        self.lines = 0        # raw lines read
+        self.malformed = 0    # lines that are not valid JSON
+        self.text_lines = 0   # lines whose "text" is a string (may be empty)
+        self.empty_text = 0   # ... of which the string is empty
+        self.chars = 0        # characters in non-empty texts
+        self.tokens = 0
+
+    def merge(self, other: "TokenCounts") -> "TokenCounts":
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+
+def load_tokenizer_once(tokenizer_name: str, hf_token: str | None = None):
+    """Load each tokenizer only once per process (multiprocessing safe; see common.tokenizer_provider)."""
+    if tokenizer_name not in _TOKENIZERS:
+        from common.tokenizer_provider import load_tokenizer
+        _TOKENIZERS[tokenizer_name] = load_tokenizer(tokenizer_name, token=hf_token, use_fast=True)
+    return _TOKENIZERS[tokenizer_name]
+
+
+def batch_token_lengths(tokenizer, texts: List[str]) -> List[int]:
+    """Token count per text, one call into the Rust backend for the whole batch."""
+    if not texts:
+        return []
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        return [len(enc) for enc in backend.encode_batch(texts, add_special_tokens=False)]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
+def batch_token_ids(tokenizer, texts: List[str]) -> List[List[int]]:
+    """Token ids per text (no special tokens), batched like batch_token_lengths."""
+    if not texts:
+        return []
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        return [enc.ids for enc in backend.encode_batch(texts, add_special_tokens=False)]
+    return tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+
+def byte_ranges(path: Path, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> List[Tuple[int, int]]:
+    """Split a file into [start, end) ranges; each line belongs to the range holding its first byte."""
+    size = path.stat().st_size
+    if size == 0:
+        return []
+    return [(start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)]
+
+
+def iter_range_lines(path: Path, start: int, end: int, offsets: bool = False) -> Iterator:
+    """Yield the raw lines that start inside [start, end) (with offsets: (byte offset, line) pairs)."""
+    with open(path, "rb") as fp:
+        if start > 0:
+            # Skip the line that started in the previous range (or just its newline).
+            fp.seek(start - 1)
+            pos = start - 1 + len(fp.readline())
+        else:
+            pos = 0
+        while pos < end:
+            line = fp.readline()
+            if not line:
+                break
+            yield (pos, line) if offsets else line
+            pos += len(line)
+
+
+def iter_texts(lines: Iterable[bytes], counts: TokenCounts,
+               lengths: array | None = None) -> Iterator[Tuple[int, str]]:
+    """Parse lines, update counts and yield (line index, text) for non-empty "text" strings.
+
+    With `lengths`, one slot per line is appended: NO_TEXT for lines without a
+    string "text", otherwise 0 (count_range fills in the count of non-empty texts).
+    """
+    for raw in lines:
+        idx = counts.lines
+        counts.lines += 1
+        try:
+            obj = json.loads(raw)
+        except Exception:
+            counts.malformed += 1
+            if lengths is not None:
+                lengths.append(NO_TEXT)
+            continue
+        text = obj.get("text") if isinstance(obj, dict) else None
+        if isinstance(text, str):
+            counts.text_lines += 1
+            if lengths is not None:
+                lengths.append(0)
+            if text:
+                counts.chars += len(text)
+                yield idx, text
+            else:
+                counts.empty_text += 1
+        elif lengths is not None:
+            lengths.append(NO_TEXT)
+
+
+def _init_worker(tokenizer_names: Sequence[str], hf_token: str | None, single_process: bool) -> None:
+    if not single_process:
+        # One process per core already; don't let every process spawn a Rust thread pool too.
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    for name in tokenizer_names:
+        load_tokenizer_once(name, hf_token)
+
+
+def count_range(job: Tuple[int, str, int, int, int, bool, Tuple[str, ...]]
+                ) -> Tuple[int, int, List[TokenCounts], List[array] | None]:
+    """Worker: count one byte range with every tokenizer.
+
+    Each line is parsed once; every batch of texts is fanned out to all
+    tokenizers (on threads when there are several, the Rust encoders release
+    the GIL). Returns (file index, bytes covered, counts per tokenizer,
+    per-line lengths per tokenizer or None).
+    """
+    file_idx, path, start, end, batch_size, per_record, names = job
+    tokenizers = [load_tokenizer_once(name) for name in names]
+    shared = TokenCounts()
+    lengths = [array("I") for _ in names] if per_record else None
+    tokens = [0] * len(names)
+    batch: List[Tuple[int, str]] = []
+    executor = ThreadPoolExecutor(len(names)) if len(names) > 1 else None
+
+    def encode(k: int, texts: List[str]) -> List[int]:
+        return batch_token_lengths(tokenizers[k], texts)
+
+    def flush() -> None:
+        if lengths is not None:
+            # iter_texts lays out the NO_TEXT/0 slots in the first array only.
+            for k in range(1, len(names)):
+                lengths[k].extend(lengths[0][len(lengths[k]):])
+        texts = [text for _, text in batch]
+        if executor is None:
+            results = [encode(0, texts)]
+        else:
+            results = list(executor.map(encode, range(len(names)), [texts] * len(names)))
+        for k, counted in enumerate(results):
+            tokens[k] += sum(counted)
+            if lengths is not None:
+                for (idx, _), n in zip(batch, counted):
+                    lengths[k][idx] = n
+        batch.clear()
+
+    try:
+        for item in iter_texts(iter_range_lines(Path(path), start, end), shared, lengths[0] if lengths else None):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    counts = []
+    for k in range(len(names)):
+        c = TokenCounts().merge(shared)
+        c.tokens = tokens[k]
+        counts.append(c)
+    return file_idx, end - start, counts, lengths
+
+
+def count_files_multi(
+    paths: Sequence[Path],
+    tokenizer_names: Sequence[str],
+    num_workers: int = 1,
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    hf_token: str | None = None,
+    per_record: bool = False,
+) -> Tuple[List[List[TokenCounts]], List[List[array]] | None]:
+    """Count every file with every tokenizer in one scan.
+
+    Returns counts[file][tokenizer] and, with per_record=True, lengths[file][tokenizer]:
+    a uint32 array with the token count of every line (NO_TEXT for lines
+    without a "text" string); otherwise None.
+    """
+    names = tuple(tokenizer_names)
+    jobs = [
+        (i, str(path), start, end, batch_size, per_record, names)
+        for i, path in enumerate(paths)
+        for start, end in byte_ranges(Path(path), chunk_bytes)
+    ]
+    results = [[TokenCounts() for _ in names] for _ in paths]
+    per_file = [[array("I") for _ in names] for _ in paths]
+    total_bytes = sum(job[3] - job[2] for job in jobs)
+    logging.debug("Counting %d files x %d tokenizers as %d byte ranges with %d workers",
+                  len(paths), len(names), len(jobs), num_workers)
+
+    def collect(done) -> None:
+        # map() yields in job order, so ranges of a file arrive in file order.
+        for file_idx, nbytes, counts, lengths in done:
+            for k, c in enumerate(counts):
+                results[file_idx][k].merge(c)
+                if lengths is not None:
+                    per_file[file_idx][k].extend(lengths[k])
+            bar.update(nbytes)
+
+    with tqdm(total=total_bytes, desc="Tokenizing", unit="B", unit_scale=True) as bar:
+        if num_workers <= 1:
+            _init_worker(names, hf_token, single_process=True)
+            collect(map(count_range, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                     initargs=(names, hf_token, False)) as executor:
+                collect(executor.map(count_range, jobs))
+    return results, (per_file if per_record else None)
+
+
+def count_files(
+    paths: Sequence[Path],
+    tokenizer_name: str,
+    num_workers: int = 1,
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    hf_token: str | None = None,
+    per_record: bool = False,
+) -> List[TokenCounts] | Tuple[List[TokenCounts], List[array]]:
+    """Count lines and tokens for every file; results are in the order of `paths`.
+
+    With per_record=True, also return one uint32 array per file holding the
+    token count of every line (NO_TEXT for lines without a "text" string).
+    """
+    counts, lengths = count_files_multi(paths, [tokenizer_name], num_workers, chunk_bytes,
+                                        batch_size, hf_token, per_record)
+    results = [c[0] for c in counts]
+    return (results, [l[0] for l in lengths]) if per_record else results
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+token_sidecar.py
+
+Persistent per-record token counts for *.jsonl files.
+
+For every (file, tokenizer) pair a sidecar is kept in `<folder>/.token_cache/`:
+
+    <file name>.<tokenizer slug>.u32    uint32 token count per line, in line order
+                                        (NO_TEXT for lines without a "text" string)
+    <file name>.<tokenizer slug>.json   content hash, size, mtime, the file totals and
+                                        the token-length histogram of non-empty texts
+
+A sidecar is valid when the file's content hash matches; size + mtime are
+checked first so unchanged files are never re-hashed. Stats scripts reuse
+valid sidecars and only tokenize new or changed files, and filters can sum
+the stored counts of the records they keep without tokenizing anything.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from array import array
+from pathlib import Path
+from typing import Optional
+
+from common.length_histogram import LengthHistogram
+from common.token_counting import NO_TEXT, TokenCounts
+
+CACHE_DIR_NAME = ".token_cache"
+VERSION = 2  # bumped when the stored counts change (2: added "chars")
+_HASH_BLOCK = 1 << 20
+
+assert array("I").itemsize == 4, "sidecars need a 4-byte unsigned array type"
+
+
+def file_hash(path: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(_HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def tokenizer_slug(tokenizer_name: str) -> str:
+    return tokenizer_name.strip("/").replace("/", "__")
+
+
+class TokenSidecar:
+    """Per-record token counts of one file under one tokenizer."""
+
+    def __init__(self, path: Path, tokenizer_name: str, cache_dir: Optional[Path] = None) -> None:
+        self.path = Path(path)
+        self.tokenizer_name = tokenizer_name
+        cache_dir = Path(cache_dir) if cache_dir else self.path.parent / CACHE_DIR_NAME
+        stem = f"{self.path.name}.{tokenizer_slug(tokenizer_name)}"
+        self.data_path = cache_dir / f"{stem}.u32"
+        self.meta_path = cache_dir / f"{stem}.json"
+
+    def _meta(self) -> Optional[dict]:
+        try:
+            return json.loads(self.meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def is_valid(self) -> bool:
+        meta = self._meta()
+        if (meta is None or meta.get("version") != VERSION or meta.get("tokenizer") != self.tokenizer_name
+                or not self.data_path.exists()):
+            return False
+        st = self.path.stat()
+        if meta["size"] == st.st_size and meta["mtime_ns"] == st.st_mtime_ns:
+            return True
+        if meta["size"] != st.st_size or meta["content_hash"] != file_hash(self.path):
+            return False
+        # Same content, new mtime (copied or touched): refresh so the next check is cheap.
+        meta["mtime_ns"] = st.st_mtime_ns
+        self.meta_path.write_text(json.dumps(meta), encoding="utf-8")
+        return True
+
+    def counts(self) -> TokenCounts:
+        meta = self._meta() or {}
+        counts = TokenCounts()
+        for name in TokenCounts.__slots__:
+            setattr(counts, name, meta.get("counts", {}).get(name, 0))
+        return counts
+
+    def histogram(self) -> LengthHistogram:
+        """Stored histogram of a valid sidecar (check is_valid() first)."""
+        meta = self._meta()
+        if meta is None or "histogram" not in meta:
+            raise ValueError(f"{self.meta_path}: no stored histogram")
+        return LengthHistogram.from_dict(meta["histogram"])
+
+    def lengths(self) -> array:
+        arr = array("I")
+        with open(self.data_path, "rb") as fp:
+            arr.fromfile(fp, self.data_path.stat().st_size // arr.itemsize)
+        return arr
+
+    def write(self, lengths: array, counts: TokenCounts, hist: Optional[LengthHistogram] = None) -> None:
+        if len(lengths) != counts.lines:
+            raise ValueError(f"{self.path.name}: {len(lengths)} lengths for {counts.lines} lines")
+        self.data_path.parent.mkdir(parents=True, exist_ok=True)
+        st = self.path.stat()
+        tmp = self.data_path.with_suffix(".u32.tmp")
+        with open(tmp, "wb") as fp:
+            lengths.tofile(fp)
+        os.replace(tmp, self.data_path)
+        meta = {
+            "version": VERSION,
+            "file": self.path.name,
+            "tokenizer": self.tokenizer_name,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "content_hash": file_hash(self.path),
+            "counts": {name: getattr(counts, name) for name in TokenCounts.__slots__},
+            "histogram": (hist or length_histogram(lengths)).to_dict(),
+        }
+        self.meta_path.write_text(json.dumps(meta), encoding="utf-8")
+
+
+def length_histogram(lengths: array) -> LengthHistogram:
+    """Histogram of the token lengths of non-empty texts."""
+    return LengthHistogram().update(n for n in lengths if n and n != NO_TEXT)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+tokenizer_provider.py
+
+Fast-startup tokenizers for the per-file scripts.
+
+    tokenizer = load_tokenizer("meta-llama/Meta-Llama-3-8B-Instruct", trust_remote_code=True)
+
+`import transformers` and AutoTokenizer.from_pretrained cost several seconds
+per process (more when the Hub is probed from a node without network), and
+the README loops pay that once per part file. Everything the pipeline needs
+from a tokenizer is in two local files: tokenizer.json (the Rust `tokenizers`
+model, for counting and encoding) and tokenizer_config.json /
+chat_template.jinja (special tokens and the chat template). load_tokenizer
+looks for them offline, in this order:
+
+    1. `name` itself, if it is a directory
+    2. <dir>/<name> for every dir in $NCC_TOKENIZERS (os.pathsep-separated) -- the local registry
+    3. the Hugging Face hub cache ($HF_HUB_CACHE, $HF_HOME/hub or ~/.cache/huggingface/hub)
+
+and returns a LocalTokenizer: backend_tokenizer, encode(), bos/eos tokens,
+chat_template and apply_chat_template() rendered with jinja2 the way
+transformers does. transformers is only imported when it is really needed:
+no local tokenizer.json (slow-only tokenizers, first use on a node with
+network), a tokenizer with custom code (auto_map), or
+NCC_TOKENIZER_BACKEND=transformers.
+
+Fill the registry once from a node with network:
+
+    python common/tokenizer_provider.py --registry /nfs/tokenizers --register meta-llama/Meta-Llama-3-8B-Instruct
+    export NCC_TOKENIZERS=/nfs/tokenizers
+
+Names given as arguments are resolved, timed and checked: a batch of
+conversations must render to the same texts as one conversation at a time.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+REGISTRY_ENV = "NCC_TOKENIZERS"
+BACKEND_ENV = "NCC_TOKENIZER_BACKEND"
+SPECIAL_TOKENS = ("bos_token", "eos_token", "unk_token", "sep_token", "pad_token", "cls_token", "mask_token")
+
+
+def _hub_cache() -> Path:
+    if os.environ.get("HF_HUB_CACHE"):
+        return Path(os.environ["HF_HUB_CACHE"])
+    if os.environ.get("HF_HOME"):
+        return Path(os.environ["HF_HOME"]) / "hub"
+    return Path.home() / ".cache" / "huggingface" / "hub"
+
+
+def _candidates(name: str) -> Iterator[Path]:
+    yield Path(name).expanduser()
+    for registry in filter(None, os.environ.get(REGISTRY_ENV, "").split(os.pathsep)):
+        yield Path(registry) / name
+    repo = _hub_cache() / f"models--{name.replace('/', '--')}"
+    ref = repo / "refs" / "main"
+    if ref.is_file():
+        yield repo / "snapshots" / ref.read_text().strip()
+    snapshots = repo / "snapshots"
+    if snapshots.is_dir():
+        yield from sorted(snapshots.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True)
+
+
+def resolve_local(name: str) -> Optional[Path]:
+    """The first local directory holding tokenizer.json for `name`, or None (no network access)."""
+    for directory in _candidates(name):
+        if (directory / "tokenizer.json").is_file():
+            return directory
+    return None
+
+
+def _read_json(path: Path) -> dict:
+    if not path.is_file():
+        return {}
+    with path.open(encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def _token_content(value) -> Optional[str]:
+    # tokenizer_config.json stores special tokens as strings or as serialized AddedTokens.
+    if isinstance(value, dict):
+        return value.get("content")
+    return value if isinstance(value, str) else None
+
+
+def _chat_template(directory: Path, config: dict) -> Optional[str]:
+    jinja = directory / "chat_template.jinja"
+    if jinja.is_file():
+        return jinja.read_text(encoding="utf-8")
+    template = config.get("chat_template")
+    if isinstance(template, list):  # named templates: [{"name": "default", "template": ...}, ...]
+        named = {t.get("name"): t.get("template") for t in template if isinstance(t, dict)}
+        template = named.get("default")
+    return template if isinstance(template, str) else None
+
+
+_COMPILED: Dict[str, object] = {}
+
+
+def _compile(template: str):
+    """Compile a chat template in the same jinja2 environment transformers uses."""
+    if template not in _COMPILED:
+        import jinja2
+        from jinja2.ext import loopcontrols
+        from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+        def raise_exception(message):
+            raise jinja2.exceptions.TemplateError(message)
+
+        def tojson(x, ensure_ascii=False, indent=None, separators=None, sort_keys=False):
+            return json.dumps(x, ensure_ascii=ensure_ascii, indent=indent, separators=separators, sort_keys=sort_keys)
+
+        env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True, extensions=[loopcontrols])
+        env.filters["tojson"] = tojson
+        env.globals["raise_exception"] = raise_exception
+        env.globals["strftime_now"] = lambda fmt: datetime.now().strftime(fmt)
+        _COMPILED[template] = env.from_string(template)
+    return _COMPILED[template]
+
+
+class LocalTokenizer:
+    """The part of the transformers tokenizer API the pipeline uses, on top of `tokenizers` alone."""
+
+    def __init__(self, directory: Path, name: Optional[str] = None) -> None:
+        from tokenizers import Tokenizer
+
+        self.name_or_path = name or str(directory)
+        self.backend_tokenizer = Tokenizer.from_file(str(directory / "tokenizer.json"))
+        config = _read_json(directory / "tokenizer_config.json")
+        special = _read_json(directory / "special_tokens_map.json")
+        self.special_tokens_map: Dict[str, str] = {}
+        for key in SPECIAL_TOKENS:
+            value = _token_content(config.get(key)) or _token_content(special.get(key))
+            if value is not None:
+                self.special_tokens_map[key] = value
+        self.chat_template = _chat_template(directory, config)
+
+    def __repr__(self) -> str:
+        return f"LocalTokenizer({self.name_or_path!r})"
+
+    def __getattr__(self, name: str):
+        # bos_token / eos_token_id / ... like transformers (None when the tokenizer has no such token)
+        if name.endswith("_token_id") and name[:-3] in SPECIAL_TOKENS:
+            token = self.special_tokens_map.get(name[:-3])
+            return None if token is None else self.backend_tokenizer.token_to_id(token)
+        if name in SPECIAL_TOKENS:
+            return self.special_tokens_map.get(name)
+        raise AttributeError(name)
+
+    def __len__(self) -> int:
+        return self.backend_tokenizer.get_vocab_size(with_added_tokens=True)
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> List[int]:
+        return self.backend_tokenizer.encode(text, add_special_tokens=add_special_tokens).ids
+
+    def decode(self, ids: List[int], skip_special_tokens: bool = False) -> str:
+        return self.backend_tokenizer.decode(ids, skip_special_tokens=skip_special_tokens)
+
+    def apply_chat_template(self, conversation, tokenize: bool = True, add_generation_prompt: bool = False,
+                            tools=None, documents=None, **kwargs):
+        if self.chat_template is None:
+            raise ValueError(f"{self.name_or_path} has no chat template")
+        if conversation and isinstance(conversation[0], (list, tuple)):
+            # a batch of conversations, one result per conversation (as in transformers)
+            return [self.apply_chat_template(messages, tokenize=tokenize, add_generation_prompt=add_generation_prompt,
+                                             tools=tools, documents=documents, **kwargs)
+                    for messages in conversation]
+        text = _compile(self.chat_template).render(
+            messages=conversation, tools=tools, documents=documents,
+            add_generation_prompt=add_generation_prompt, **self.special_tokens_map, **kwargs)
+        return self.encode(text, add_special_tokens=False) if tokenize else text
+
+
+def _needs_transformers(directory: Optional[Path]) -> bool:
+    if os.environ.get(BACKEND_ENV) == "transformers" or directory is None:
+        return True
+    auto_map = _read_json(directory / "tokenizer_config.json").get("auto_map") or {}
+    return "AutoTokenizer" in auto_map if isinstance(auto_map, dict) else bool(auto_map)
+
+
+def load_tokenizer(name: str, trust_remote_code: bool = False, token: Optional[str] = None, **kwargs):
+    """A LocalTokenizer when `name` resolves offline, else AutoTokenizer.from_pretrained(name, ...)."""
+    directory = resolve_local(name)
+    if not _needs_transformers(directory):
+        logging.info("Tokenizer %s: tokenizers backend from %s", name, directory)
+        return LocalTokenizer(directory, name)
+    try:
+        from transformers import AutoTokenizer
+    except ImportError as exc:
+        raise ImportError(f"No local tokenizer.json for {name!r} (see ${REGISTRY_ENV}) "
+                          "and transformers is not installed") from exc
+    logging.info("Tokenizer %s: transformers AutoTokenizer", name)
+    return AutoTokenizer.from_pretrained(str(directory or name), trust_remote_code=trust_remote_code,
+                                         token=token, **kwargs)
+
+
+CHECK_CONVERSATIONS = [
+    [{"role": "system", "content": "Du er en hjelpsom assistent."},
+     {"role": "user", "content": "Hva er hovedstaden i Norge?"},
+     {"role": "assistant", "content": "Oslo."}],
+    [{"role": "user", "content": "Oversett: god morgen"},
+     {"role": "assistant", "content": "Good morning."}],
+]
+
+
+def check_batch(tokenizer) -> bool:
+    """True if a batch of conversations renders to the same texts as rendering them one by one."""
+    if getattr(tokenizer, "chat_template", None) is None:
+        return True
+    batch = tokenizer.apply_chat_template(CHECK_CONVERSATIONS, tokenize=False)
+    single = [tokenizer.apply_chat_template(messages, tokenize=False) for messages in CHECK_CONVERSATIONS]
+    return batch == single
+
+
+def register(name: str, registry: Path, token: Optional[str] = None) -> Path:
+    """Save `name` (downloaded with transformers) to <registry>/<name> for offline use."""
+    from transformers import AutoTokenizer
+
+    target = registry / name
+    AutoTokenizer.from_pretrained(name, trust_remote_code=True, token=token).save_pretrained(str(target))
+    if not (target / "tokenizer.json").is_file():
+        logging.warning("%s has no fast tokenizer; it will still be loaded with transformers", name)
+    return target
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Register tokenizers for offline use and check where names resolve.")
+    parser.add_argument("names", nargs="*", help="Tokenizer names to resolve and time.")
+    parser.add_argument("--register", nargs="+", default=[], metavar="NAME", help="Download and save these tokenizers.")
+    parser.add_argument("--registry", type=Path, default=None, help=f"Registry directory (default: first entry of ${REGISTRY_ENV}).")
+    parser.add_argument("--hf_token", type=str, default=None, help="Hugging Face token for gated tokenizers.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    if args.register:
+        registry = args.registry or next(iter(filter(None, os.environ.get(REGISTRY_ENV, "").split(os.pathsep))), None)
+        if registry is None:
+            sys.exit(f"Give --registry or set ${REGISTRY_ENV}")
+        for name in args.register:
+            print(f"{name} -> {register(name, Path(registry), args.hf_token)}")
+    for name in args.names:
+        t0 = time.perf_counter()
+        tokenizer = load_tokenizer(name)
+        print(f"{name}: {tokenizer!r} via {resolve_local(name) or 'transformers'} in {time.perf_counter() - t0:.2f}s")
+        if not check_batch(tokenizer):
+            sys.exit(f"{name}: batched apply_chat_template differs from single renders")
+
+
+if __name__ == "__main__":
+    main()